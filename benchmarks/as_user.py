@@ -0,0 +1,79 @@
+# encoding=utf-8
+"""Measure the cost of calling a function through as_user().
+
+Compare the persistent worker with the previous model, where each call forked
+a new process and returned its result through a SimpleQueue.
+
+Run with "python -m benchmarks.as_user [calls]" from the repository root.
+"""
+from multiprocessing import (Process,
+                             SimpleQueue,
+                             )
+from os import stat
+from os.path import abspath
+from sys import argv
+from time import perf_counter
+from wdeploy.user import (as_user,
+                          stop_workers,
+                          )
+
+
+def _getMTime(path):
+    try:
+        return stat(path).st_mtime
+    except OSError:
+        return 0
+
+
+@as_user()
+def _workerMTime(path):
+    return _getMTime(path)
+
+
+def _forkedMTime(path):
+    """Reproduce the fork-per-call behavior of as_user() before workers"""
+    resultQueue = SimpleQueue()
+
+    def user_switched_process(path):
+        try:
+            resultQueue.put(_getMTime(path))
+            resultQueue.put(None)
+        except Exception as e:
+            resultQueue.put(None)
+            resultQueue.put(e)
+
+    subprocess = Process(target=user_switched_process,
+                         args=(path,),
+                         )
+    subprocess.start()
+    result = resultQueue.get()
+    exception = resultQueue.get()
+    subprocess.join()
+    if exception:
+        raise exception
+    return result
+
+
+def measure(function, path, count):
+    """Return the number of calls per second"""
+    start = perf_counter()
+    for _ in range(count):
+        function(path)
+    return count / (perf_counter() - start)
+
+
+def main():
+    count = int(argv[1]) if len(argv) > 1 else 2000
+    path = abspath(__file__)
+    forked = measure(_forkedMTime, path, count)
+    # First call starts the worker; keep it out of the measure
+    _workerMTime(path)
+    persistent = measure(_workerMTime, path, count)
+    stop_workers()
+    print('fork per call:     %10.1f calls/s' % forked)
+    print('persistent worker: %10.1f calls/s' % persistent)
+    print('speedup:           %10.1fx' % (persistent / forked))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+# encoding=utf-8
+"""Measure the memory and time needed to build a dependency graph.
+
+Compare DependencyGraph with the previous representation, where each file was
+a dictionary holding its paths, modification time and a list of dependencies.
+
+A synthetic tree is used: each file depends on up to two files added before
+it. Dependencies are resolved without touching the filesystem.
+
+Run with "python -m benchmarks.dependency_graph [files...]" from the
+repository root.
+"""
+from array import array
+from os.path import join
+from random import Random
+from sys import argv
+from time import perf_counter
+import tracemalloc
+from wdeploy import dependencies
+
+BASE_DIR = '/project/static/less'
+FILES_PER_DIRECTORY = 100
+
+
+def _relativePath(fileId):
+    return join('dir%s' % (fileId // FILES_PER_DIRECTORY),
+                'file%s.less' % fileId,
+                )
+
+
+def _makeTree(nodeCount):
+    """Return the relative path of all files, their dependencies and mtimes"""
+    rng = Random(nodeCount)
+    filesList = [_relativePath(fileId)
+                 for fileId in range(nodeCount)
+                 ]
+    deps = {}
+    for fileId in range(1, nodeCount):
+        deps[join(BASE_DIR, filesList[fileId])] = [
+            filesList[rng.randrange(fileId)]
+            for _ in range(rng.randrange(3))
+        ]
+    mtimes = {join(BASE_DIR, relativePath): rng.randrange(1 << 60)
+              for relativePath in filesList
+              }
+    return filesList, deps, mtimes
+
+
+def _buildDicts(filesList, deps, mtimes):
+    """Build the graph as the previous checkDependencies() did"""
+    allFiles = {x: {'modifiedDate': None,
+                    'relativePath': x,
+                    'fullPath': join(BASE_DIR, x),
+                    'deps': [],
+                    }
+                for x in filesList
+                }
+    dependencyFiles = {}
+    pending = list(allFiles.values())
+    while pending:
+        fileObj = pending.pop()
+        for dependency in deps.get(fileObj['fullPath'], ()):
+            depObj = dependencyFiles.get(dependency)
+            if depObj is None:
+                depObj = {'modifiedDate': None,
+                          'relativePath': dependency,
+                          'fullPath': join(BASE_DIR, dependency),
+                          'deps': [],
+                          }
+                dependencyFiles[dependency] = depObj
+                pending.append(depObj)
+            fileObj['deps'].append(depObj)
+
+    def updateMTime(fileObj):
+        selfMTime = mtimes[fileObj['fullPath']]
+        for dep in fileObj['deps']:
+            if dep['modifiedDate'] is None:
+                updateMTime(dep)
+            if dep['modifiedDate'] > selfMTime:
+                selfMTime = dep['modifiedDate']
+        fileObj['modifiedDate'] = selfMTime
+
+    for fileObj in allFiles.values():
+        updateMTime(fileObj)
+    return allFiles, dependencyFiles
+
+
+def _buildGraph(filesList, deps, mtimes):
+    """Build the graph as checkDependencies() does"""
+    graph = dependencies.DependencyGraph()
+    for relativePath in filesList:
+        graph.addSource(BASE_DIR, relativePath)
+    graph.build([BASE_DIR],
+                False,
+                lambda fullPath: deps.get(fullPath),
+                )
+    newestMTimes = graph.newestMTimes(
+        array('q',
+              (mtimes[graph.fullPath(node)]
+               for node in range(len(graph))
+               ),
+              ),
+    )
+    return graph, newestMTimes
+
+
+def measure(function, *args):
+    """Return the memory kept by the result of function, and the time taken.
+
+    Notes
+    -----
+    Tracing memory allocations slows down the function; it is timed in a
+    separate run.
+    """
+    start = perf_counter()
+    result = function(*args)
+    duration = perf_counter() - start
+    del result
+    tracemalloc.start()
+    result = function(*args)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return memory, duration
+
+
+def main():
+    sizes = [int(size) for size in argv[1:]] or [10000, 100000, 1000000]
+    # The benchmark doesn't create files
+    dependencies.isfile = lambda path: True
+    print('%10s %22s %22s' % ('files', 'dictionaries', 'DependencyGraph'))
+    for nodeCount in sizes:
+        tree = _makeTree(nodeCount)
+        dictMemory, dictTime = measure(_buildDicts, *tree)
+        graphMemory, graphTime = measure(_buildGraph, *tree)
+        print('%10s %9.1fMB %9.2fs %9.1fMB %9.2fs'
+              % (nodeCount,
+                 dictMemory / 1e6,
+                 dictTime,
+                 graphMemory / 1e6,
+                 graphTime,
+                 ),
+              )
+
+
+if __name__ == '__main__':
+    main()
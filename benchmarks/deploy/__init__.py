@@ -0,0 +1,10 @@
+# encoding=utf-8
+"""Measure full deployments of a synthetic project.
+
+A project of configurable size is generated (see generator), with stub
+programs standing for the real toolchain (see stubtool.py). Deployments are
+then timed from a cold state, with nothing to do, and after changing one input
+file of each task (see runner).
+
+Run with "python -m benchmarks.deploy --help" from the repository root.
+"""
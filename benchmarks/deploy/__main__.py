@@ -0,0 +1,4 @@
+# encoding=utf-8
+from .runner import main
+
+main()
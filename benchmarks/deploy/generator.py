@@ -0,0 +1,531 @@
+# encoding=utf-8
+"""Generate a synthetic project to deploy.
+
+The project directory contains:
+- root/: the project sources
+  - static/: plain files, mirrored by synctree
+  - less/ and less_include/: LESS files, each importing some partials
+  - js/: Javascript files
+  - img/: JPEG and SVG images
+  - third/: descriptions of third-party packages
+  - pages/: header, footer and bodies of static pages
+  - env/: a Python environment to reproduce (see stubenv.py)
+  - app/: a Django-like project, with migrations run by a stub manage.py
+- repos/: local git repositories of the third-party packages
+- prefix/: the deployment directory
+- tools/: stub programs (see stubtool.py and stubenv.py)
+- config.py: the project configuration
+"""
+from grp import getgrgid
+import json
+from os import (environ,
+                getgid,
+                getuid,
+                makedirs,
+                pathsep,
+                remove,
+                symlink,
+                )
+from os.path import (abspath,
+                     dirname,
+                     join,
+                     )
+from pprint import pformat
+from pwd import getpwuid
+from random import Random
+from shutil import which
+from subprocess import (DEVNULL,
+                        check_call,
+                        )
+from .stubenv import (INSTALLED_NAME,
+                      createEnvironment,
+                      installPackages,
+                      )
+
+# Programs replaced by stubs, by name
+STUB_TOOLS = ('lessc',
+              'uglifyjs',
+              'cssmin',
+              'jpegtran',
+              'svgo',
+              )
+
+# Programs replaced by stubs of Python environment tools (see stubenv.py)
+STUB_ENV_TOOLS = ('virtualenv',
+                  )
+
+# Task description of each kind of input, as used in results
+TASK_DESCRIPTIONS = {'static': 'Static files',
+                     'css': 'Styles',
+                     'js': 'Scripts',
+                     'img': 'Images',
+                     'third': 'Third-party packages',
+                     'pages': 'Pages',
+                     'virtualenv': 'Python environment',
+                     'manage': 'Migrations',
+                     'apachecfg': 'Apache configuration',
+                     }
+
+# Default size of generated projects
+DEFAULT_SIZES = {'staticFiles': 200,
+                 'lessFiles': 50,
+                 'lessPartials': 20,
+                 'lessFanout': 5,
+                 'jsFiles': 100,
+                 'images': 50,
+                 'thirdPackages': 5,
+                 'pages': 50,
+                 'pythonPackages': 20,
+                 'migrations': 20,
+                 }
+
+_CONFIG_TEMPLATE = '''# Generated by benchmarks.deploy
+ROOT = %(root)r
+PREFIX = %(prefix)r
+PROJECT_NAME = 'benchmark'
+PREFIX_USER = %(user)r
+PREFIX_GROUP = %(group)r
+PREFIX_PERMISSIONS = None
+TASK_JOBS = %(taskJobs)r
+TASKS = %(tasks)s
+'''
+
+_GIT_IDENTITY = ['-c', 'user.name=benchmark',
+                 '-c', 'user.email=benchmark@localhost',
+                 ]
+
+
+def _writeFile(path, content):
+    makedirs(dirname(path), exist_ok=True)
+    with open(path, 'w') as outFile:
+        outFile.write(content)
+
+
+def _javascript(rng, name):
+    lines = ['// %s' % name,
+             'var %s = (function () {' % name,
+             ]
+    for index in range(rng.randrange(20, 60)):
+        lines.append('    var value%s = %s * %s;'
+                     % (index,
+                        rng.randrange(1000),
+                        rng.randrange(1000),
+                        ),
+                     )
+    lines += ['    return value0;',
+              '})();',
+              '',
+              ]
+    return '\n'.join(lines)
+
+
+def _stylesheet(rng, selector):
+    return ''.join('.%s-%s {\n  margin: %spx;\n  color: #%06x;\n}\n'
+                   % (selector,
+                      index,
+                      rng.randrange(50),
+                      rng.randrange(1 << 24),
+                      )
+                   for index in range(rng.randrange(5, 20))
+                   )
+
+
+def _svg(rng):
+    return ('<svg xmlns="http://www.w3.org/2000/svg" width="100" '
+            'height="100">\n%s</svg>\n'
+            % ''.join('  <circle cx="%s" cy="%s" r="%s" />\n'
+                      % (rng.randrange(100),
+                         rng.randrange(100),
+                         rng.randrange(1, 20),
+                         )
+                      for _ in range(rng.randrange(5, 30))
+                      ))
+
+
+def _git(args, cwd):
+    check_call(['git'] + _GIT_IDENTITY + args,
+               cwd=cwd,
+               stdout=DEVNULL,
+               stderr=DEVNULL,
+               )
+
+
+def _generateThird(projectDir, rng, count):
+    """Create the git repositories and descriptions of third-party packages"""
+    if count and which('git') is None:
+        print('git not found, no third-party package generated')
+        count = 0
+    for index in range(count):
+        name = 'package%s' % index
+        repoPath = join(projectDir, 'repos', name)
+        _writeFile(join(repoPath, 'dist', '%s.js' % name),
+                   _javascript(rng, name),
+                   )
+        _writeFile(join(repoPath, 'dist', '%s.css' % name),
+                   _stylesheet(rng, name),
+                   )
+        _writeFile(join(repoPath, 'README'),
+                   'Not deployed\n',
+                   )
+        _git(['init', '-q'], repoPath)
+        _git(['add', '.'], repoPath)
+        _git(['commit', '-q', '-m', 'Version 1'], repoPath)
+        _git(['tag', 'v1'], repoPath)
+        _writeFile(join(projectDir, 'root', 'third', '%s.json' % name),
+                   json.dumps({'source': {'type': 'git',
+                                          'url': 'file://%s' % repoPath,
+                                          'tag': 'v1',
+                                          },
+                               'files': {'js': {'dist/%s.js' % name:
+                                                '%s.js' % name,
+                                                },
+                                         'css': {'dist/%s.css' % name:
+                                                 '%s.css' % name,
+                                                 },
+                                         },
+                               },
+                              indent=2,
+                              ),
+                   )
+    return count
+
+
+_MANAGE_TEMPLATE = '''# Generated by benchmarks.deploy
+# Stand-in for a Django manage.py: only waits like a migration would
+from os import environ
+from time import sleep
+sleep(float(environ.get('BENCHMARK_MANAGE_LATENCY',
+                        environ.get('BENCHMARK_TOOL_LATENCY', 0.02))))
+'''
+
+
+def _generatePages(rootDir, rng, count):
+    """Create the header, footer and bodies of static pages"""
+    _writeFile(join(rootDir, 'pages', 'header.html'),
+               '<html><head><title>%TITLE%</title></head><body>\n',
+               )
+    _writeFile(join(rootDir, 'pages', 'footer.html'),
+               '</body></html>\n',
+               )
+    for index in range(count):
+        _writeFile(join(rootDir, 'pages', 'page%s.html' % index),
+                   ''.join('<p>Paragraph %s of page %s</p>\n' % (line, index)
+                           for line in range(rng.randrange(10, 100))
+                           ),
+                   )
+
+
+def _generateApp(rootDir, pythonPackages, migrations):
+    """Create the Python environment and the Django-like project"""
+    createEnvironment(join(rootDir, 'env'))
+    installPackages(join(rootDir, 'env'),
+                    ''.join('package%s==1.0\n' % index
+                            for index in range(pythonPackages)
+                            ),
+                    )
+    appDir = join(rootDir, 'app')
+    _writeFile(join(appDir, 'manage.py'), _MANAGE_TEMPLATE)
+    _writeFile(join(appDir, 'site', 'settings.py'),
+               'INSTALLED_APPS = [\'site\']\n',
+               )
+    for index in range(migrations):
+        _writeFile(join(appDir, 'site', 'migrations',
+                        '%04d_migration.py' % index),
+                   '# Migration %s\n' % index,
+                   )
+
+
+def _tasks(thirdPackages, pages, prefixDir, rootDir):
+    tasks = [{'name': 'synctree',
+              'desc': TASK_DESCRIPTIONS['static'],
+              'args': {'sourceDir': 'static',
+                       'destDir': 'static',
+                       'incremental': True,
+                       },
+              },
+             {'name': 'css',
+              'desc': TASK_DESCRIPTIONS['css'],
+              'args': {'sourceDir': 'less',
+                       'destinationDir': 'css',
+                       'includeDirs': ['less_include'],
+                       'incremental': True,
+                       },
+              },
+             {'name': 'js',
+              'desc': TASK_DESCRIPTIONS['js'],
+              'args': {'sourceDir': 'js',
+                       'destinationDir': 'js',
+                       'incremental': True,
+                       },
+              },
+             {'name': 'img',
+              'desc': TASK_DESCRIPTIONS['img'],
+              'args': {'sourceDir': 'img',
+                       'destinationDir': 'img',
+                       'incremental': True,
+                       },
+              },
+             ]
+    if thirdPackages:
+        tasks.append({'name': 'third',
+                      'desc': TASK_DESCRIPTIONS['third'],
+                      'args': {'listDir': 'third',
+                               'jsDir': 'third/js',
+                               'cssDir': 'third/css',
+                               'incremental': True,
+                               },
+                      })
+    tasks += [{'name': 'makepages',
+               'desc': TASK_DESCRIPTIONS['pages'],
+               'args': {'sourceDir': 'pages',
+                        'targetDir': 'pages',
+                        'headerNames': ['header'],
+                        'footerNames': ['footer'],
+                        'pagesList': [['Page %s' % index,
+                                       'page%s' % index,
+                                       ]
+                                      for index in range(pages)
+                                      ],
+                        },
+               },
+              {'name': 'virtualenv',
+               'desc': TASK_DESCRIPTIONS['virtualenv'],
+               'args': {'sourceDir': 'env',
+                        'outputDir': 'venv',
+                        'pythonBin': '',
+                        },
+               },
+              {'name': 'manage',
+               'desc': TASK_DESCRIPTIONS['manage'],
+               'args': {'virtualEnv': join(prefixDir, 'venv'),
+                        'projectLocation': join(rootDir, 'app'),
+                        'args': ['migrate'],
+                        'runAs': 'original',
+                        },
+               'skip': True,
+               },
+              {'name': 'apachecfg',
+               'desc': TASK_DESCRIPTIONS['apachecfg'],
+               'args': {'name': 'apache/site.conf',
+                        'apacheConfig': {'venv': 'venv',
+                                         'app': 'app',
+                                         'alias': [['static', 'static'],
+                                                   ['pages', 'pages'],
+                                                   ],
+                                         },
+                        },
+               },
+              ]
+    return tasks
+
+
+def generateProject(projectDir,
+                    staticFiles=DEFAULT_SIZES['staticFiles'],
+                    lessFiles=DEFAULT_SIZES['lessFiles'],
+                    lessPartials=DEFAULT_SIZES['lessPartials'],
+                    lessFanout=DEFAULT_SIZES['lessFanout'],
+                    jsFiles=DEFAULT_SIZES['jsFiles'],
+                    images=DEFAULT_SIZES['images'],
+                    thirdPackages=DEFAULT_SIZES['thirdPackages'],
+                    pages=DEFAULT_SIZES['pages'],
+                    pythonPackages=DEFAULT_SIZES['pythonPackages'],
+                    migrations=DEFAULT_SIZES['migrations'],
+                    taskJobs=1,
+                    seed=0,
+                    ):
+    """Generate a project in an empty directory.
+
+    Parameters
+    ----------
+    projectDir : string
+        The directory to fill
+    staticFiles : int
+        The number of plain files
+    lessFiles : int
+        The number of LESS files producing an output
+    lessPartials : int
+        The number of LESS files only imported by others
+    lessFanout : int
+        The number of partials imported by each LESS file
+    jsFiles : int
+        The number of Javascript files
+    images : int
+        The number of images, half JPEG and half SVG
+    thirdPackages : int
+        The number of third-party packages, each with one JS and one CSS file
+    pages : int
+        The number of static pages
+    pythonPackages : int
+        The number of packages of the Python environment
+    migrations : int
+        The number of migration files of the Django-like project
+    taskJobs : int
+        The TASK_JOBS setting of the project
+    seed : int
+        Seed of the generated content
+
+
+    Returns
+    -------
+    list(string)
+        The kinds of input of the project tasks (see TASK_DESCRIPTIONS)
+
+
+    Notes
+    -----
+    Files are spread in subdirectories of 100 files.
+    """
+    projectDir = abspath(projectDir)
+    rootDir = join(projectDir, 'root')
+    rng = Random(seed)
+    for index in range(staticFiles):
+        _writeFile(join(rootDir, 'static', 'dir%s' % (index // 100),
+                        'file%s.txt' % index),
+                   '%s\n' % ('static file %s ' % index) * rng.randrange(1, 200),
+                   )
+    fanout = min(lessFanout, lessPartials)
+    for index in range(lessPartials):
+        _writeFile(join(rootDir, 'less_include', 'partial%s.less' % index),
+                   _stylesheet(rng, 'partial%s' % index),
+                   )
+    for index in range(lessFiles):
+        imports = ''.join('@import "partial%s";\n' % partial
+                          for partial in sorted(rng.sample(range(lessPartials),
+                                                           fanout,
+                                                           ))
+                          )
+        _writeFile(join(rootDir, 'less', 'dir%s' % (index // 100),
+                        'style%s.less' % index),
+                   imports + _stylesheet(rng, 'style%s' % index),
+                   )
+    for index in range(jsFiles):
+        _writeFile(join(rootDir, 'js', 'dir%s' % (index // 100),
+                        'script%s.js' % index),
+                   _javascript(rng, 'script%s' % index),
+                   )
+    for index in range(images):
+        imagePath = join(rootDir, 'img', 'dir%s' % (index // 100),
+                         'image%s' % index)
+        if index % 2:
+            makedirs(dirname(imagePath), exist_ok=True)
+            with open('%s.jpg' % imagePath, 'wb') as outFile:
+                outFile.write(bytes(rng.randrange(256)
+                                    for _ in range(rng.randrange(1000,
+                                                                 20000))))
+        else:
+            _writeFile('%s.svg' % imagePath, _svg(rng))
+    thirdPackages = _generateThird(projectDir, rng, thirdPackages)
+    makedirs(join(rootDir, 'third'), exist_ok=True)
+    _generatePages(rootDir, rng, pages)
+    _generateApp(rootDir, pythonPackages, migrations)
+    prefixDir = join(projectDir, 'prefix')
+    makedirs(prefixDir, exist_ok=True)
+    toolsDir = join(projectDir, 'tools')
+    makedirs(toolsDir, exist_ok=True)
+    for toolName in STUB_TOOLS:
+        symlink(join(dirname(abspath(__file__)), 'stubtool.py'),
+                join(toolsDir, toolName),
+                )
+    for toolName in STUB_ENV_TOOLS:
+        symlink(join(dirname(abspath(__file__)), 'stubenv.py'),
+                join(toolsDir, toolName),
+                )
+    tasks = _tasks(thirdPackages, pages, prefixDir, rootDir)
+    _writeFile(join(projectDir, 'config.py'),
+               _CONFIG_TEMPLATE % {'root': rootDir,
+                                   'prefix': prefixDir,
+                                   'user': getpwuid(getuid()).pw_name,
+                                   'group': getgrgid(getgid()).gr_name,
+                                   'taskJobs': taskJobs,
+                                   'tasks': pformat(tasks),
+                                   },
+               )
+    return [kind
+            for kind, description in TASK_DESCRIPTIONS.items()
+            if any(taskDesc['desc'] == description
+                   for taskDesc in tasks
+                   )
+            ]
+
+
+def toolEnvironment(projectDir):
+    """Return the environment variables making wdeploy use the stubs.
+
+    Notes
+    -----
+    The tools directory is also put first in PATH, for programs not run
+    through which() (virtualenv).
+    """
+    toolsDir = join(abspath(projectDir), 'tools')
+    result = {'%s_BIN' % toolName.upper(): join(toolsDir, toolName)
+              for toolName in STUB_TOOLS + STUB_ENV_TOOLS
+              }
+    result['PATH'] = pathsep.join([toolsDir,
+                                   environ.get('PATH', ''),
+                                   ],
+                                  )
+    return result
+
+
+def changeOneFile(projectDir, kind):
+    """Change one input file of a task.
+
+    Parameters
+    ----------
+    projectDir : string
+        The generated project
+    kind : string
+        The kind of input, from TASK_DESCRIPTIONS. For styles, a partial is
+        changed, so every file importing it is rebuilt. For the Python
+        environment, a package is installed in the source environment. For
+        the Apache configuration, whose only input files are its outputs, the
+        generated configuration is removed.
+    """
+    rootDir = join(abspath(projectDir), 'root')
+    if kind == 'third':
+        repoPath = join(abspath(projectDir), 'repos', 'package0')
+        descriptionPath = join(rootDir, 'third', 'package0.json')
+        with open(descriptionPath, 'r') as inFile:
+            description = json.load(inFile)
+        version = int(description['source']['tag'][1:]) + 1
+        with open(join(repoPath, 'dist', 'package0.js'), 'a') as outFile:
+            outFile.write('// Version %s\n' % version)
+        _git(['commit', '-q', '-a', '-m', 'Version %s' % version], repoPath)
+        _git(['tag', 'v%s' % version], repoPath)
+        description['source']['tag'] = 'v%s' % version
+        _writeFile(descriptionPath, json.dumps(description, indent=2))
+        return
+    if kind == 'virtualenv':
+        envDir = join(rootDir, 'env')
+        with open(join(envDir, INSTALLED_NAME), 'r') as inFile:
+            requirements = inFile.read()
+        installPackages(envDir,
+                        '%sadded%s==1.0\n' % (requirements,
+                                              len(requirements.splitlines()),
+                                              ),
+                        )
+        return
+    if kind == 'apachecfg':
+        remove(join(abspath(projectDir), 'prefix', 'apache', 'site.conf'))
+        return
+    changedPath = {'static': join(rootDir, 'static', 'dir0', 'file0.txt'),
+                   'css': join(rootDir, 'less_include', 'partial0.less'),
+                   'js': join(rootDir, 'js', 'dir0', 'script0.js'),
+                   'img': join(rootDir, 'img', 'dir0', 'image0.svg'),
+                   'pages': join(rootDir, 'pages', 'page0.html'),
+                   'manage': join(rootDir, 'app', 'site', 'migrations',
+                                  '0000_migration.py'),
+                   }[kind]
+    with open(changedPath, 'r') as inFile:
+        content = inFile.read()
+    if kind == 'img':
+        content = content.replace('</svg>', '<!-- changed --></svg>')
+    elif kind == 'pages':
+        content += '<!-- changed -->\n'
+    elif kind == 'js':
+        content += '// changed\n'
+    elif kind == 'manage':
+        content += '# changed\n'
+    else:
+        content += '/* changed */\n'
+    _writeFile(changedPath, content)
@@ -0,0 +1,342 @@
+# encoding=utf-8
+"""Time deployments of a generated project, and compare with earlier runs.
+
+Scenarios:
+- cold: nothing deployed, no data directory (compile cache, manifests...)
+- noop: everything already deployed
+- change:<kind>: one input file of a task changed (see
+  generator.changeOneFile())
+Each deployment runs in a new process with profiling enabled; the time of each
+task is taken from the profiling report (see wdeploy.profiling).
+Tasks whose inputs include files they write (a virtualenv they install
+packages into...) run again on the deployment following a change. An untimed
+deployment is made after each measured one, so that measures start from a
+settled state.
+
+Results are stored as JSON files in a results directory. They are compared
+with the latest earlier result obtained with the same parameters.
+"""
+from argparse import ArgumentParser
+import json
+from os import (environ,
+                listdir,
+                makedirs,
+                )
+from os.path import (abspath,
+                     dirname,
+                     isdir,
+                     join,
+                     )
+from shutil import rmtree
+from subprocess import (PIPE,
+                        run,
+                        )
+import sys
+from tempfile import mkdtemp
+from time import (perf_counter,
+                  strftime,
+                  )
+from .generator import (DEFAULT_SIZES,
+                        TASK_DESCRIPTIONS,
+                        changeOneFile,
+                        generateProject,
+                        toolEnvironment,
+                        )
+
+# Root of the repository, containing webdeploy.py
+REPOSITORY_DIR = dirname(dirname(dirname(abspath(__file__))))
+
+DEFAULT_RESULTS_DIR = join(REPOSITORY_DIR, 'benchmarks', 'results')
+
+RESULTS_VERSION = 1
+
+_DEPLOY_SCRIPT = 'import webdeploy; webdeploy.run()'
+
+
+def runDeploy(projectDir, latency):
+    """Deploy the project once.
+
+    Returns
+    -------
+    dict
+        The total time in seconds ("seconds") and the time of each task by
+        description ("tasks")
+    """
+    environment = dict(environ)
+    environment.update(toolEnvironment(projectDir))
+    environment.update({'PYTHONPATH': REPOSITORY_DIR,
+                        'DEPLOY_CONFIG': projectDir,
+                        'WDEPLOY_PROFILE': '1',
+                        'BENCHMARK_TOOL_LATENCY': str(latency),
+                        })
+    start = perf_counter()
+    process = run([sys.executable,
+                   '-c', _DEPLOY_SCRIPT,
+                   ],
+                  cwd=REPOSITORY_DIR,
+                  env=environment,
+                  stdout=PIPE,
+                  stderr=PIPE,
+                  )
+    seconds = perf_counter() - start
+    if process.returncode != 0:
+        sys.stderr.write(process.stderr.decode('utf-8', 'replace'))
+        raise RuntimeError('Deployment failed')
+    with open(join(projectDir, 'root', '.deploy', 'profile.json'),
+              'r') as inFile:
+        profile = json.load(inFile)
+    tasks = {}
+    for taskRecord in profile['tasks']:
+        tasks[taskRecord['desc']] = (tasks.get(taskRecord['desc'], 0)
+                                     + taskRecord['seconds'])
+    return {'seconds': seconds,
+            'tasks': tasks,
+            }
+
+
+def _best(measures):
+    """Keep the fastest time of each task over repeated measures"""
+    return {'seconds': min(measure['seconds'] for measure in measures),
+            'tasks': {description: min(measure['tasks'].get(description, 0)
+                                       for measure in measures
+                                       )
+                      for description in measures[0]['tasks']
+                      },
+            }
+
+
+def _clean(projectDir):
+    """Remove everything deployed, and the data directory"""
+    for path in (join(projectDir, 'prefix'),
+                 join(projectDir, 'root', '.deploy'),
+                 ):
+        if isdir(path):
+            rmtree(path)
+    makedirs(join(projectDir, 'prefix'))
+
+
+def runSuite(projectDir, kinds, repeat=1, latency=0.02):
+    """Time all scenarios on a generated project.
+
+    Parameters
+    ----------
+    projectDir : string
+        The generated project
+    kinds : list(string)
+        The kinds of input to change, as returned by generateProject()
+    repeat : int
+        The number of times each scenario is run; the fastest is kept
+    latency : float
+        The time taken by each stub program, in seconds
+
+
+    Returns
+    -------
+    dict
+        The results of each scenario, by name (see runDeploy())
+    """
+    results = {}
+    measures = []
+    for _ in range(repeat):
+        _clean(projectDir)
+        measures.append(runDeploy(projectDir, latency))
+    results['cold'] = _best(measures)
+    runDeploy(projectDir, latency)
+    measures = [runDeploy(projectDir, latency)
+                for _ in range(repeat)
+                ]
+    results['noop'] = _best(measures)
+    for kind in kinds:
+        measures = []
+        for _ in range(repeat):
+            changeOneFile(projectDir, kind)
+            measures.append(runDeploy(projectDir, latency))
+            runDeploy(projectDir, latency)
+        results['change:%s' % kind] = _best(measures)
+    return results
+
+
+def _gitRevision():
+    process = run(['git', 'rev-parse', '--short', 'HEAD'],
+                  cwd=REPOSITORY_DIR,
+                  stdout=PIPE,
+                  stderr=PIPE,
+                  )
+    if process.returncode != 0:
+        return None
+    return process.stdout.decode().strip()
+
+
+def saveResults(resultsDir, parameters, scenarios):
+    """Store results in a new file of the results directory.
+
+    Returns
+    -------
+    dict
+        The stored results
+    """
+    results = {'version': RESULTS_VERSION,
+               'date': strftime('%Y-%m-%d %H:%M:%S'),
+               'revision': _gitRevision(),
+               'parameters': parameters,
+               'scenarios': scenarios,
+               }
+    makedirs(resultsDir, exist_ok=True)
+    resultsPath = join(resultsDir, '%s.json' % strftime('%Y%m%d-%H%M%S'))
+    with open(resultsPath, 'w') as outFile:
+        json.dump(results, outFile, indent=2, sort_keys=True)
+    print('Results stored in %s' % resultsPath)
+    return results
+
+
+def previousResults(resultsDir, parameters):
+    """Return the latest stored results with the same parameters, or None"""
+    if not isdir(resultsDir):
+        return None
+    for fileName in sorted(listdir(resultsDir), reverse=True):
+        if not fileName.endswith('.json'):
+            continue
+        try:
+            with open(join(resultsDir, fileName), 'r') as inFile:
+                results = json.load(inFile)
+        except (OSError, ValueError):
+            continue
+        if (results.get('version') == RESULTS_VERSION
+                and results.get('parameters') == parameters):
+            return results
+    return None
+
+
+def _formatChange(seconds, previousSeconds):
+    if previousSeconds is None:
+        return '%10s %8s' % ('', '')
+    if not previousSeconds:
+        return '%10.3f %8s' % (previousSeconds, '')
+    return '%10.3f %+7.1f%%' % (previousSeconds,
+                                (seconds / previousSeconds - 1) * 100,
+                                )
+
+
+def printResults(results, previous=None):
+    """Print results, with the change since previous results if provided"""
+    if previous is not None:
+        print('Compared with %s (revision %s)'
+              % (previous['date'],
+                 previous['revision'],
+                 ),
+              )
+        previousScenarios = previous['scenarios']
+    else:
+        previousScenarios = {}
+    print('%-16s %-22s %10s %10s %8s'
+          % ('scenario', 'task', 'seconds', 'previous', 'change'))
+    for scenario, measure in results['scenarios'].items():
+        previousMeasure = previousScenarios.get(scenario, {})
+        print('%-16s %-22s %10.3f %s'
+              % (scenario,
+                 '(total)',
+                 measure['seconds'],
+                 _formatChange(measure['seconds'],
+                               previousMeasure.get('seconds'),
+                               ),
+                 ),
+              )
+        for description, seconds in measure['tasks'].items():
+            print('%-16s %-22s %10.3f %s'
+                  % ('',
+                     description,
+                     seconds,
+                     _formatChange(seconds,
+                                   previousMeasure.get('tasks',
+                                                       {},
+                                                       ).get(description),
+                                   ),
+                     ),
+                  )
+
+
+def main():
+    parser = ArgumentParser(prog='python -m benchmarks.deploy',
+                            description='Time deployments of a generated '
+                                        'project.',
+                            )
+    parser.add_argument('--static', type=int,
+                        default=DEFAULT_SIZES['staticFiles'],
+                        help='number of static files')
+    parser.add_argument('--less', type=int,
+                        default=DEFAULT_SIZES['lessFiles'],
+                        help='number of LESS files')
+    parser.add_argument('--partials', type=int,
+                        default=DEFAULT_SIZES['lessPartials'],
+                        help='number of LESS partials')
+    parser.add_argument('--fanout', type=int,
+                        default=DEFAULT_SIZES['lessFanout'],
+                        help='number of partials imported by each LESS file')
+    parser.add_argument('--js', type=int,
+                        default=DEFAULT_SIZES['jsFiles'],
+                        help='number of Javascript files')
+    parser.add_argument('--images', type=int,
+                        default=DEFAULT_SIZES['images'],
+                        help='number of images')
+    parser.add_argument('--third', type=int,
+                        default=DEFAULT_SIZES['thirdPackages'],
+                        help='number of third-party packages')
+    parser.add_argument('--pages', type=int,
+                        default=DEFAULT_SIZES['pages'],
+                        help='number of static pages')
+    parser.add_argument('--python-packages', type=int,
+                        default=DEFAULT_SIZES['pythonPackages'],
+                        help='number of packages of the Python environment')
+    parser.add_argument('--migrations', type=int,
+                        default=DEFAULT_SIZES['migrations'],
+                        help='number of migration files')
+    parser.add_argument('--task-jobs', type=int, default=1,
+                        help='TASK_JOBS setting of the project')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='time taken by stub programs, in seconds')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs of each scenario; the fastest is kept')
+    parser.add_argument('--results', default=DEFAULT_RESULTS_DIR,
+                        help='directory of stored results')
+    parser.add_argument('--dir',
+                        help='directory of the generated project (default '
+                             'to a temporary directory, removed afterward)')
+    args = parser.parse_args()
+    parameters = {'staticFiles': args.static,
+                  'lessFiles': args.less,
+                  'lessPartials': args.partials,
+                  'lessFanout': args.fanout,
+                  'jsFiles': args.js,
+                  'images': args.images,
+                  'thirdPackages': args.third,
+                  'pages': args.pages,
+                  'pythonPackages': args.python_packages,
+                  'migrations': args.migrations,
+                  'taskJobs': args.task_jobs,
+                  'latency': args.latency,
+                  }
+    projectDir = abspath(args.dir or mkdtemp(prefix='wdeploy-benchmark-'))
+    try:
+        if isdir(projectDir) and listdir(projectDir):
+            raise RuntimeError('Project directory %s is not empty'
+                               % projectDir)
+        kinds = generateProject(projectDir,
+                                **{name: value
+                                   for name, value in parameters.items()
+                                   if name != 'latency'
+                                   })
+        scenarios = runSuite(projectDir,
+                             kinds,
+                             args.repeat,
+                             args.latency,
+                             )
+    finally:
+        if not args.dir:
+            rmtree(projectDir)
+    previous = previousResults(args.results, parameters)
+    printResults(saveResults(args.results, parameters, scenarios),
+                 previous,
+                 )
+    for kind in TASK_DESCRIPTIONS:
+        if kind not in kinds:
+            print('No %s task measured' % TASK_DESCRIPTIONS[kind])
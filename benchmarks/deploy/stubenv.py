@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# encoding=utf-8
+"""Stand-in for virtualenv and pip.
+
+Environments created by the virtualenv stub contain:
+- bin/pip: a link to this program
+- bin/python: a link to the Python interpreter running this program
+- lib/python3/site-packages/: one file per installed package
+- installed.txt: the list of installed packages, as output by "pip freeze"
+
+The pip stub supports "pip freeze" and "pip install -U -r <file>". The tool it
+stands for is taken from the name it is called with (a symlink to this file).
+
+Latency is read from BENCHMARK_<TOOL>_LATENCY, then BENCHMARK_TOOL_LATENCY,
+in seconds.
+"""
+from os import (environ,
+                makedirs,
+                symlink,
+                )
+from os.path import (abspath,
+                     basename,
+                     dirname,
+                     join,
+                     realpath,
+                     )
+import sys
+from time import sleep
+
+DEFAULT_LATENCY = 0.02
+
+INSTALLED_NAME = 'installed.txt'
+
+SITE_PACKAGES = join('lib', 'python3', 'site-packages')
+
+
+def installPackages(envDir, requirements):
+    """Record packages as installed in an environment.
+
+    Parameters
+    ----------
+    envDir : string
+        The environment directory
+    requirements : string
+        The packages, one "name==version" per line
+    """
+    sitePackages = join(envDir, SITE_PACKAGES)
+    makedirs(sitePackages, exist_ok=True)
+    for line in requirements.splitlines():
+        if line.strip():
+            with open(join(sitePackages,
+                           '%s.py' % line.split('==')[0],
+                           ),
+                      'w') as outFile:
+                outFile.write('__version__ = %r\n' % line.split('==')[-1])
+    with open(join(envDir, INSTALLED_NAME), 'w') as outFile:
+        outFile.write(requirements)
+
+
+def createEnvironment(envDir):
+    """Create an empty environment"""
+    makedirs(join(envDir, 'bin'))
+    symlink(realpath(__file__), join(envDir, 'bin', 'pip'))
+    symlink(sys.executable, join(envDir, 'bin', 'python'))
+    installPackages(envDir, '')
+
+
+def _pip(envDir, args):
+    if args == ['freeze']:
+        with open(join(envDir, INSTALLED_NAME), 'r') as inFile:
+            sys.stdout.write(inFile.read())
+    elif args[:3] == ['install', '-U', '-r']:
+        with open(args[3], 'r') as inFile:
+            installPackages(envDir, inFile.read())
+    else:
+        sys.exit('Unsupported pip arguments: %s' % ' '.join(args))
+
+
+def main():
+    toolName = basename(sys.argv[0])
+    latency = environ.get('BENCHMARK_%s_LATENCY' % toolName.upper(),
+                          environ.get('BENCHMARK_TOOL_LATENCY',
+                                      DEFAULT_LATENCY,
+                                      ),
+                          )
+    sleep(float(latency))
+    if toolName == 'virtualenv':
+        # Ignore "-p <python>"
+        createEnvironment(sys.argv[-1])
+    elif toolName == 'pip':
+        _pip(dirname(dirname(abspath(sys.argv[0]))), sys.argv[1:])
+    else:
+        sys.exit('Unknown tool: %s' % toolName)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# encoding=utf-8
+"""Stand-in for lessc, uglifyjs, jpegtran, svgo and cssmin.
+
+The program waits for a configurable time, then copies its standard input to
+its standard output. The tool it stands for is taken from the name it is
+called with (a symlink to this file).
+
+Latency is read from BENCHMARK_<TOOL>_LATENCY, then BENCHMARK_TOOL_LATENCY,
+in seconds.
+"""
+from os import environ
+from os.path import basename
+import sys
+from time import sleep
+
+DEFAULT_LATENCY = 0.02
+
+
+def main():
+    toolName = basename(sys.argv[0]).upper()
+    latency = environ.get('BENCHMARK_%s_LATENCY' % toolName,
+                          environ.get('BENCHMARK_TOOL_LATENCY',
+                                      DEFAULT_LATENCY,
+                                      ),
+                          )
+    sleep(float(latency))
+    sys.stdout.buffer.write(sys.stdin.buffer.read())
+
+
+if __name__ == '__main__':
+    main()
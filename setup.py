@@ -29,6 +29,8 @@ setup(name="web_deploy",
       packages=['wdeploy',
                 'wdeploy.tasks',
                 ],
+      package_data={'wdeploy': ['drivers/*.js'],
+                    },
       entry_points={
           'console_scripts': ['webdeploy=webdeploy:main'],
       },
@@ -3,9 +3,7 @@ from .configloader import config
 from .task import (runTask,
                    task,
                    )
-from wdeploy import (tasks,
-                     utils,
-                     )
+from wdeploy import utils
 
 if __name__ == '__main__':
     raise Exception('This program cannot be run in DOS mode.')
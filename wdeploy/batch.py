@@ -0,0 +1,223 @@
+# encoding=utf-8
+"""Process multiple files with a single minifier invocation.
+
+Starting a minifier running on node takes longer than minifying most files.
+The minifiers supporting it are run by a driver script (see wdeploy.driver)
+receiving a whole chunk of files per request, and the results are split back
+into separate outputs.
+
+Use batchProcess() as the batchCB argument of utils.checkDependencies().
+
+The minify server uses the library API of the minifiers, with options matching
+their command line arguments. Its results are kept in the compile cache under
+their own keys (see cacheTool()), so that they are never mixed with results of
+the command line.
+"""
+from os.path import realpath
+from wdeploy import (compilecache,
+                     utils,
+                     )
+from wdeploy.driver import (driverScript,
+                            getDriver,
+                            )
+from wdeploy.user import (as_user,
+                          original_user,
+                          original_group,
+                          writeDestinationFile,
+                          )
+from logging import getLogger
+
+if __name__ == '__main__':
+    raise Exception('This program cannot be run in DOS mode.')
+logg = getLogger(__name__)
+
+
+# Minifiers that can process multiple files in a single invocation
+BATCH_TOOLS = ('uglifyjs',
+               'cleancss',
+               )
+
+
+# Argument added to batched tools in compile cache keys (see cacheTool())
+BATCH_KEY_MARKER = 'batch'
+
+
+def cacheTool(tool):
+    """Return a batched tool as used in compile cache keys.
+
+    Parameters
+    ----------
+    tool : tuple(string, list)
+        The name and arguments of the minifier
+
+
+    Returns
+    -------
+    tuple(string, list)
+        The tool, with BATCH_KEY_MARKER added to its arguments
+    """
+    toolName, args = tool
+    return toolName, list(args) + [BATCH_KEY_MARKER]
+
+
+def batchTool(toolCB):
+    """Return the tool to use if it can be batched.
+
+    Parameters
+    ----------
+    toolCB : runnable
+        Called without argument, returns the name and arguments of the tool
+
+
+    Returns
+    -------
+    tuple(string, list)
+        The tool returned by toolCB, or None if it is not in BATCH_TOOLS or if
+        no tool is available. In the latter case the error is reported when
+        processing files one by one.
+    """
+    try:
+        tool = toolCB()
+    except RuntimeError:
+        return None
+    if tool[0] not in BATCH_TOOLS:
+        return None
+    return tool
+
+
+def _minifyServerArgs(toolName):
+    """Return the command line of the minify server for a tool"""
+    return [utils.which('node'),
+            driverScript('minify_server.js'),
+            toolName,
+            realpath(utils.which(toolName)),
+            ]
+
+
+def _minifyContents(toolName, sources):
+    """Minify multiple sources in one request to the minify server.
+
+    Returns
+    -------
+    list(dict)
+        For each source, either {"output": content} or
+        {"error": {"message", "line", "column"}}. None if the minify server is
+        not available.
+    """
+    server = getDriver('minify:%s' % toolName,
+                       lambda: _minifyServerArgs(toolName),
+                       )
+    if server is None:
+        return None
+    response = server.request(sources=sources)
+    if response is None:
+        return None
+    return response['results']
+
+
+@as_user(original_user, original_group)
+def _minifySources(toolName, sourcePaths):
+    """Read and minify multiple source files in one request.
+
+    Returns
+    -------
+    list(dict)
+        See _minifyContents()
+    """
+    sources = []
+    for sourcePath in sourcePaths:
+        with utils.open_utf8(sourcePath, 'r') as inFile:
+            sources.append(inFile.read())
+    return _minifyContents(toolName, sources)
+
+
+def minifyContent(tool, content):
+    """Minify some content with the minify server.
+
+    Parameters
+    ----------
+    tool : tuple(string, list)
+        The name and arguments of the minifier, as returned by batchTool()
+    content : bytes
+        The content to minify
+
+
+    Returns
+    -------
+    bytes
+        The minified content, or None if the minify server is not available or
+        failed. The content should then be minified by the command line tool,
+        to report errors.
+
+
+    Notes
+    -----
+    The minify server is started by the calling process; call it from the
+    account reading sources.
+    """
+    results = _minifyContents(tool[0], [content.decode('utf-8')])
+    if results is None or 'error' in results[0]:
+        return None
+    return results[0]['output'].encode('utf-8')
+
+
+def batchProcess(tool, toUpdate):
+    """Minify a chunk of files with a single tool invocation.
+
+    Parameters
+    ----------
+    tool : tuple(string, list)
+        The name and arguments of the minifier, as returned by batchTool().
+        Results are cached with cacheTool(tool).
+    toUpdate : list(tuple)
+        The source and destination path of all files to process. Extra items
+        in each tuple are ignored.
+
+
+    Returns
+    -------
+    list(tuple)
+        The items of toUpdate that were not processed, because they failed or
+        because the minify server is not available. They should be processed
+        one by one, to report errors against the right file.
+    """
+    toolName, _ = tool
+    pending = []
+    for updateArgs in toUpdate:
+        key, content = compilecache.lookup([cacheTool(tool)],
+                                           [updateArgs[0]],
+                                           )
+        if content is None:
+            pending.append((updateArgs, key))
+        else:
+            writeDestinationFile(updateArgs[1], content)
+    if not pending:
+        return []
+    results = _minifySources(toolName,
+                             [updateArgs[0]
+                              for updateArgs, _ in pending
+                              ],
+                             )
+    if results is None:
+        return [updateArgs
+                for updateArgs, _ in pending
+                ]
+    logg.debug('Minified %s files with one %s invocation'
+               % (len(pending),
+                  toolName,
+                  ),
+               )
+    notProcessed = []
+    for (updateArgs, key), result in zip(pending, results):
+        if 'error' in result:
+            logg.debug('Error in batch for %s: %s'
+                       % (updateArgs[0],
+                          result['error'].get('message'),
+                          ),
+                       )
+            notProcessed.append(updateArgs)
+            continue
+        content = result['output'].encode('utf-8')
+        compilecache.store(key, content)
+        writeDestinationFile(updateArgs[1], content)
+    return notProcessed
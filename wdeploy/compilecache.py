@@ -0,0 +1,431 @@
+# encoding=utf-8
+"""Content-addressed cache of processed files.
+
+The output of a minifier or compiler only depends on the content of its input
+files, the program used and its arguments. Results are stored under a key
+computed from these, so they can be reused whenever the same input is
+processed again, even if the source files modification time changed.
+
+Results are stored in the project data directory. The size of the cache is
+bounded; the least recently used results are removed first.
+A shared directory can also be configured, allowing multiple checkouts of a
+project (or multiple build machines) to reuse each other results.
+"""
+from hashlib import blake2b
+from os import (getpid,
+                makedirs,
+                register_at_fork,
+                replace,
+                scandir,
+                stat,
+                unlink,
+                utime,
+                )
+from os.path import join
+from threading import (Lock,
+                       get_ident,
+                       )
+from wdeploy import (config,
+                     digest,
+                     utils,
+                     )
+from wdeploy.user import getSourceStats
+from logging import getLogger
+
+if __name__ == '__main__':
+    raise Exception('This program cannot be run in DOS mode.')
+logg = getLogger(__name__)
+
+
+COMPILE_CACHE_NAME = 'compile'
+
+# Default maximum size of a cache directory, in bytes
+DEFAULT_COMPILE_CACHE_SIZE = 256 * 1024 * 1024
+
+# Bump this to invalidate all cached results
+COMPILE_CACHE_VERSION = 3
+
+_SETUP_LOCK = Lock()
+
+
+class CacheDirectory(object):
+    """A directory containing cached results, with a bounded size.
+
+    Parameters
+    ----------
+    path : string
+        The cache directory. Created if needed.
+    maxSize : int
+        The maximum total size of cached results, in bytes.
+
+
+    Notes
+    -----
+    Each result is stored in a file named after its key. Reading a result
+    updates its modification time, which is used to remove the least recently
+    used results when the directory grows too large.
+    The directory can be used by multiple processes at the same time; results
+    are written atomically, and removed results are simply computed again.
+    """
+
+    def __init__(self, path, maxSize):
+        self.path = path
+        self.maxSize = maxSize
+        self.size = None
+        self._lock = Lock()
+
+    def _entryPath(self, key):
+        return join(self.path, key[:2], key)
+
+    def read(self, key):
+        """Return the cached result for key, or None if not present"""
+        entryPath = self._entryPath(key)
+        try:
+            with open(entryPath, 'rb') as inFile:
+                result = inFile.read()
+        except FileNotFoundError:
+            return None
+        try:
+            utime(entryPath)
+        except OSError:
+            pass
+        return result
+
+    def write(self, key, content):
+        """Store a result, evicting old results if needed"""
+        entryPath = self._entryPath(key)
+        temporaryPath = '%s.%s.%s.tmp' % (entryPath,
+                                          getpid(),
+                                          get_ident(),
+                                          )
+        try:
+            makedirs(join(self.path, key[:2]), exist_ok=True)
+            with open(temporaryPath, 'wb') as outFile:
+                outFile.write(content)
+            with self._lock:
+                try:
+                    previousSize = stat(entryPath).st_size
+                except FileNotFoundError:
+                    previousSize = 0
+                replace(temporaryPath, entryPath)
+        except OSError as e:
+            logg.warning('Can\'t write in compile cache %s: %s'
+                         % (self.path,
+                            e,
+                            ),
+                         )
+            try:
+                unlink(temporaryPath)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            if self.size is None:
+                self.size = sum(entry[0] for entry in self._entries())
+            else:
+                self.size += len(content) - previousSize
+            if self.size > self.maxSize:
+                self._evict()
+
+    def _entries(self):
+        """Return the size, last use time and path of all cached results"""
+        result = []
+        try:
+            subDirs = [entry.path
+                       for entry in scandir(self.path)
+                       if entry.is_dir(follow_symlinks=False)
+                       ]
+        except FileNotFoundError:
+            return result
+        for subDir in subDirs:
+            try:
+                entries = list(scandir(subDir))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    entryStat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                result.append((entryStat.st_size,
+                               entryStat.st_mtime_ns,
+                               entry.path,
+                               ),
+                              )
+        return result
+
+    def _evict(self):
+        """Remove least recently used results until the size is acceptable"""
+        entries = sorted(self._entries(),
+                         key=lambda entry: entry[1],
+                         )
+        self.size = sum(entry[0] for entry in entries)
+        removed = 0
+        for entrySize, _, entryPath in entries:
+            if self.size <= self.maxSize:
+                break
+            try:
+                unlink(entryPath)
+            except FileNotFoundError:
+                pass
+            self.size -= entrySize
+            removed += 1
+        logg.debug('Removed %s results from compile cache %s'
+                   % (removed,
+                      self.path,
+                      ),
+                   )
+
+
+class CompileCache(object):
+    """Cache for processed files, with an optional shared directory.
+
+    Parameters
+    ----------
+    local : CacheDirectory
+        The cache directory of the project
+    shared : CacheDirectory
+        (optional) A directory shared with other projects or machines. It is
+        used when a result is not in the local cache, and receives all new
+        results.
+    """
+
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+        self.hits = 0
+        self.sharedHits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    def get(self, key):
+        """Return the cached result for key, or None if not present"""
+        result = self.local.read(key)
+        if result is not None:
+            with self._lock:
+                self.hits += 1
+            return result
+        if self.shared is not None:
+            result = self.shared.read(key)
+            if result is not None:
+                self.local.write(key, result)
+                with self._lock:
+                    self.hits += 1
+                    self.sharedHits += 1
+                return result
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, content):
+        """Store a result in the cache"""
+        self.local.write(key, content)
+        if self.shared is not None:
+            self.shared.write(key, content)
+
+
+def compileCache():
+    """Return the compile cache of the project, or None if disabled.
+
+    Notes
+    -----
+    The cache can be configured with the following optional variables in the
+    config.py file:
+    - COMPILE_CACHE_SIZE: the maximum size of the cache, in bytes. Set to 0 to
+      disable the cache.
+    - COMPILE_CACHE_SHARED_DIR: a directory used as a shared cache
+    - COMPILE_CACHE_SHARED_SIZE: the maximum size of the shared cache.
+      Default to COMPILE_CACHE_SIZE.
+    """
+    myself = compileCache
+    try:
+        return myself.cache
+    except AttributeError:
+        pass
+    with _SETUP_LOCK:
+        if not hasattr(myself, 'cache'):
+            myself.cache = _createCompileCache()
+    return myself.cache
+
+
+def _createCompileCache():
+    """Create the compile cache from the project configuration"""
+    projectConfig = config()
+    maxSize = getattr(projectConfig,
+                      'COMPILE_CACHE_SIZE',
+                      DEFAULT_COMPILE_CACHE_SIZE,
+                      )
+    if not maxSize:
+        logg.debug('Compile cache disabled')
+        return None
+    local = CacheDirectory(join(utils.dataPath(),
+                                COMPILE_CACHE_NAME,
+                                ),
+                           maxSize,
+                           )
+    sharedDir = getattr(projectConfig,
+                        'COMPILE_CACHE_SHARED_DIR',
+                        None,
+                        )
+    if sharedDir:
+        shared = CacheDirectory(sharedDir,
+                                getattr(projectConfig,
+                                        'COMPILE_CACHE_SHARED_SIZE',
+                                        maxSize,
+                                        ),
+                                )
+    else:
+        shared = None
+    return CompileCache(local, shared)
+
+
+def _keyArgument(argument):
+    """Return a program argument as used in cache keys.
+
+    Notes
+    -----
+    The project root is replaced by a placeholder, so that arguments
+    containing paths in the project give the same key in all checkouts.
+    """
+    return str(argument).replace(config().ROOT, '<ROOT>')
+
+
+def cacheKey(tools, inputDigests):
+    """Compute the key of a processed file in the cache.
+
+    Parameters
+    ----------
+    tools : list(tuple(string, list))
+        The name and arguments of all programs used to process the file
+    inputDigests : list(tuple(string, string))
+        The full path and digest of the source file and all its dependencies.
+        The first one must be the source file.
+
+
+    Returns
+    -------
+    string
+        The key, as an hexadecimal string
+    """
+    key = blake2b(digest_size=digest.DIGEST_SIZE)
+    key.update(b'%d\n' % COMPILE_CACHE_VERSION)
+    for toolName, args in tools:
+        key.update(utils.toolIdentity(toolName).encode())
+        key.update(b'\n')
+        for argument in args:
+            key.update(_keyArgument(argument).encode())
+            key.update(b'\0')
+        key.update(b'\n')
+    key.update(inputDigests[0][1].encode())
+    for path, inputDigest in sorted((_keyArgument(path), inputDigest)
+                                    for path, inputDigest in inputDigests[1:]
+                                    ):
+        key.update(b',')
+        key.update(path.encode())
+        key.update(b'\0')
+        key.update(inputDigest.encode())
+    return key.hexdigest()
+
+
+def lookup(tools, inputPaths):
+    """Look for the processed content of a file in the cache.
+
+    Parameters
+    ----------
+    tools : list(tuple(string, list))
+        The name and arguments of all programs used to process the file
+    inputPaths : list(string)
+        The full path of the source file followed by all its dependencies
+
+
+    Returns
+    -------
+    tuple(string, bytes)
+        The cache key of the file, to be used with store(), and the processed
+        content if it was cached (None otherwise). The key is None if the cache
+        is disabled.
+    """
+    cache = compileCache()
+    if cache is None:
+        return None, None
+    stamps = dict(zip(inputPaths,
+                      getSourceStats(inputPaths),
+                      ),
+                  )
+    digests = digest.sourceDigests(stamps)
+    key = cacheKey(tools,
+                   [(path, digests[path])
+                    for path in inputPaths
+                    ],
+                   )
+    result = cache.get(key)
+    if result is not None:
+        logg.debug('Using cached result for %s' % inputPaths[0])
+    return key, result
+
+
+def store(key, content):
+    """Store the processed content of a file, with the key from lookup()"""
+    if key is not None:
+        compileCache().put(key, content)
+
+
+def cachedResult(tools, inputPaths, processCB):
+    """Return the processed content of a file, using the cache if possible.
+
+    Parameters
+    ----------
+    tools : list(tuple(string, list))
+        The name and arguments of all programs used to process the file
+    inputPaths : list(string)
+        The full path of the source file followed by all its dependencies
+    processCB : runnable
+        Called without argument to process the file when the result is not
+        cached. Must return the processed content as bytes.
+
+
+    Returns
+    -------
+    bytes
+        The processed content
+    """
+    key, result = lookup(tools, inputPaths)
+    if result is None:
+        result = processCB()
+        store(key, result)
+    return result
+
+
+def logStatistics():
+    """Log the compile cache statistics for this run"""
+    cache = getattr(compileCache, 'cache', None)
+    if cache is None or not (cache.hits or cache.misses):
+        return
+    if cache.shared is not None:
+        sharedStats = ' (%s from shared cache)' % cache.sharedHits
+    else:
+        sharedStats = ''
+    logg.info('Compile cache: %s hits%s, %s misses'
+              % (cache.hits,
+                 sharedStats,
+                 cache.misses,
+                 ),
+              )
+
+
+def _resetLocks():
+    """Make sure a forked process doesn't inherit a held lock"""
+    global _SETUP_LOCK
+    _SETUP_LOCK = Lock()
+    cache = getattr(compileCache, 'cache', None)
+    if cache is None:
+        return
+    cache._lock = Lock()
+    for directory in (cache.local, cache.shared):
+        if directory is not None:
+            directory._lock = Lock()
+
+
+register_at_fork(after_in_child=_resetLocks)
@@ -0,0 +1,269 @@
+# encoding=utf-8
+"""Cache the dependencies found in source files between runs.
+
+Finding the dependencies of a file requires reading and parsing it, and
+finding where each dependency is located requires looking for it in all
+include directories. Both results are kept in the project data directory:
+- the dependencies of a file are reused as long as its size, modification
+  time and inode are unchanged
+- the location of a dependency is reused as long as the directories where it
+  was looked for are unchanged; adding or removing a file in a directory
+  changes its modification time
+
+The source files of a task (roots) are also recorded with their output and
+all the files they depend on, along with the reverse index from each
+dependency to the roots depending on it. When a few files change, the outputs
+to rebuild are found from this index without looking at the whole tree.
+"""
+from hashlib import sha1
+import json
+from os import (remove,
+                replace,
+                stat,
+                )
+from os.path import (dirname,
+                     isfile,
+                     join,
+                     normpath,
+                     )
+from threading import Lock
+from wdeploy import utils
+from wdeploy.dependencies import resolveInclude
+from logging import getLogger
+
+if __name__ == '__main__':
+    raise Exception('This program cannot be run in DOS mode.')
+logg = getLogger(__name__)
+
+
+DEPENDENCY_CACHE_VERSION = 2
+
+
+def _stamp(path):
+    """Return the size, modification time (in ns) and inode of a file"""
+    try:
+        pathStat = stat(path)
+    except OSError:
+        return [0, 0, 0]
+    return [pathStat.st_size,
+            pathStat.st_mtime_ns,
+            pathStat.st_ino,
+            ]
+
+
+class DependencyCache(object):
+    """The dependencies found in a set of source files.
+
+    Parameters
+    ----------
+    name : string
+        Unique name of the cache. It should identify the task and its output
+        (for example "css:/path/to/destination").
+
+
+    Notes
+    -----
+    Entries not used during a run are removed when the cache is saved.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.path = join(utils.dataPath(),
+                         '%s.depcache' % sha1(name.encode()).hexdigest(),
+                         )
+        self.files = {}
+        self.includes = {}
+        self.roots = {}
+        self.dependents = {}
+        self._usedFiles = {}
+        self._usedIncludes = {}
+        self._usedRoots = {}
+        self._usedDependents = {}
+        self._directoryMTimes = {}
+        self._lock = Lock()
+        self.parsed = 0
+        self.cached = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as inFile:
+                content = json.load(inFile)
+        except (OSError, ValueError):
+            logg.debug('No usable dependency cache for %s' % self.name)
+            return
+        if (content.get('version') != DEPENDENCY_CACHE_VERSION
+                or content.get('name') != self.name):
+            logg.debug('Ignoring outdated dependency cache for %s'
+                       % self.name)
+            return
+        self.files = content['files']
+        self.includes = content['includes']
+        self.roots = content['roots']
+        self.dependents = content['dependents']
+
+    def wrap(self, dependencyCheck):
+        """Return a dependencyCheck runnable using the cache.
+
+        Parameters
+        ----------
+        dependencyCheck : runnable
+            See utils.checkDependencies(). Only called for files that are not
+            in the cache or that changed.
+        """
+        def cachedDependencyCheck(absolutePath):
+            stamp = _stamp(absolutePath)
+            cached = self.files.get(absolutePath)
+            if cached and cached[0] == stamp:
+                result = cached[1]
+                self.cached += 1
+            else:
+                result = dependencyCheck(absolutePath)
+                if result is not None:
+                    result = list(result)
+                self.parsed += 1
+            self._usedFiles[absolutePath] = [stamp, result]
+            return result
+        return cachedDependencyCheck
+
+    def _directoryMTime(self, directory):
+        """Return the modification time of a directory, once per run"""
+        with self._lock:
+            try:
+                return self._directoryMTimes[directory]
+            except KeyError:
+                pass
+        try:
+            result = stat(directory).st_mtime_ns
+        except OSError:
+            result = 0
+        with self._lock:
+            self._directoryMTimes[directory] = result
+        return result
+
+    def resolve(self, relativePath, includeDirs):
+        """Return the first include directory containing a file, or None.
+
+        Notes
+        -----
+        Suitable as the resolveCB argument of DependencyGraph.
+        """
+        key = '\0'.join([relativePath] + list(includeDirs))
+        cached = self.includes.get(key)
+        if cached and all(self._directoryMTime(directory) == mtime
+                          for directory, mtime in cached[1]
+                          ):
+            self._usedIncludes[key] = cached
+            return cached[0]
+        result = resolveInclude(relativePath, includeDirs)
+        if result is None:
+            return None
+        probedDirectories = []
+        for includeDir in includeDirs:
+            directory = dirname(join(includeDir, relativePath))
+            probedDirectories.append([directory,
+                                      self._directoryMTime(directory),
+                                      ],
+                                     )
+            if includeDir == result:
+                break
+        self._usedIncludes[key] = [result, probedDirectories]
+        return result
+
+    def recordRoot(self, sourcePath, outputPath, dependencies):
+        """Record the output of a source file and the files it depends on"""
+        previous = self._usedRoots.get(sourcePath)
+        if previous:
+            for dependency in previous[1]:
+                dependents = self._usedDependents[dependency]
+                dependents.remove(sourcePath)
+                if not dependents:
+                    del self._usedDependents[dependency]
+        self._usedRoots[sourcePath] = [outputPath, dependencies]
+        for dependency in dependencies:
+            self._usedDependents.setdefault(dependency, []).append(sourcePath)
+
+    def affectedOutputs(self, changedPaths):
+        """Return the outputs to rebuild after some files changed.
+
+        Parameters
+        ----------
+        changedPaths : list(string)
+            Full path of the files that changed since the last run
+
+
+        Returns
+        -------
+        dict
+            The source file of each output to rebuild, by output path. None if
+            the outputs can't be found from the previous run: a changed file
+            is unknown (it may be a new file), or a source file was removed.
+
+
+        Notes
+        -----
+        This only looks at the changed files, the previous run being a
+        complete and successful one.
+        """
+        result = {}
+        for changedPath in changedPaths:
+            changedPath = normpath(changedPath)
+            sourcePaths = list(self.dependents.get(changedPath, ()))
+            if changedPath in self.roots:
+                if not isfile(changedPath):
+                    return None
+                sourcePaths.append(changedPath)
+            elif not sourcePaths:
+                return None
+            for sourcePath in sourcePaths:
+                result[self.roots[sourcePath][0]] = sourcePath
+        return result
+
+    def keep(self):
+        """Keep all the entries of the previous run when saving.
+
+        Notes
+        -----
+        Used when only part of the source files are checked; entries for the
+        others stay valid.
+        """
+        self._usedFiles = dict(self.files)
+        self._usedIncludes = dict(self.includes)
+        self._usedRoots = dict(self.roots)
+        self._usedDependents = {dependency: list(dependents)
+                                for dependency, dependents
+                                in self.dependents.items()
+                                }
+
+    def outputs(self):
+        """Return the outputs of all recorded source files"""
+        return [root[0]
+                for root in self._usedRoots.values()
+                ]
+
+    def save(self):
+        """Write the cache in the project data directory"""
+        logg.debug('Parsed %s files for dependencies (%s cached)'
+                   % (self.parsed,
+                      self.cached,
+                      ),
+                   )
+        temporaryPath = '%s.tmp' % self.path
+        try:
+            with open(temporaryPath, 'w') as outFile:
+                json.dump({'version': DEPENDENCY_CACHE_VERSION,
+                           'name': self.name,
+                           'files': self._usedFiles,
+                           'includes': self._usedIncludes,
+                           'roots': self._usedRoots,
+                           'dependents': self._usedDependents,
+                           },
+                          outFile,
+                          )
+            replace(temporaryPath, self.path)
+        except OSError:
+            logg.warning('Can\'t save dependency cache for %s' % self.name)
+            try:
+                remove(temporaryPath)
+            except OSError:
+                pass
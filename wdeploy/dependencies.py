@@ -1,114 +1,297 @@
 # encoding=utf-8
+from array import array
 from os.path import (join,
                      isfile,
                      dirname,
                      splitext,
                      )
+from sys import intern
 
 
-def _getDependencyFile(dependencyRelPath,
-                       allFiles,
-                       dependencyFiles,
-                       includeDirs,
-                       localInclude,
-                       dependencyCheck,
-                       ):
-    """Update dependencyFiles and return the requested file object"""
-    if dependencyRelPath in dependencyFiles:
-        return dependencyFiles[dependencyRelPath]
-    if includeDirs:
-        for includeDir in includeDirs:
-            candidatePath = join(includeDir, dependencyRelPath)
-            if isfile(join(includeDir, dependencyRelPath)):
-                newFileObject = {'modifiedDate': None,
-                                 'relativePath': dependencyRelPath,
-                                 'fullPath': candidatePath,
-                                 'deps': [],
-                                 }
-                dependencyFiles[dependencyRelPath] = newFileObject
-                _fillDeps(newFileObject,
-                          allFiles,
-                          dependencyFiles,
-                          includeDirs,
-                          localInclude,
-                          dependencyCheck,
-                          )
-                return newFileObject
-    raise RuntimeError('Missing dependency: %s' % dependencyRelPath)
-
-
-def _fillDeps(fileObject,
-              allFiles,
-              dependencyFiles,
+def resolveInclude(relativePath, includeDirs):
+    """Return the first include directory containing a file, or None"""
+    for includeDir in includeDirs:
+        if isfile(join(includeDir, relativePath)):
+            return includeDir
+    return None
+
+
+class DependencyGraph(object):
+    """Files and the dependencies between them.
+
+    Parameters
+    ----------
+    resolveCB : runnable
+        (optional) A runnable with the same signature as resolveInclude(),
+        used to find the files depended on.
+
+
+    Notes
+    -----
+    Files are identified by integer ids, in the order they were added. Source
+    files are added first with addSource(), then build() adds their
+    dependencies.
+
+    The graph is kept compact to handle large trees: a file is stored as a
+    base directory id and an interned relative path, its full path is only
+    built on request. The dependencies of all files are stored in a single
+    array; the dependencies of a file are between depStart and depEnd.
+    """
+
+    def __init__(self, resolveCB=None):
+        self.resolveCB = resolveCB or resolveInclude
+        self.bases = []
+        self._baseIds = {}
+        self.nodeBases = array('l')
+        self.relativePaths = []
+        self.depStart = array('l')
+        self.depEnd = array('l')
+        self.edges = array('l')
+        self.order = None
+        self._dependencyIds = {}
+
+    def __len__(self):
+        return len(self.relativePaths)
+
+    def _addNode(self, baseDir, relativePath):
+        baseId = self._baseIds.get(baseDir)
+        if baseId is None:
+            baseId = len(self.bases)
+            self.bases.append(baseDir)
+            self._baseIds[baseDir] = baseId
+        self.nodeBases.append(baseId)
+        self.relativePaths.append(intern(relativePath))
+        self.depStart.append(0)
+        self.depEnd.append(0)
+        return len(self.relativePaths) - 1
+
+    def addSource(self, baseDir, relativePath):
+        """Add a source file to the graph and return its id"""
+        return self._addNode(baseDir, relativePath)
+
+    def fullPath(self, node):
+        """Return the full path of a file"""
+        return join(self.bases[self.nodeBases[node]],
+                    self.relativePaths[node],
+                    )
+
+    def dependencies(self, node):
+        """Return the ids of the files a file directly depends on"""
+        return self.edges[self.depStart[node]:self.depEnd[node]]
+
+    def allDependencies(self, node):
+        """Return the ids of all files a file depends on, directly or not"""
+        result = []
+        seen = {node}
+        pending = [node]
+        edges = self.edges
+        while pending:
+            current = pending.pop()
+            for edge in range(self.depStart[current], self.depEnd[current]):
+                dep = edges[edge]
+                if dep not in seen:
+                    seen.add(dep)
+                    result.append(dep)
+                    pending.append(dep)
+        return result
+
+    def _getDependency(self, dependencyRelPath, includeDirs):
+        """Return the id of a dependency.
+
+        Returns
+        -------
+        tuple(int, bool)
+            The file id, and True if it was not known yet. In that case, its
+            own dependencies must be filled.
+        """
+        node = self._dependencyIds.get(dependencyRelPath)
+        if node is not None:
+            return node, False
+        includeDir = self.resolveCB(dependencyRelPath, includeDirs)
+        if includeDir is None:
+            raise RuntimeError('Missing dependency: %s' % dependencyRelPath)
+        node = self._addNode(includeDir, dependencyRelPath)
+        self._dependencyIds[dependencyRelPath] = node
+        return node, True
+
+    def build(self,
               includeDirs,
               localInclude,
               dependencyCheck,
               ):
-    """Convert a list of string representing the deps to file objects"""
-    if not dependencyCheck:
-        return
-    dependencies = dependencyCheck(fileObject['fullPath'])
-    if not dependencies:
-        return
-    if localInclude:
-        includeDirs = includeDirs + [dirname(fileObject['fullPath'])]
-    for dependency in dependencies:
-        dependencyFile = _getDependencyFile(dependency,
-                                            allFiles,
-                                            dependencyFiles,
-                                            includeDirs,
-                                            localInclude,
-                                            dependencyCheck,
-                                            )
-        if _checkDependencies(fileObject, dependencyFile):
-            raise RuntimeError('Circular dependency: file %s depends '
-                               'on itself through %s' %
-                               (fileObject['relativePath'],
-                                dependencyFile['relativePath']),
+        """Fill the dependencies of all files, and make sure there is no cycle.
+
+        Parameters
+        ----------
+        includeDirs : list(string)
+            Directories where dependencies are looked for
+        localInclude : bool
+            Also look for dependencies in the directory of the file depending
+            on them. Dependencies of dependencies are also looked for in the
+            directories of all the files that led to them.
+        dependencyCheck : runnable
+            See utils.checkDependencies()
+
+
+        Notes
+        -----
+        The graph is built and checked without recursion, so long chains of
+        dependencies are not an issue. If a cycle is found, an exception with
+        the full cycle is raised.
+        """
+        if dependencyCheck:
+            pending = [(node, list(includeDirs or []))
+                       for node in reversed(range(len(self)))
+                       ]
+            while pending:
+                node, fileIncludeDirs = pending.pop()
+                fullPath = self.fullPath(node)
+                dependencies = dependencyCheck(fullPath)
+                if not dependencies:
+                    continue
+                if localInclude:
+                    fileIncludeDirs = fileIncludeDirs + [dirname(fullPath)]
+                nodeDeps = []
+                for dependency in dependencies:
+                    dep, isNew = self._getDependency(dependency,
+                                                     fileIncludeDirs,
+                                                     )
+                    if isNew:
+                        pending.append((dep, fileIncludeDirs))
+                    nodeDeps.append(dep)
+                self.depStart[node] = len(self.edges)
+                self.edges.extend(nodeDeps)
+                self.depEnd[node] = len(self.edges)
+        cycle = self._sortNodes()
+        if cycle:
+            raise RuntimeError('Circular dependency: %s'
+                               % ' -> '.join(self.relativePaths[node]
+                                             for node in cycle
+                                             ),
                                )
-        fileObject['deps'].append(dependencyFile)
 
+    def _sortNodes(self):
+        """Fill self.order with all files, dependencies first.
 
-def _checkDependencies(firstFile, newDependency):
-    """Make sure newDependency doesn't depend on firstFile.
+        Returns
+        -------
+        list(int)
+            The ids of the files forming the first cycle found, starting and
+            ending with the same file, or None if there is no cycle.
 
-    Returns
-    -------
-    bool
-        True if there is a loop, False otherwise
-    """
-    for dependency in newDependency['deps']:
-        if dependency is firstFile:
-            return True
-        else:
-            return _checkDependencies(firstFile, dependency)
-    return False
 
+        Notes
+        -----
+        This is an iterative version of Tarjan's strongly connected
+        components algorithm; it runs in linear time in the size of the graph.
+        Any component with more than one file, or a file depending on itself,
+        is a cycle. Without cycles, the order in which components are found is
+        a topological order of the graph.
+        """
+        nodeCount = len(self)
+        index = array('l', [-1]) * nodeCount
+        lowLink = array('l', [0]) * nodeCount
+        onStack = bytearray(nodeCount)
+        order = array('l')
+        stack = []
+        edges = self.edges
+        depStart = self.depStart
+        depEnd = self.depEnd
+        nextIndex = 0
+        for root in range(nodeCount):
+            if index[root] != -1:
+                continue
+            index[root] = lowLink[root] = nextIndex
+            nextIndex += 1
+            stack.append(root)
+            onStack[root] = 1
+            workNodes = [root]
+            workEdges = [depStart[root]]
+            while workNodes:
+                node = workNodes[-1]
+                edge = workEdges[-1]
+                if edge < depEnd[node]:
+                    workEdges[-1] = edge + 1
+                    dep = edges[edge]
+                    if index[dep] == -1:
+                        index[dep] = lowLink[dep] = nextIndex
+                        nextIndex += 1
+                        stack.append(dep)
+                        onStack[dep] = 1
+                        workNodes.append(dep)
+                        workEdges.append(depStart[dep])
+                    elif onStack[dep] and index[dep] < lowLink[node]:
+                        lowLink[node] = index[dep]
+                    continue
+                workNodes.pop()
+                workEdges.pop()
+                if workNodes and lowLink[node] < lowLink[workNodes[-1]]:
+                    lowLink[workNodes[-1]] = lowLink[node]
+                if lowLink[node] != index[node]:
+                    continue
+                member = stack.pop()
+                onStack[member] = 0
+                if member != node:
+                    component = {member}
+                    while member != node:
+                        member = stack.pop()
+                        onStack[member] = 0
+                        component.add(member)
+                    return self._cyclePath(node, component)
+                if node in self.dependencies(node):
+                    return [node, node]
+                order.append(node)
+        self.order = order
+        return None
 
-def _updateMTime(fileObj, mtimeCB):
-    """Update the modified time of a file object.
+    def _cyclePath(self, start, component):
+        """Return a path from start to itself through files of a component"""
+        previous = {start: None}
+        pending = [start]
+        while pending:
+            nextPending = []
+            for node in pending:
+                for dep in self.dependencies(node):
+                    if dep == start:
+                        result = [start]
+                        while node is not None:
+                            result.append(node)
+                            node = previous[node]
+                        result.reverse()
+                        return result
+                    if dep in component and dep not in previous:
+                        previous[dep] = node
+                        nextPending.append(dep)
+            pending = nextPending
+        return None
 
-    Parameters
-    ----------
-    mtimeCB : runnable
-        A runnable that take a single argument and return the modification time
-        of the file it represents.
+    def newestMTimes(self, mtimes):
+        """Return the newest modification time of files and their dependencies.
 
+        Parameters
+        ----------
+        mtimes : array('q')
+            The modification time of all files, by id
 
-    Notes
-    -----
-    This will use the newest time of both the file itself and all of its
-    dependencies if any.
-    """
-    selfMTime = mtimeCB(fileObj['fullPath'])
-    for dep in fileObj['deps']:
-        if dep['modifiedDate'] is None:
-            _updateMTime(dep,
-                         mtimeCB,
-                         )
-        if dep['modifiedDate'] > selfMTime:
-            selfMTime = dep['modifiedDate']
-    fileObj['modifiedDate'] = selfMTime
+
+        Returns
+        -------
+        array('q')
+            For each file, the newest modification time of the file itself and
+            all of its dependencies.
+        """
+        result = array('q', mtimes)
+        edges = self.edges
+        depStart = self.depStart
+        depEnd = self.depEnd
+        for node in self.order:
+            newest = result[node]
+            for edge in range(depStart[node], depEnd[node]):
+                depMTime = result[edges[edge]]
+                if depMTime > newest:
+                    newest = depMTime
+            result[node] = newest
+        return result
 
 
 def extensionCheck(exts):
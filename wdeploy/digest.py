@@ -0,0 +1,179 @@
+# encoding=utf-8
+"""Content digests of source files, used to detect changes.
+
+Digests are cached in the project data directory, indexed by file path and
+associated with the size, modification time and inode of the file when it was
+hashed. A file is only read again when one of these changes.
+
+The cache is kept in memory during a run, and written once at the end of the
+run by saveDigests(). Only the files used during the run are kept.
+"""
+from hashlib import blake2b
+import json
+from mmap import (mmap,
+                  ACCESS_READ,
+                  )
+from os import (fstat,
+                register_at_fork,
+                replace,
+                )
+from os.path import join
+from threading import Lock
+from wdeploy import utils
+from wdeploy.user import (as_user,
+                          original_user,
+                          original_group,
+                          )
+from logging import getLogger
+
+if __name__ == '__main__':
+    raise Exception('This program cannot be run in DOS mode.')
+logg = getLogger(__name__)
+
+
+DIGEST_SIZE = 20
+DIGEST_CACHE_NAME = 'digests.cache'
+
+# Valid values for the changeDetection argument of tasks
+CHANGE_DETECTION_MODES = ('mtime',
+                          'hash',
+                          )
+
+_CACHE_LOCK = Lock()
+# Paths whose digest was used during this run
+_SEEN = set()
+# Number of digests computed during this run
+_COMPUTED = 0
+
+
+def checkChangeDetection(changeDetection, incremental):
+    """Make sure a change detection mode can be used by a task"""
+    if changeDetection not in CHANGE_DETECTION_MODES:
+        raise RuntimeError('Invalid change detection mode: "%s"'
+                           % changeDetection)
+    if changeDetection == 'hash' and not incremental:
+        raise RuntimeError('Hash change detection requires incremental mode')
+
+
+def fileDigest(path):
+    """Return the digest of a file content, as an hexadecimal string"""
+    digest = blake2b(digest_size=DIGEST_SIZE)
+    with open(path, 'rb') as inFile:
+        if fstat(inFile.fileno()).st_size:
+            with mmap(inFile.fileno(), 0, access=ACCESS_READ) as content:
+                digest.update(content)
+    return digest.hexdigest()
+
+
+def combineDigests(digests):
+    """Return a single digest representing a list of digests"""
+    digest = blake2b(digest_size=DIGEST_SIZE)
+    for part in digests:
+        digest.update(part.encode())
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+@as_user(original_user, original_group)
+def _sourceDigests(sourcePaths):
+    """Return the digests of a list of source files using original user"""
+    return [fileDigest(sourcePath)
+            for sourcePath in sourcePaths
+            ]
+
+
+def _cache():
+    """Return the digest cache, loading it on first call"""
+    myself = _cache
+    try:
+        return myself.cache
+    except AttributeError:
+        pass
+    try:
+        with open(join(utils.dataPath(), DIGEST_CACHE_NAME), 'r') as inFile:
+            myself.cache = json.load(inFile)
+    except (OSError, ValueError):
+        myself.cache = {}
+    return myself.cache
+
+
+def saveDigests():
+    """Write the digest cache in the project data directory.
+
+    Notes
+    -----
+    Entries of files not used during this run are removed. Nothing is written
+    if no digest was computed.
+    """
+    global _COMPUTED
+    with _CACHE_LOCK:
+        if not _COMPUTED:
+            return
+        cache = {path: entry
+                 for path, entry in _cache().items()
+                 if path in _SEEN
+                 }
+        _COMPUTED = 0
+    cachePath = join(utils.dataPath(), DIGEST_CACHE_NAME)
+    temporaryPath = '%s.tmp' % cachePath
+    try:
+        with open(temporaryPath, 'w') as outFile:
+            json.dump(cache, outFile)
+        replace(temporaryPath, cachePath)
+    except OSError:
+        logg.warning('Can\'t save digest cache')
+
+
+def sourceDigests(stamps):
+    """Return the digests of source files.
+
+    Parameters
+    ----------
+    stamps : dict
+        The stamp (size, modification time, inode) of the files, by full path
+
+
+    Returns
+    -------
+    dict
+        The digest of each file, by full path
+
+
+    Notes
+    -----
+    Only files not in the cache, or whose stamp changed, are read. New digests
+    are only written by saveDigests().
+    """
+    global _COMPUTED
+    result = {}
+    missing = []
+    with _CACHE_LOCK:
+        cache = _cache()
+        _SEEN.update(stamps)
+        for path, stamp in stamps.items():
+            cached = cache.get(path)
+            if cached and cached[0] == list(stamp):
+                result[path] = cached[1]
+            else:
+                missing.append(path)
+    if not missing:
+        return result
+    logg.debug('Computing %s digests' % len(missing))
+    digests = _sourceDigests(missing)
+    with _CACHE_LOCK:
+        for path, digest in zip(missing, digests):
+            result[path] = digest
+            cache[path] = [list(stamps[path]),
+                           digest,
+                           ]
+        _COMPUTED += len(missing)
+    return result
+
+
+def _resetLock():
+    """Make sure a forked process doesn't inherit a held lock"""
+    global _CACHE_LOCK
+    _CACHE_LOCK = Lock()
+
+
+register_at_fork(after_in_child=_resetLock)
@@ -0,0 +1,210 @@
+# encoding=utf-8
+"""Long-lived helper processes.
+
+Some programs (less, minifiers running on node...) are expensive to start.
+Instead of running them once per file, a driver script running in a single
+process receives requests on its standard input and writes responses on its
+standard output, one JSON document per line.
+
+Driver scripts are located in the drivers directory of this package.
+"""
+from atexit import register as atexit_register
+import json
+from os import (getpid,
+                register_at_fork,
+                )
+from os.path import (dirname,
+                     join,
+                     )
+import subprocess
+from threading import Lock
+from logging import getLogger
+
+if __name__ == '__main__':
+    raise Exception('This program cannot be run in DOS mode.')
+logg = getLogger(__name__)
+
+
+# Time to wait for a driver to exit after closing its input, in seconds
+DRIVER_STOP_TIMEOUT = 1
+
+_DRIVERS_LOCK = Lock()
+
+
+def driverScript(name):
+    """Return the full path of a driver script"""
+    return join(dirname(__file__),
+                'drivers',
+                name,
+                )
+
+
+class Driver(object):
+    """A process handling requests sent as JSON lines.
+
+    Parameters
+    ----------
+    name : string
+        Name of the driver, used in messages
+    args : list(string)
+        The command line of the process
+
+
+    Notes
+    -----
+    The process must write a first line containing {"ready": true} once it
+    can handle requests. Requests are sent one at a time; the driver can be
+    used from multiple threads.
+    """
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.process = None
+        self.nextId = 0
+        self._lock = Lock()
+
+    def start(self):
+        """Start the process, and wait until it is ready.
+
+        Returns
+        -------
+        dict
+            The first message from the process
+
+
+        Notes
+        -----
+        An exception is raised if the process can't start.
+        """
+        self.process = subprocess.Popen(self.args,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL,
+                                        )
+        ready = self._readMessage()
+        if not ready:
+            self.stop()
+            raise RuntimeError('Driver %s exited without answering'
+                               % self.name)
+        if not ready.get('ready'):
+            self.stop()
+            raise RuntimeError('Driver %s failed to start: %s'
+                               % (self.name,
+                                  ready.get('error'),
+                                  ),
+                               )
+        return ready
+
+    def _readMessage(self):
+        line = self.process.stdout.readline()
+        if not line:
+            return None
+        return json.loads(line.decode('utf-8'))
+
+    def request(self, **request):
+        """Send a request and return the response.
+
+        Returns
+        -------
+        dict
+            The response, or None if the process is not running anymore.
+        """
+        with self._lock:
+            if self.process is None:
+                return None
+            self.nextId += 1
+            request['id'] = self.nextId
+            try:
+                self.process.stdin.write(json.dumps(request).encode('utf-8')
+                                         + b'\n')
+                self.process.stdin.flush()
+                response = self._readMessage()
+            except (OSError, ValueError):
+                response = None
+            if response is None or response.get('id') != request['id']:
+                logg.warning('Driver %s stopped unexpectedly' % self.name)
+                self.stop()
+                return None
+            return response
+
+    def stop(self):
+        """Stop the process"""
+        if self.process is None:
+            return
+        process = self.process
+        self.process = None
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        try:
+            process.wait(DRIVER_STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+
+
+def getDriver(name, argsCB):
+    """Return a running driver, starting it on first call.
+
+    Parameters
+    ----------
+    name : string
+        Name of the driver
+    argsCB : runnable
+        Called without argument to get the command line of the driver. Can
+        raise an exception if the driver can't be used.
+
+
+    Returns
+    -------
+    Driver
+        The driver, or None if it can't be started. In that case, a warning is
+        logged once and None is returned on subsequent calls.
+
+
+    Notes
+    -----
+    Drivers are started once per process: a process forked after a driver was
+    started doesn't share it.
+    """
+    myself = getDriver
+    try:
+        myself.cache
+    except AttributeError:
+        myself.cache = {}
+    with _DRIVERS_LOCK:
+        pid, driver = myself.cache.get(name, (None, None))
+        if pid == getpid():
+            if driver is not None and driver.process is None:
+                return None
+            return driver
+        try:
+            driver = Driver(name, argsCB())
+            driver.start()
+        except Exception as e:
+            logg.warning('Can\'t use driver %s: %s' % (name, e))
+            driver = None
+        myself.cache[name] = (getpid(), driver)
+        return driver
+
+
+def stopDrivers():
+    """Stop all drivers started by this process"""
+    cache = getattr(getDriver, 'cache', {})
+    for pid, driver in list(cache.values()):
+        if pid == getpid() and driver is not None:
+            driver.stop()
+    cache.clear()
+
+
+def _resetLock():
+    """Make sure a forked process doesn't inherit a held lock"""
+    global _DRIVERS_LOCK
+    _DRIVERS_LOCK = Lock()
+
+
+register_at_fork(after_in_child=_resetLock)
+atexit_register(stopDrivers)
@@ -0,0 +1,36 @@
+// encoding=utf-8
+// Compile less sources received on stdin, one JSON request per line.
+//
+// Usage: node less_server.js <path to the less module>
+//
+// The first line written on stdout tells if the server is ready. Each request
+// ({id, source, options}) gets one response line, either {id, css} or
+// {id, error: {message, filename, line, column}}.
+'use strict';
+const readline = require('readline');
+
+function reply(message) {
+  process.stdout.write(JSON.stringify(message) + '\n');
+}
+
+let less;
+try {
+  less = require(process.argv[2]);
+} catch (e) {
+  reply({ready: false, error: {message: String(e.message)}});
+  process.exit(1);
+}
+reply({ready: true,
+       version: less.version ? less.version.join('.') : null});
+
+const input = readline.createInterface({input: process.stdin});
+input.on('line', (line) => {
+  const request = JSON.parse(line);
+  less.render(request.source, request.options).then(
+    (output) => reply({id: request.id, css: output.css}),
+    (error) => reply({id: request.id,
+                      error: {message: String(error.message),
+                              filename: error.filename || null,
+                              line: error.line || null,
+                              column: error.column || null}}));
+});
@@ -0,0 +1,88 @@
+// encoding=utf-8
+// Minify batches of sources received on stdin, one JSON request per line.
+//
+// Usage: node minify_server.js <tool> <path to the tool executable>
+//
+// <tool> is either uglifyjs or cleancss. The module is looked up from the
+// package containing the executable.
+//
+// The first line written on stdout tells if the server is ready. Each request
+// ({id, sources}) gets one response line, {id, results}, with one result per
+// source: either {output} or {error: {message, line, column}}.
+'use strict';
+const path = require('path');
+const readline = require('readline');
+
+function reply(message) {
+  process.stdout.write(JSON.stringify(message) + '\n');
+}
+
+function errorResult(error) {
+  return {error: {message: String(error.message || error),
+                  line: error.line || null,
+                  column: error.col || error.column || null}};
+}
+
+function uglifyjsMinifier(toolDir) {
+  const uglify = require(toolDir);
+  const version = require(path.join(toolDir, 'package.json')).version;
+  if (parseInt(version, 10) >= 3) {
+    // Same as "uglifyjs -c -m"
+    return (source) => {
+      const result = uglify.minify(source, {compress: {}, mangle: true});
+      if (result.error) {
+        return errorResult(result.error);
+      }
+      return {output: result.code};
+    };
+  }
+  return (source) => {
+    try {
+      return {output: uglify.minify(source, {fromString: true}).code};
+    } catch (e) {
+      return errorResult(e);
+    }
+  };
+}
+
+function cleancssMinifier(toolDir) {
+  const CleanCSS = require(require.resolve('clean-css', {paths: [toolDir]}));
+  // Same as "cleancss -e --s1 -s", for both the 3.x and 4.x options
+  const minifier = new CleanCSS({keepSpecialComments: 1,
+                                 processImport: false,
+                                 inline: ['none'],
+                                 level: {1: {specialComments: 1}}});
+  return (source) => {
+    try {
+      const result = minifier.minify(source);
+      if (result.errors && result.errors.length) {
+        return errorResult(result.errors.join(', '));
+      }
+      return {output: result.styles};
+    } catch (e) {
+      return errorResult(e);
+    }
+  };
+}
+
+const minifiers = {uglifyjs: uglifyjsMinifier,
+                   cleancss: cleancssMinifier};
+
+let minify;
+try {
+  const toolDir = path.dirname(path.dirname(process.argv[3]));
+  if (!(process.argv[2] in minifiers)) {
+    throw new Error('Unknown tool ' + process.argv[2]);
+  }
+  minify = minifiers[process.argv[2]](toolDir);
+} catch (e) {
+  reply({ready: false, error: {message: String(e.message)}});
+  process.exit(1);
+}
+reply({ready: true});
+
+const input = readline.createInterface({input: process.stdin});
+input.on('line', (line) => {
+  const request = JSON.parse(line);
+  reply({id: request.id, results: request.sources.map(minify)});
+});
@@ -0,0 +1,374 @@
+# encoding=utf-8
+"""Content-fingerprinted copies of outputs.
+
+A file whose name contains a digest of its content can be cached forever by
+clients: a new content gets a new name. When enabled on a task, a copy of each
+output named after its content (for example app.3f9a1c2b4d5e.css) is written
+next to it. The static manifest of the static root maps each output to its
+copy. It uses the format of Django's ManifestStaticFilesStorage
+(staticfiles.json), so the application can find the URL of the copies.
+
+url() references in CSS files are rewritten in their copy to point to the
+copy of the referenced files. The referenced files must be fingerprinted by a
+task running before. A CSS file referencing a file without a fingerprinted
+copy keeps the plain URL, and is rewritten once the copy exists.
+
+The state of fingerprinted outputs is kept in the project data directory;
+outputs that did not change are not read again.
+
+The previous copy of an updated or removed output is kept until the next run,
+like ManifestStaticFilesStorage does: the running application and cached pages
+still refer to it until the application is restarted.
+"""
+from hashlib import (md5,
+                     sha1,
+                     )
+import json
+import re
+from os import (register_at_fork,
+                remove,
+                replace,
+                sep,
+                unlink,
+                )
+from os.path import (basename,
+                     dirname,
+                     join,
+                     normpath,
+                     relpath,
+                     splitext,
+                     )
+from threading import Lock
+from urllib.parse import (urlsplit,
+                          urlunsplit,
+                          )
+from wdeploy import utils
+from wdeploy.precompress import (PRECOMPRESS_FORMATS,
+                                 compressedPaths,
+                                 precompressMissing,
+                                 writePrecompressed,
+                                 )
+from wdeploy.user import (as_user,
+                          getDestinationStats,
+                          prefix_user,
+                          prefix_group,
+                          writeDestinationFile,
+                          )
+from logging import getLogger
+
+if __name__ == '__main__':
+    raise Exception('This program cannot be run in DOS mode.')
+logg = getLogger(__name__)
+
+
+FINGERPRINT_STATE_VERSION = 3
+
+# Name of the static manifest, in the static root
+STATIC_MANIFEST_NAME = 'staticfiles.json'
+# Version of the ManifestStaticFilesStorage format
+STATIC_MANIFEST_VERSION = '1.0'
+
+# Number of hexadecimal digits of the digest in file names
+FINGERPRINT_LENGTH = 12
+
+CSS_URL_RE = re.compile(r'url\(\s*(?P<quote>[\'"]?)(?P<url>[^\'")]*?)'
+                        r'(?P=quote)\s*\)')
+
+# The static manifest is shared by all tasks using the same static root
+_STATIC_MANIFEST_LOCK = Lock()
+
+
+def fingerprintedName(name, content):
+    """Return the name of the fingerprinted copy of a file.
+
+    Notes
+    -----
+    Names are built like ManifestStaticFilesStorage does: the first digits of
+    the MD5 digest of the content are inserted before the extension.
+    """
+    root, ext = splitext(name)
+    return '%s.%s%s' % (root,
+                        md5(content).hexdigest()[:FINGERPRINT_LENGTH],
+                        ext,
+                        )
+
+
+def _rewriteUrls(content, name, staticPaths):
+    """Make url() references in a CSS file point to fingerprinted copies.
+
+    Parameters
+    ----------
+    content : bytes
+        The CSS file content
+    name : string
+        The path of the CSS file, relative to the static root
+    staticPaths : dict
+        The fingerprinted name of files, by name
+
+
+    Returns
+    -------
+    tuple(bytes, dict)
+        The rewritten content, and the fingerprinted name of all referenced
+        files, by name. Referenced files without a fingerprinted copy are
+        included with None, so that the file is rewritten when they get one.
+    """
+    references = {}
+
+    def replaceUrl(match):
+        url = match.group('url').strip()
+        scheme, netloc, path, query, fragment = urlsplit(url)
+        if scheme or netloc or not path or path.startswith('/'):
+            return match.group(0)
+        target = normpath(join(dirname(name), path))
+        hashedName = staticPaths.get(target)
+        if hashedName is None:
+            logg.debug('No fingerprinted copy of %s, referenced by %s'
+                       % (target,
+                          name,
+                          ),
+                       )
+            references[target] = None
+            return match.group(0)
+        references[target] = hashedName
+        hashedPath = '%s%s' % (path[:len(path) - len(basename(path))],
+                               basename(hashedName),
+                               )
+        return 'url(%s%s%s)' % (match.group('quote'),
+                                urlunsplit(('',
+                                            '',
+                                            hashedPath,
+                                            query,
+                                            fragment,
+                                            ),
+                                           ),
+                                match.group('quote'),
+                                )
+    # Bytes that are not UTF-8 (latin-1 files...) are kept as they are
+    content = CSS_URL_RE.sub(replaceUrl,
+                             content.decode('utf-8', 'surrogateescape'),
+                             )
+    return content.encode('utf-8', 'surrogateescape'), references
+
+
+@as_user(prefix_user, prefix_group)
+def _writeFingerprinted(outputPaths, staticRoot, staticPaths):
+    """Write the fingerprinted copy of outputs.
+
+    Returns
+    -------
+    dict
+        For each output, the name of its copy relative to the static root and
+        the files referenced by its copy (see _rewriteUrls()).
+    """
+    result = {}
+    for outputPath in outputPaths:
+        with open(outputPath, 'rb') as inFile:
+            content = inFile.read()
+        name = relpath(outputPath, staticRoot)
+        if splitext(outputPath)[1].lower() == '.css':
+            content, references = _rewriteUrls(content, name, staticPaths)
+        else:
+            references = {}
+        hashedName = fingerprintedName(name, content)
+        writeDestinationFile(join(staticRoot, hashedName), content)
+        result[outputPath] = [hashedName, references]
+    return result
+
+
+def _statePath(name):
+    return join(utils.dataPath(),
+                '%s.fingerprint' % sha1(name.encode()).hexdigest(),
+                )
+
+
+def _loadState(name):
+    """Return the fingerprinted outputs of the previous run.
+
+    Returns
+    -------
+    tuple(dict, list(string))
+        For each output, its stamp, the name of its copy and the references of
+        its copy; and the name of the previous copies kept by the previous run
+    """
+    try:
+        with open(_statePath(name), 'r') as inFile:
+            content = json.load(inFile)
+    except (OSError, ValueError):
+        return {}, []
+    if (content.get('version') != FINGERPRINT_STATE_VERSION
+            or content.get('name') != name):
+        return {}, []
+    return content['outputs'], content['stale']
+
+
+def _saveState(name, outputs, stale):
+    statePath = _statePath(name)
+    temporaryPath = '%s.tmp' % statePath
+    try:
+        with open(temporaryPath, 'w') as outFile:
+            json.dump({'version': FINGERPRINT_STATE_VERSION,
+                       'name': name,
+                       'outputs': outputs,
+                       'stale': stale,
+                       },
+                      outFile,
+                      )
+        replace(temporaryPath, statePath)
+    except OSError:
+        logg.warning('Can\'t save fingerprints for %s' % name)
+        try:
+            remove(temporaryPath)
+        except OSError:
+            pass
+
+
+def _readStaticManifest(staticManifestPath):
+    """Return the paths of a static manifest, or an empty dict"""
+    try:
+        with open(staticManifestPath, 'r') as inFile:
+            return json.load(inFile).get('paths', {})
+    except (OSError, ValueError):
+        return {}
+
+
+def fingerprintOutputs(name, staticRoot, outputFiles, formats=(),
+                       manifest=None):
+    """Write the fingerprinted copy of outputs, and update the static manifest.
+
+    Parameters
+    ----------
+    name : string
+        Unique name identifying the task and its outputs
+    staticRoot : string
+        The static root, containing all outputs. The static manifest is
+        written there, and names are relative to it.
+    outputFiles : list(string)
+        Full path of all the outputs of the task
+    formats : list(string)
+        (optional) Also write compressed copies of the fingerprinted copies in
+        these formats (see wdeploy.precompress)
+    manifest : Manifest
+        (optional) The manifest of the task, see precompressMissing()
+
+
+    Returns
+    -------
+    list(string)
+        Full path of the fingerprinted copies of all outputs, of the previous
+        copies kept until the next run, and of the static manifest. These files
+        must not be removed as stale files.
+
+
+    Notes
+    -----
+    Copies of outputs that changed since the previous run are written. CSS
+    files are handled after other files, so that they can reference outputs
+    of the same task. The previous copy of updated or removed outputs is kept
+    until the next run, and removed then.
+    """
+    staticRoot = normpath(staticRoot)
+    for outputPath in outputFiles:
+        if not outputPath.startswith(staticRoot + sep):
+            raise RuntimeError('Output %s is not in the static root %s'
+                               % (outputPath,
+                                  staticRoot,
+                                  ),
+                               )
+    staticManifestPath = join(staticRoot, STATIC_MANIFEST_NAME)
+    with _STATIC_MANIFEST_LOCK:
+        previous, previousStale = _loadState(name)
+        staticPaths = _readStaticManifest(staticManifestPath)
+        previousStaticPaths = dict(staticPaths)
+        stamps = dict(zip(outputFiles,
+                          getDestinationStats(outputFiles),
+                          ),
+                      )
+        outputs = {}
+        written = []
+        for cssPhase in (False, True):
+            toWrite = []
+            for outputPath in outputFiles:
+                if (splitext(outputPath)[1].lower() == '.css') != cssPhase:
+                    continue
+                record = previous.get(outputPath)
+                if (record
+                        and tuple(record[0]) == tuple(stamps[outputPath])
+                        and all(staticPaths.get(target) == hashedName
+                                for target, hashedName in record[2].items()
+                                )):
+                    outputs[outputPath] = record
+                else:
+                    toWrite.append(outputPath)
+            if toWrite:
+                results = _writeFingerprinted(toWrite,
+                                              staticRoot,
+                                              staticPaths if cssPhase else {},
+                                              )
+                for outputPath, (hashedName, references) in results.items():
+                    outputs[outputPath] = [list(stamps[outputPath]),
+                                           hashedName,
+                                           references,
+                                           ]
+                    written.append(join(staticRoot, hashedName))
+            for outputPath in outputFiles:
+                if outputPath in outputs:
+                    staticPaths[relpath(outputPath, staticRoot)] = (
+                        outputs[outputPath][1])
+        currentNames = set(record[1] for record in outputs.values())
+        stale = []
+        for outputPath, record in previous.items():
+            current = outputs.get(outputPath)
+            if current is not None and current[1] == record[1]:
+                continue
+            if current is None:
+                staticPaths.pop(relpath(outputPath, staticRoot), None)
+            if record[1] not in currentNames:
+                logg.debug('Keeping previous fingerprinted copy %s until the '
+                           'next run'
+                           % record[1])
+                stale.append(record[1])
+        for hashedName in previousStale:
+            if hashedName in currentNames or hashedName in stale:
+                continue
+            stalePath = join(staticRoot, hashedName)
+            logg.debug('Removing previous fingerprinted copy %s' % stalePath)
+            for path in [stalePath] + compressedPaths(stalePath,
+                                                      PRECOMPRESS_FORMATS,
+                                                      ):
+                try:
+                    unlink(path)
+                except FileNotFoundError:
+                    pass
+        if staticPaths != previousStaticPaths:
+            writeDestinationFile(staticManifestPath,
+                                 json.dumps({'paths': staticPaths,
+                                             'version':
+                                             STATIC_MANIFEST_VERSION,
+                                             },
+                                            sort_keys=True,
+                                            ).encode('utf-8'),
+                                 )
+        _saveState(name, outputs, stale)
+    logg.debug('Fingerprinted %s files (%s unchanged)'
+               % (len(written),
+                  len(outputs) - len(written),
+                  ),
+               )
+    hashedPaths = [join(staticRoot, record[1])
+                   for record in outputs.values()
+                   ]
+    writePrecompressed(written, formats)
+    precompressMissing(hashedPaths, formats, manifest)
+    return hashedPaths + [join(staticRoot, hashedName)
+                          for hashedName in stale
+                          ] + [staticManifestPath]
+
+
+def _resetLock():
+    """Make sure a forked process doesn't inherit a held lock"""
+    global _STATIC_MANIFEST_LOCK
+    _STATIC_MANIFEST_LOCK = Lock()
+
+
+register_at_fork(after_in_child=_resetLock)
@@ -0,0 +1,251 @@
+# encoding=utf-8
+"""Keep track of deployed outputs between runs.
+
+A manifest records, for each output file of a task, the state of the source
+files it was produced from. Outputs whose sources did not change since the
+last run can then be skipped without looking at the destination.
+"""
+from hashlib import sha1
+import json
+from os import (remove,
+                replace,
+                )
+from os.path import (dirname,
+                     join,
+                     )
+from wdeploy import utils
+from wdeploy.user import getDestinationMTimes
+from logging import getLogger
+
+if __name__ == '__main__':
+    raise Exception('This program cannot be run in DOS mode.')
+logg = getLogger(__name__)
+
+
+MANIFEST_VERSION = 2
+
+
+class Manifest(object):
+    """The persistent list of outputs produced by a task.
+
+    Parameters
+    ----------
+    name : string
+        Unique name of the manifest. It should identify both the task and its
+        output (for example "synctree:/path/to/destination").
+    root : string
+        The destination directory containing all outputs.
+    variant : string
+        (optional) How outputs are produced, for tasks with settings changing
+        outputs without changing their sources. A manifest saved with another
+        variant is ignored, and outputs not recorded in the manifest are
+        rebuilt instead of being compared with their sources modification
+        time.
+
+
+    Notes
+    -----
+    Each output is associated with a record containing:
+    - source: the full path of the source file
+    - stamp: the size, modification time (in ns) and inode of the source file
+    - deps: the stamps of all files the source depends on, by full path
+    - output: the stamp of the output file
+    - digest: the digest of the source and its dependencies content, if
+      changes are detected by content
+
+    The modification time of all destination directories is saved with the
+    manifest. Directories whose modification time changed since then had
+    files added or removed by someone else; records for outputs in these
+    directories are not trusted.
+    """
+
+    def __init__(self, name, root, variant=None):
+        self.name = name
+        self.root = root
+        self.variant = variant
+        self.path = join(utils.dataPath(),
+                         '%s.manifest' % sha1(name.encode()).hexdigest(),
+                         )
+        self.records = {}
+        self.directories = {}
+        self.cleanDirectories = set()
+        self.previousOutputs = set()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as inFile:
+                content = json.load(inFile)
+        except (OSError, ValueError):
+            logg.debug('No usable manifest for %s' % self.name)
+            return
+        if (content.get('version') != MANIFEST_VERSION
+                or content.get('name') != self.name
+                or content.get('variant') != self.variant):
+            logg.debug('Ignoring outdated manifest for %s' % self.name)
+            return
+        self.records = content['records']
+        self.directories = content['directories']
+        self.previousOutputs = set(self.records)
+        directories = list(self.directories)
+        self.cleanDirectories = {directory
+                                 for directory, mtime
+                                 in zip(directories,
+                                        getDestinationMTimes(directories),
+                                        )
+                                 if mtime == self.directories[directory]
+                                 }
+
+    def isClean(self):
+        """Indicate if no destination directory was changed since last run.
+
+        Notes
+        -----
+        When True, the outputs recorded in the previous run are the only files
+        in the destination; there is no need to crawl it.
+        """
+        return (bool(self.directories)
+                and len(self.cleanDirectories) == len(self.directories))
+
+    def rebuildUnknown(self, outputPath):
+        """Indicate if an output must be rebuilt because it is not recorded.
+
+        Notes
+        -----
+        This is only the case for manifests with a variant, since an existing
+        output may have been produced with another variant.
+        """
+        return self.variant is not None and outputPath not in self.records
+
+    def isTrusted(self, outputPath):
+        """Indicate if the directory of an output is unchanged since last run"""
+        return dirname(outputPath) in self.cleanDirectories
+
+    def isUpToDate(self, outputPath, sourcePath, stamp, deps):
+        """Check if an output was produced from the given sources.
+
+        Parameters
+        ----------
+        outputPath : string
+            Full path of the output
+        sourcePath : string
+            Full path of the source
+        stamp : tuple(int, int, int)
+            Current size, modification time and inode of the source
+        deps : dict
+            Current stamp of each dependency, by full path
+
+
+        Returns
+        -------
+        bool
+            True if the output is known, its directory unchanged, and all its
+            sources have the same stamp as when it was produced.
+        """
+        try:
+            record = self.records[outputPath]
+        except KeyError:
+            return False
+        return (self.isTrusted(outputPath)
+                and record['source'] == sourcePath
+                and tuple(record['stamp']) == tuple(stamp)
+                and {path: tuple(depStamp)
+                     for path, depStamp in record['deps'].items()
+                     } == {path: tuple(depStamp)
+                           for path, depStamp in deps.items()
+                           })
+
+    def matchesDigest(self, outputPath, sourcePath, digest):
+        """Check if an output was produced from sources with the given digest.
+
+        Returns
+        -------
+        bool
+            True if the output is known, and was produced from the same
+            source with the same content digest. The output directory is not
+            checked; see isTrusted().
+        """
+        try:
+            record = self.records[outputPath]
+        except KeyError:
+            return False
+        return (record['source'] == sourcePath
+                and record.get('digest') == digest)
+
+    def outputStamp(self, outputPath):
+        """Return the recorded stamp of an output, or None if unknown"""
+        try:
+            return tuple(self.records[outputPath]['output'])
+        except KeyError:
+            return None
+
+    def record(self,
+               outputPath,
+               sourcePath,
+               stamp,
+               deps,
+               outputStamp,
+               digest=None,
+               ):
+        """Record the state of an output and its sources"""
+        self.records[outputPath] = {'source': sourcePath,
+                                    'stamp': list(stamp),
+                                    'deps': {path: list(depStamp)
+                                             for path, depStamp
+                                             in deps.items()
+                                             },
+                                    'output': list(outputStamp),
+                                    'digest': digest,
+                                    }
+
+    def retain(self, outputPaths):
+        """Forget all outputs not in outputPaths"""
+        outputPaths = set(outputPaths)
+        for outputPath in list(self.records):
+            if outputPath not in outputPaths:
+                del self.records[outputPath]
+
+    def _recordedDirectories(self):
+        """Return all directories between root and the recorded outputs"""
+        result = set()
+        for outputPath in self.records:
+            directory = dirname(outputPath)
+            while directory not in result:
+                result.add(directory)
+                if (directory == self.root
+                        or not directory.startswith(self.root)):
+                    break
+                directory = dirname(directory)
+        return result
+
+    def save(self):
+        """Write the manifest in the project data directory.
+
+        Notes
+        -----
+        This must be called once all outputs are written, since the current
+        modification time of the destination directories is saved.
+        """
+        directories = sorted(self._recordedDirectories())
+        self.directories = dict(zip(directories,
+                                    getDestinationMTimes(directories),
+                                    ),
+                                )
+        temporaryPath = '%s.tmp' % self.path
+        try:
+            with open(temporaryPath, 'w') as outFile:
+                json.dump({'version': MANIFEST_VERSION,
+                           'name': self.name,
+                           'variant': self.variant,
+                           'records': self.records,
+                           'directories': self.directories,
+                           },
+                          outFile,
+                          )
+            replace(temporaryPath, self.path)
+        except OSError:
+            logg.warning('Can\'t save manifest for %s' % self.name)
+            try:
+                remove(temporaryPath)
+            except OSError:
+                pass
@@ -0,0 +1,215 @@
+# encoding=utf-8
+"""Write precompressed copies of static outputs.
+
+Text outputs (css, js, svg, html...) can be served compressed without having
+the web server compress them on every request. When enabled on a task, a gzip
+(.gz) and/or brotli (.br) file is written next to each output when it is
+updated, at maximum compression. See apachecfg() to serve them.
+"""
+import gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+from os import stat
+from os.path import splitext
+from wdeploy import utils
+from wdeploy.user import (as_user,
+                          prefix_user,
+                          prefix_group,
+                          writeDestinationFile,
+                          )
+from logging import getLogger
+
+if __name__ == '__main__':
+    raise Exception('This program cannot be run in DOS mode.')
+logg = getLogger(__name__)
+
+
+# Supported formats (as file suffix), with their content encoding
+PRECOMPRESS_FORMATS = {'br': 'br',
+                       'gz': 'gzip',
+                       }
+
+# Mime types of the outputs that are precompressed, by extension
+PRECOMPRESS_TYPES = {'.css': 'text/css',
+                     '.js': 'application/javascript',
+                     '.svg': 'image/svg+xml',
+                     '.html': 'text/html',
+                     '.htm': 'text/html',
+                     '.txt': 'text/plain',
+                     '.xml': 'application/xml',
+                     '.json': 'application/json',
+                     }
+
+
+def precompressFormats(precompress):
+    """Return the formats to write from the precompress argument of a task.
+
+    Parameters
+    ----------
+    precompress : bool | list(string)
+        True for all formats, False or None for none, or a list of formats
+        from PRECOMPRESS_FORMATS.
+
+
+    Returns
+    -------
+    list(string)
+        The formats, as file suffixes
+
+
+    Notes
+    -----
+    An exception is raised for unknown formats, or if brotli is requested but
+    neither the brotli module nor the brotli program is available.
+    """
+    if not precompress:
+        return []
+    if precompress is True:
+        formats = sorted(PRECOMPRESS_FORMATS)
+    else:
+        formats = list(precompress)
+    for compressFormat in formats:
+        if compressFormat not in PRECOMPRESS_FORMATS:
+            raise RuntimeError('Unknown precompression format: "%s"'
+                               % compressFormat)
+    if ('br' in formats
+            and brotli is None
+            and not utils.isToolPresent('brotli')):
+        raise RuntimeError('No brotli compression facilities present!'
+                           + '(tried brotli module, brotli)')
+    return formats
+
+
+def manifestName(name, formats):
+    """Return the name of a task manifest, depending on the formats written.
+
+    Notes
+    -----
+    Changing the formats gives a new manifest, so that all outputs are checked
+    for missing compressed files (see precompressMissing()).
+    """
+    if not formats:
+        return name
+    return '%s:%s' % (name,
+                      ','.join(formats),
+                      )
+
+
+def isCompressible(path):
+    """Tell if an output is worth precompressing, from its extension"""
+    return splitext(path)[1].lower() in PRECOMPRESS_TYPES
+
+
+def compressedPaths(path, formats=PRECOMPRESS_FORMATS):
+    """Return the path of the compressed files of an output"""
+    return ['%s.%s' % (path, compressFormat)
+            for compressFormat in formats
+            ]
+
+
+def _compress(content, compressFormat):
+    """Compress some content at maximum level"""
+    if compressFormat == 'gz':
+        # A fixed modification time keeps the result reproducible
+        return gzip.compress(content, 9, mtime=0)
+    if brotli is not None:
+        return brotli.compress(content, quality=11)
+    return utils.processData('brotli',
+                             content,
+                             ['-c',
+                              '-q', '11',
+                              ],
+                             )
+
+
+@as_user(prefix_user, prefix_group)
+def _writeCompressed(destinationPaths, formats, missingOnly):
+    """Write the compressed files of outputs.
+
+    Parameters
+    ----------
+    missingOnly : bool
+        If True, only write compressed files that are missing or older than
+        their output.
+    """
+    for destinationPath in destinationPaths:
+        if missingOnly:
+            outputMTime = stat(destinationPath).st_mtime_ns
+            toWrite = []
+            for compressFormat, compressedPath in zip(
+                    formats,
+                    compressedPaths(destinationPath, formats),
+            ):
+                try:
+                    if stat(compressedPath).st_mtime_ns >= outputMTime:
+                        continue
+                except FileNotFoundError:
+                    pass
+                toWrite.append(compressFormat)
+            if not toWrite:
+                continue
+        else:
+            toWrite = formats
+        with open(destinationPath, 'rb') as inFile:
+            content = inFile.read()
+        for compressFormat in toWrite:
+            logg.debug('Compressing %s (%s)'
+                       % (destinationPath,
+                          compressFormat,
+                          ),
+                       )
+            writeDestinationFile('%s.%s' % (destinationPath, compressFormat),
+                                 _compress(content, compressFormat),
+                                 )
+
+
+def writePrecompressed(destinationPaths, formats):
+    """Write the compressed files of updated outputs.
+
+    Parameters
+    ----------
+    destinationPaths : list(string)
+        Full path of the updated outputs. Outputs that are not worth
+        compressing are ignored.
+    formats : list(string)
+        The formats to write, as returned by precompressFormats()
+    """
+    destinationPaths = [path
+                        for path in destinationPaths
+                        if isCompressible(path)
+                        ]
+    if formats and destinationPaths:
+        _writeCompressed(destinationPaths, formats, False)
+
+
+def precompressMissing(destinationPaths, formats, manifest=None):
+    """Write the compressed files missing or older than their output.
+
+    Parameters
+    ----------
+    destinationPaths : list(string)
+        Full path of all the outputs of a task
+    formats : list(string)
+        The formats to write, as returned by precompressFormats()
+    manifest : Manifest
+        (optional) The manifest of the task. If no destination directory
+        changed since it was saved, all compressed files were written along
+        with their output and nothing is checked.
+
+
+    Notes
+    -----
+    Outputs are only compressed when updated; this catches outputs that were
+    up to date when precompression was enabled, or compressed files removed
+    by someone else.
+    """
+    if not formats or (manifest is not None and manifest.isClean()):
+        return
+    destinationPaths = [path
+                        for path in destinationPaths
+                        if isCompressible(path)
+                        ]
+    if destinationPaths:
+        _writeCompressed(destinationPaths, formats, True)
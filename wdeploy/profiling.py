@@ -0,0 +1,275 @@
+# encoding=utf-8
+"""Measure where deployment time goes.
+
+When enabled (--profile option of webdeploy.py, or WDEPLOY_PROFILE environment
+variable), counters and timings are collected from the hot paths:
+- run time of each task (wdeploy.task.runTask()), without the time of tasks
+  it runs itself
+- workers started and function calls made by as_user()
+- programs run (utils.pipeRun(), utils.processData())
+- files checked, skipped and rebuilt by utils.checkDependencies()
+- bytes read and written in source and destination files
+Workers collect their own counters and send them back with the result of each
+call.
+
+At the end of the run, a JSON report is written in the project data directory
+and a summary is logged.
+"""
+from contextlib import contextmanager
+import json
+from os import (environ,
+                register_at_fork,
+                )
+from os.path import join
+from threading import (Lock,
+                       local,
+                       )
+from time import (perf_counter,
+                  time,
+                  )
+from wdeploy import utils
+from logging import getLogger
+
+if __name__ == '__main__':
+    raise Exception('This program cannot be run in DOS mode.')
+logg = getLogger(__name__)
+
+
+# Environment variable set to enable profiling
+PROFILE_KEY = 'WDEPLOY_PROFILE'
+
+# Name of the report, in the project data directory
+PROFILE_REPORT_NAME = 'profile.json'
+
+PROFILE_REPORT_VERSION = 2
+
+# Number of entries of each category shown in the summary
+SUMMARY_SIZE = 10
+
+# Counters, by name
+_COUNTERS = {}
+# Timings, by name: [number of calls, total time in seconds]
+_TIMINGS = {}
+# Run time of tasks
+_TASKS = []
+# Time spent in nested tasks, for each task running in the current thread
+_NESTED = local()
+_LOCK = Lock()
+_START = perf_counter()
+
+
+def isEnabled():
+    """Tell if profiling is enabled"""
+    return bool(environ.get(PROFILE_KEY))
+
+
+def count(name, value=1):
+    """Add a value to a counter"""
+    if not isEnabled():
+        return
+    with _LOCK:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + value
+
+
+def addTime(name, seconds):
+    """Record a call and its duration"""
+    if not isEnabled():
+        return
+    with _LOCK:
+        timing = _TIMINGS.setdefault(name, [0, 0])
+        timing[0] += 1
+        timing[1] += seconds
+
+
+@contextmanager
+def timed(name):
+    """Record the duration of a block (see addTime())"""
+    if not isEnabled():
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        addTime(name, perf_counter() - start)
+
+
+def startTask():
+    """Mark the start of a task, to be followed by recordTask()"""
+    if not isEnabled():
+        return
+    if not hasattr(_NESTED, 'stack'):
+        _NESTED.stack = []
+    _NESTED.stack.append(0)
+
+
+def recordTask(name, description, seconds, skipped):
+    """Record the run time of a task started with startTask().
+
+    Notes
+    -----
+    The time of tasks run by this task is not counted, so that the time of all
+    tasks adds up to the time of the run. It is added to the "nested" time of
+    the record.
+    """
+    if not isEnabled():
+        return
+    nested = _NESTED.stack.pop()
+    if _NESTED.stack:
+        _NESTED.stack[-1] += seconds
+    with _LOCK:
+        _TASKS.append({'name': name,
+                       'desc': description,
+                       'seconds': seconds - nested,
+                       'nested': nested,
+                       'skipped': skipped,
+                       },
+                      )
+
+
+def takeCounters():
+    """Return and reset the counters and timings of this process.
+
+    Returns
+    -------
+    tuple(dict, dict)
+        The counters and timings, to be passed to merge(), or None if nothing
+        was collected
+
+    Notes
+    -----
+    This is used by workers to send what they collected with each reply.
+    """
+    global _COUNTERS, _TIMINGS
+    with _LOCK:
+        if not _COUNTERS and not _TIMINGS:
+            return None
+        result = (_COUNTERS, _TIMINGS)
+        _COUNTERS = {}
+        _TIMINGS = {}
+    return result
+
+
+def merge(collected):
+    """Add counters and timings returned by takeCounters()"""
+    if collected is None:
+        return
+    counters, timings = collected
+    with _LOCK:
+        for name, value in counters.items():
+            _COUNTERS[name] = _COUNTERS.get(name, 0) + value
+        for name, (calls, seconds) in timings.items():
+            timing = _TIMINGS.setdefault(name, [0, 0])
+            timing[0] += calls
+            timing[1] += seconds
+
+
+def report():
+    """Return the profiling report of the run"""
+    with _LOCK:
+        return {'version': PROFILE_REPORT_VERSION,
+                'date': time(),
+                'seconds': perf_counter() - _START,
+                'tasks': list(_TASKS),
+                'counters': dict(_COUNTERS),
+                'timings': {name: {'calls': calls,
+                                   'seconds': seconds,
+                                   }
+                            for name, (calls, seconds) in _TIMINGS.items()
+                            },
+                }
+
+
+def _formatSize(size):
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return '%.1f %s' % (size, unit)
+        size /= 1024
+    return '%.1f GiB' % size
+
+
+def _logTimings(title, timings, prefix):
+    """Log the slowest timings whose name starts with prefix"""
+    entries = sorted(((seconds, calls, name[len(prefix):])
+                      for name, (calls, seconds) in timings.items()
+                      if name.startswith(prefix)
+                      ),
+                     reverse=True,
+                     )
+    if not entries:
+        return
+    logg.info('%s:' % title)
+    for seconds, calls, name in entries[:SUMMARY_SIZE]:
+        logg.info('  %8.3fs %6s calls  %s'
+                  % (seconds,
+                     calls,
+                     name,
+                     ),
+                  )
+
+
+def writeReport():
+    """Write the JSON report and log a summary, if profiling is enabled"""
+    if not isEnabled():
+        return
+    content = report()
+    reportPath = join(utils.dataPath(),
+                      PROFILE_REPORT_NAME,
+                      )
+    try:
+        with open(reportPath, 'w') as outFile:
+            json.dump(content,
+                      outFile,
+                      indent=2,
+                      sort_keys=True,
+                      )
+    except OSError as e:
+        logg.warning('Can\'t write profiling report %s: %s'
+                     % (reportPath,
+                        e,
+                        ),
+                     )
+    logg.info('Profile: %.3fs total, report in %s'
+              % (content['seconds'],
+                 reportPath,
+                 ),
+              )
+    if content['tasks']:
+        logg.info('Tasks:')
+        for taskRecord in sorted(content['tasks'],
+                                 key=lambda record: -record['seconds'],
+                                 ):
+            logg.info('  %8.3fs  %s%s'
+                      % (taskRecord['seconds'],
+                         taskRecord['desc'],
+                         ' (skipped)' if taskRecord['skipped'] else '',
+                         ),
+                      )
+    timings = {name: (timing['calls'], timing['seconds'])
+               for name, timing in content['timings'].items()
+               }
+    _logTimings('Programs', timings, 'program:')
+    _logTimings('Worker calls', timings, 'as_user:')
+    _logTimings('Worker starts', timings, 'worker:')
+    counters = content['counters']
+    logg.info('Files: %s checked, %s skipped, %s rebuilt, %s failed'
+              % (counters.get('files.checked', 0),
+                 counters.get('files.skipped', 0),
+                 counters.get('files.rebuilt', 0),
+                 counters.get('files.failed', 0),
+                 ),
+              )
+    logg.info('Data: %s read, %s written'
+              % (_formatSize(counters.get('bytes.read', 0)),
+                 _formatSize(counters.get('bytes.written', 0)),
+                 ),
+              )
+
+
+def _resetLock():
+    """Make sure a forked process doesn't inherit a held lock"""
+    global _LOCK
+    _LOCK = Lock()
+
+
+register_at_fork(after_in_child=_resetLock)
@@ -0,0 +1,198 @@
+# encoding=utf-8
+"""Run the tasks of a project, at the same time when possible.
+
+Tasks are run in the order of the configuration unless they are known to be
+independent. A task runs after another one if:
+- it lists the other task "id" in its "after" property, or
+- one of them is not concurrent (see wdeploy.task.task()) and doesn't have an
+  "after" property, or
+- one of them writes a path read or written by the other.
+
+A task that is not concurrent but has an "after" property only runs after the
+tasks it lists; its other dependencies are assumed to be handled by the
+configuration.
+
+Ready tasks are run at the same time up to a global limit, one by default.
+With a single task at a time, tasks are run in the configuration order.
+"""
+from concurrent.futures import (FIRST_COMPLETED,
+                                ThreadPoolExecutor,
+                                wait,
+                                )
+from os.path import (normpath,
+                     sep,
+                     )
+from wdeploy.task import (runTask,
+                          taskPaths,
+                          )
+from logging import getLogger
+
+if __name__ == '__main__':
+    raise Exception('This program cannot be run in DOS mode.')
+logg = getLogger(__name__)
+
+
+def _overlap(paths, otherPaths):
+    """Tell if a path is inside (or is) another path from the other list"""
+    for path in paths:
+        for otherPath in otherPaths:
+            if (path == otherPath
+                    or path.startswith(otherPath + sep)
+                    or otherPath.startswith(path + sep)):
+                return True
+    return False
+
+
+def _taskName(taskDesc):
+    return taskDesc.get('desc', taskDesc['name'])
+
+
+def taskDependencies(tasks):
+    """Compute the tasks each task must run after.
+
+    Parameters
+    ----------
+    tasks : list(dict)
+        The task definitions, in configuration order
+
+
+    Returns
+    -------
+    list(set(int))
+        For each task, the index of the tasks it must run after
+    """
+    ids = {}
+    for index, taskDesc in enumerate(tasks):
+        if 'id' not in taskDesc:
+            continue
+        if taskDesc['id'] in ids:
+            raise RuntimeError('Duplicate task id: "%s"' % taskDesc['id'])
+        ids[taskDesc['id']] = index
+    paths = []
+    for taskDesc in tasks:
+        taskPathsList = taskPaths(taskDesc)
+        if taskPathsList is not None:
+            taskPathsList = tuple([normpath(path)
+                                   for path in pathList
+                                   ]
+                                  for pathList in taskPathsList
+                                  )
+        paths.append(taskPathsList)
+    result = []
+    for index, taskDesc in enumerate(tasks):
+        dependencies = set()
+        for afterId in taskDesc.get('after', []):
+            try:
+                dependencies.add(ids[afterId])
+            except KeyError:
+                raise RuntimeError('Unknown task id "%s" in "after" of task '
+                                   '"%s"'
+                                   % (afterId,
+                                      _taskName(taskDesc),
+                                      ),
+                                   )
+        sequential = paths[index] is None and 'after' not in taskDesc
+        for previous in range(index):
+            previousSequential = (paths[previous] is None
+                                  and 'after' not in tasks[previous])
+            if sequential or previousSequential:
+                dependencies.add(previous)
+            elif paths[index] is None or paths[previous] is None:
+                continue
+            elif (_overlap(paths[index][1], paths[previous][0] +
+                           paths[previous][1])
+                  or _overlap(paths[index][0], paths[previous][1])):
+                dependencies.add(previous)
+        result.append(dependencies)
+    return result
+
+
+def _checkCycles(tasks, dependencies):
+    """Raise an exception if some tasks depend on each other"""
+    remaining = {index: set(taskDependencies)
+                 for index, taskDependencies in enumerate(dependencies)
+                 }
+    while remaining:
+        ready = [index
+                 for index, taskDependencies in remaining.items()
+                 if not taskDependencies
+                 ]
+        if not ready:
+            raise RuntimeError('Circular dependencies between tasks: %s'
+                               % ', '.join(_taskName(tasks[index])
+                                           for index in sorted(remaining)
+                                           ),
+                               )
+        for index in ready:
+            del remaining[index]
+        for taskDependencies in remaining.values():
+            taskDependencies.difference_update(ready)
+
+
+def runTasks(tasks, jobs=1):
+    """Run tasks, at the same time when possible.
+
+    Parameters
+    ----------
+    tasks : list(dict)
+        The task definitions, in configuration order (see runTask()). They can
+        have an "id" property, and an "after" property listing the id of the
+        tasks to run before.
+    jobs : int
+        The maximum number of tasks running at the same time
+
+
+    Notes
+    -----
+    When a task fails, no other task is started. The exception of the first
+    failed task is raised once running tasks are done.
+    """
+    dependencies = taskDependencies(tasks)
+    _checkCycles(tasks, dependencies)
+    pending = list(range(len(tasks)))
+    done = set()
+    running = {}
+    failure = None
+    jobs = max(1, jobs or 1)
+    with ThreadPoolExecutor(jobs) as executor:
+        while True:
+            while failure is None and len(running) < jobs:
+                ready = [index
+                         for index in pending
+                         if dependencies[index] <= done
+                         ]
+                if not ready:
+                    break
+                index = ready[0]
+                pending.remove(index)
+                logg.info('Running task %s: %s'
+                          % (index + 1,
+                             tasks[index]['name'],
+                             ),
+                          )
+                running[executor.submit(runTask, tasks[index])] = index
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                index = running.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    logg.error('Task %s failed: %s'
+                               % (_taskName(tasks[index]),
+                                  e,
+                                  ),
+                               )
+                    if failure is None:
+                        failure = e
+                    continue
+                done.add(index)
+    if failure is not None:
+        if pending:
+            logg.error('Tasks not run: %s'
+                       % ', '.join(_taskName(tasks[index])
+                                   for index in pending
+                                   ),
+                       )
+        raise failure
@@ -2,11 +2,20 @@
 """Task management.
 
 Decorators and functions required to define and run tasks.
+
+Task modules are only imported when one of their tasks is used (see
+getTask()).
 """
+from importlib import import_module
 from os.path import (join,
                      expanduser,
                      )
-from wdeploy import config
+from time import perf_counter
+from wdeploy import (config,
+                     profiling,
+                     taskstate,
+                     )
+from wdeploy.tasks import TASK_MODULES
 from logging import getLogger
 
 if __name__ == '__main__':
@@ -14,6 +23,10 @@ if __name__ == '__main__':
 logg = getLogger(__name__)
 
 
+# Group of the entry points declaring tasks of installed packages
+TASK_ENTRY_POINT_GROUP = 'wdeploy.tasks'
+
+
 def _handlePathArgs(args,
                     filterList,
                     baseDir,
@@ -58,9 +71,32 @@ def _handlePathArgs(args,
                                  ]
 
 
+def _taskArguments(taskName, kwargs):
+    """Return the arguments of a task function, with paths handled"""
+    sourceArguments, destinationArguments, otherArguments = (
+        task.taskPathArguments[taskName])
+    args = kwargs.copy()
+    _handlePathArgs(args,
+                    sourceArguments,
+                    config().ROOT,
+                    )
+    _handlePathArgs(args,
+                    destinationArguments,
+                    config().PREFIX,
+                    )
+    _handlePathArgs(args,
+                    otherArguments,
+                    None,
+                    )
+    return args
+
+
 def task(sourcePathArguments=None,
          destinationPathArguments=None,
          pathArguments=None,
+         concurrent=False,
+         inputs=None,
+         skipByDefault=True,
          ):
     """Returns a decorator for tasks.
 
@@ -72,6 +108,22 @@ def task(sourcePathArguments=None,
     destinationPathArguments : list(string)
         A list of arguments names that will be prefixed by config().PREFIX
         before running the task function.
+    concurrent : bool
+        The task only reads paths from sourcePathArguments and only writes
+        paths from destinationPathArguments and pathArguments. It can run at
+        the same time as other tasks not writing these paths (see
+        wdeploy.scheduler).
+    inputs : runnable
+        (optional) Called with the task arguments (with paths handled), returns
+        the inputs of the task as a dictionary with the optional keys "files"
+        (list of glob patterns), "tools" (list of programs) and "outputs"
+        (list of paths that must exist). If provided, the task is skipped when
+        its inputs did not change since its last successful run (see
+        wdeploy.taskstate).
+    skipByDefault : bool
+        If False, the task is only skipped when its definition opts in, with a
+        'skip' property set to True or with an 'inputs' property (see
+        runTask()). For tasks whose effects are not known from their inputs.
 
 
     Returns
@@ -92,29 +144,116 @@ def task(sourcePathArguments=None,
             myself.taskList
         except AttributeError:
             myself.taskList = {}
+            myself.taskPathArguments = {}
+            myself.concurrentTasks = set()
+            myself.taskInputs = {}
+            myself.optInSkipTasks = set()
 
         def processTask(**kwargs):
-            args = kwargs.copy()
-            _handlePathArgs(args,
-                            sourcePathArguments,
-                            config().ROOT,
-                            )
-            _handlePathArgs(args,
-                            destinationPathArguments,
-                            config().PREFIX,
-                            )
-            _handlePathArgs(args,
-                            pathArguments,
-                            None,
-                            )
-            func(**args)
+            func(**_taskArguments(func.__name__, kwargs))
         myself.taskList[func.__name__] = processTask
+        myself.taskPathArguments[func.__name__] = (
+            sourcePathArguments or [],
+            destinationPathArguments or [],
+            pathArguments or [],
+        )
+        if concurrent:
+            myself.concurrentTasks.add(func.__name__)
+        if inputs is not None:
+            myself.taskInputs[func.__name__] = inputs
+        if not skipByDefault:
+            myself.optInSkipTasks.add(func.__name__)
         logg.debug('Registering task %s'
                    % func.__name__)
         return None
     return decorator
 
 
+def _entryPointModules():
+    """Return the module of the tasks declared by installed packages, by name.
+
+    Notes
+    -----
+    Packages declare tasks with entry points in the "wdeploy.tasks" group; the
+    entry point name is the task name, and its value the module defining it.
+    importlib.metadata is slow to import; it is only imported when a task is
+    not found elsewhere.
+    """
+    myself = _entryPointModules
+    try:
+        return myself.cache
+    except AttributeError:
+        pass
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        entry_points = None
+    result = {}
+    if entry_points is not None:
+        try:
+            points = entry_points(group=TASK_ENTRY_POINT_GROUP)
+        except TypeError:
+            points = entry_points().get(TASK_ENTRY_POINT_GROUP, [])
+        for point in points:
+            result[point.name] = point.value.split(':')[0]
+    myself.cache = result
+    return result
+
+
+def taskModule(taskName):
+    """Return the name of the module defining a task.
+
+    Notes
+    -----
+    The module is looked up in order:
+    - in the optional TASK_MODULES dictionary of the project configuration
+    - in the tasks of wdeploy (see wdeploy.tasks.TASK_MODULES)
+    - in the entry points of installed packages (see _entryPointModules())
+    None is returned for unknown tasks.
+    """
+    projectModules = getattr(config(), 'TASK_MODULES', {})
+    if taskName in projectModules:
+        return projectModules[taskName]
+    if taskName in TASK_MODULES:
+        return TASK_MODULES[taskName]
+    return _entryPointModules().get(taskName)
+
+
+def getTask(taskName):
+    """Return the runnable of a task, importing its module on first use.
+
+    Parameters
+    ----------
+    taskName : string
+        The name of the task (see runTask())
+
+
+    Returns
+    -------
+    runnable
+        The task function, with path arguments handled (see task())
+    """
+    taskList = getattr(task, 'taskList', {})
+    if taskName not in taskList:
+        moduleName = taskModule(taskName)
+        if moduleName is None:
+            raise RuntimeError('Unknown task: "%s"' % taskName)
+        logg.debug('Loading task %s from %s'
+                   % (taskName,
+                      moduleName,
+                      ),
+                   )
+        import_module(moduleName)
+        taskList = getattr(task, 'taskList', {})
+        if taskName not in taskList:
+            raise RuntimeError('Module %s doesn\'t define task "%s"'
+                               % (moduleName,
+                                  taskName,
+                                  ),
+                               )
+    return taskList[taskName]
+
+
 def runTask(taskDesc):
     """Call a task.
 
@@ -125,6 +264,15 @@ def runTask(taskDesc):
         'name' is the name of the task (in fact, the name of a function using
         the @task decorator), and 'args' is a list of keyword arguments that
         will be passed to the task function.
+        If the task declares its inputs (see task()), it is skipped when they
+        did not change, unless the definition has a 'skip' property set to
+        False. Tasks declared with skipByDefault=False are only skipped when
+        the 'skip' property is set to True.
+        The definition can also have an 'inputs' property, with the same keys
+        as the inputs of task(); relative paths of "files" are relative to
+        config().ROOT, and relative paths of "outputs" to config().PREFIX.
+        They are added to the inputs of the task, and make it skippable by
+        default.
     """
     taskName = taskDesc['name']
     taskArgs = taskDesc['args'].copy()
@@ -135,4 +283,110 @@ def runTask(taskDesc):
     logg.info('Running task "%s"'
               % taskDescription
               )
-    task.taskList[taskName](**taskArgs)
+    profiling.startTask()
+    start = perf_counter()
+    skipped = False
+    try:
+        skipped = _runTask(taskName, taskDescription, taskDesc, taskArgs)
+    finally:
+        profiling.recordTask(taskName,
+                             taskDescription,
+                             perf_counter() - start,
+                             skipped,
+                             )
+
+
+def _runTask(taskName, taskDescription, taskDesc, taskArgs):
+    """Call a task, unless its inputs did not change.
+
+    Returns
+    -------
+    bool
+        True if the task was skipped
+    """
+    runnable = getTask(taskName)
+    inputsCB = task.taskInputs.get(taskName)
+    skip = taskDesc.get('skip',
+                        taskName not in task.optInSkipTasks
+                        or 'inputs' in taskDesc,
+                        )
+    if (inputsCB is None and 'inputs' not in taskDesc) or not skip:
+        runnable(**taskArgs)
+        return False
+    state = taskstate.TaskState(taskName,
+                                taskDesc['args'],
+                                lambda: _taskInputs(taskName,
+                                                    taskDesc,
+                                                    taskArgs,
+                                                    ),
+                                )
+    fingerprint = state.fingerprint()
+    if state.isUpToDate(fingerprint):
+        logg.info('Skipping task "%s": inputs did not change'
+                  % taskDescription)
+        return True
+    state.reset()
+    runnable(**taskArgs)
+    state.save(fingerprint)
+    return False
+
+
+def _taskInputs(taskName, taskDesc, taskArgs):
+    """Return the inputs of a task and of its definition (see runTask())"""
+    inputsCB = task.taskInputs.get(taskName)
+    if inputsCB is None:
+        result = {}
+    else:
+        result = dict(inputsCB(_taskArguments(taskName, taskArgs)))
+    definitionInputs = dict(taskDesc.get('inputs', {}))
+    _handlePathArgs(definitionInputs,
+                    ['files'],
+                    config().ROOT,
+                    )
+    _handlePathArgs(definitionInputs,
+                    ['outputs'],
+                    config().PREFIX,
+                    )
+    for key, values in definitionInputs.items():
+        result[key] = list(result.get(key, [])) + list(values)
+    return result
+
+
+def _pathValues(args, argNames):
+    """Return the paths of some arguments, as a flat list"""
+    result = []
+    for argName in argNames:
+        value = args.get(argName)
+        if value is None:
+            continue
+        if isinstance(value, str):
+            result.append(value)
+        else:
+            result += value
+    return result
+
+
+def taskPaths(taskDesc):
+    """Return the paths used by a task.
+
+    Parameters
+    ----------
+    taskDesc : dict
+        The task definition (see runTask())
+
+
+    Returns
+    -------
+    tuple(list(string), list(string))
+        The full paths read and the full paths written by the task, or None if
+        the task is not concurrent (see task()) and may touch anything.
+    """
+    getTask(taskDesc['name'])
+    if taskDesc['name'] not in task.concurrentTasks:
+        return None
+    sourceArguments, destinationArguments, otherArguments = (
+        task.taskPathArguments[taskDesc['name']])
+    args = _taskArguments(taskDesc['name'], taskDesc['args'])
+    return (_pathValues(args, sourceArguments),
+            _pathValues(args, destinationArguments + otherArguments),
+            )
@@ -1,16 +1,23 @@
 # encoding=utf-8
-from .a2site import a2site
-from .apachecfg import apachecfg
-from .cgi import cgi
-from .create_symlink import create_symlink
-from .css import css
-from .img import img
-from .js import js
-from .manage import manage
-from .makefile import makefile
-from .makepages import makepages
-from .mkdir import mkdir
-from .service import service
-from .synctree import synctree
-from .third import third
-from .virtualenv import virtualenv
+"""Tasks provided by wdeploy.
+
+Task modules are imported when a task is first used (see
+wdeploy.task.getTask()); this table gives the module defining each task.
+"""
+
+TASK_MODULES = {'a2site': 'wdeploy.tasks.a2site',
+                'apachecfg': 'wdeploy.tasks.apachecfg',
+                'cgi': 'wdeploy.tasks.cgi',
+                'create_symlink': 'wdeploy.tasks.create_symlink',
+                'css': 'wdeploy.tasks.css',
+                'img': 'wdeploy.tasks.img',
+                'js': 'wdeploy.tasks.js',
+                'manage': 'wdeploy.tasks.manage',
+                'makefile': 'wdeploy.tasks.makefile',
+                'makepages': 'wdeploy.tasks.makepages',
+                'mkdir': 'wdeploy.tasks.mkdir',
+                'service': 'wdeploy.tasks.service',
+                'synctree': 'wdeploy.tasks.synctree',
+                'third': 'wdeploy.tasks.third',
+                'virtualenv': 'wdeploy.tasks.virtualenv',
+                }
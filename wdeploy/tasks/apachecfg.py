@@ -9,6 +9,10 @@ from wdeploy import (config,
                      task,
                      utils,
                      )
+from wdeploy.fingerprint import FINGERPRINT_LENGTH
+from wdeploy.precompress import (PRECOMPRESS_FORMATS,
+                                 PRECOMPRESS_TYPES,
+                                 )
 from logging import getLogger
 
 if __name__ == '__main__':
@@ -92,7 +96,11 @@ def _writeVHost(outFile,
             cacheStrategy = None
         outFile.write('Alias /%s/ %s/\n' %
                       (alias[0], join(config().PREFIX, alias[1])))
-        apacheGrantAccess(outFile, alias[1], cacheStrategy)
+        apacheGrantAccess(outFile,
+                          alias[1],
+                          cacheStrategy,
+                          alias[0] if apache_config['precompressed'] else None,
+                          )
     # Compression
     if apache_config['enable_compression']:
         outFile.write('<IfModule mod_deflate.c>\n')
@@ -120,7 +128,15 @@ def _writeVHost(outFile,
     outFile.write('</VirtualHost>\n')
 
 
-@task()
+def _apachecfgInputs(args):
+    """Inputs of apachecfg(): its outputs, rewritten if removed"""
+    return {'outputs': [join(config().PREFIX, args['name']),
+                        join(config().PREFIX, 'cgi/wsgi.py'),
+                        ],
+            }
+
+
+@task(inputs=_apachecfgInputs)
 def apachecfg(name, apacheConfig):
     """Prepare the application to run on an apache2 server.
 
@@ -140,6 +156,11 @@ def apachecfg(name, apacheConfig):
     - hostname: the name of this vhost.
     - enable_compression: (optional) output directives to use the deflate module
                           (default to False).
+    - precompressed: (optional) serve the compressed files written next to the
+                     files of aliases (see the precompress argument of css(),
+                     js(), img(), makepages() and synctree()), using
+                     mod_rewrite and mod_headers. Dynamic compression is then
+                     only used for WSGI responses (default to False).
     - tls: a tuple containing path to the private and public key. If not
            provided, only HTTP configuration is produced.
            An optional third value can be used to indicate the CA certificate
@@ -153,7 +174,12 @@ def apachecfg(name, apacheConfig):
     For aliases, cache strategy can be either "no-cache" to explicitely mark all
     files to expire as soon as they are available, or "cache" to mark them to be
     cached (this is done by setting their expiration date at a month after
-    access).
+    access), or "immutable" to mark fingerprinted files (see the fingerprint
+    argument of css(), js() and img()) to be cached forever. With "immutable",
+    other files are handled as with "no-cache".
+
+    The task is skipped when its arguments and the configuration did not
+    change, and the generated files are still there.
     """
     cgiName = 'cgi/wsgi.py'
     runTask({'name': 'cgi',
@@ -174,6 +200,9 @@ def apachecfg(name, apacheConfig):
     if 'enable_compression' not in apacheConfig:
         apacheConfig['enable_compression'] = False
 
+    if 'precompressed' not in apacheConfig:
+        apacheConfig['precompressed'] = False
+
     if 'tls' not in apacheConfig:
         apacheConfig['tls'] = None
 
@@ -189,8 +218,26 @@ def apachecfg(name, apacheConfig):
     utils.cfg_chmod(apacheFullPath)
 
 
-def apacheGrantAccess(outFile, directory, cacheStrategy=None):
-    """Write an all-access directive to a directory in an apache config dir."""
+def apacheGrantAccess(outFile,
+                      directory,
+                      cacheStrategy=None,
+                      precompressedURL=None,
+                      ):
+    """Write an all-access directive to a directory in an apache config dir.
+
+    Parameters
+    ----------
+    outFile : file
+        The configuration file
+    directory : string
+        The directory, relative to PREFIX
+    cacheStrategy : string
+        (optional) "no-cache", "cache" or "immutable" (see apachecfg())
+    precompressedURL : string
+        (optional) The URL path the directory is aliased to. If provided, the
+        compressed files written next to the files of the directory are served
+        to clients accepting them, and dynamic compression is disabled.
+    """
     outFile.write('<Directory %s>\n' % join(config().PREFIX, directory))
     outFile.write('Require all granted\n')
     if cacheStrategy:
@@ -200,6 +247,70 @@ def apacheGrantAccess(outFile, directory, cacheStrategy=None):
             outFile.write('ExpiresDefault "access"\n')
         elif cacheStrategy == 'cache':
             outFile.write('ExpiresDefault "access plus 1 month"\n')
+        elif cacheStrategy == 'immutable':
+            _writeImmutable(outFile)
         else:
             raise RuntimeError('Invalid cache strategy: "%s"' % cacheStrategy)
+    if precompressedURL is not None:
+        _writePrecompressed(outFile, precompressedURL)
     outFile.write('</Directory>\n')
+
+
+def _writeImmutable(outFile):
+    """Write the directives caching fingerprinted files forever"""
+    # Files that are not fingerprinted can change
+    outFile.write('ExpiresDefault "access"\n')
+    outFile.write('<IfModule mod_headers.c>\n')
+    outFile.write('<FilesMatch "\\.[0-9a-f]{%s}\\.[^./]+(\\.(%s))?$">\n'
+                  % (FINGERPRINT_LENGTH,
+                     '|'.join(sorted(PRECOMPRESS_FORMATS)),
+                     ),
+                  )
+    outFile.write('ExpiresActive "off"\n')
+    outFile.write('Header set Cache-Control '
+                  + '"public, max-age=31536000, immutable"\n')
+    outFile.write('</FilesMatch>\n')
+    outFile.write('</IfModule>\n')
+
+
+def _writePrecompressed(outFile, url):
+    """Write the directives serving precompressed files in a directory"""
+    extensions = '|'.join(sorted(extension[1:]
+                                 for extension in PRECOMPRESS_TYPES
+                                 ),
+                          )
+    outFile.write('SetEnv no-gzip 1\n')
+    outFile.write('SetEnv no-brotli 1\n')
+    outFile.write('<IfModule mod_rewrite.c>\n')
+    outFile.write('<IfModule mod_headers.c>\n')
+    outFile.write('RewriteEngine On\n')
+    outFile.write('RewriteBase /%s/\n' % url)
+    for compressFormat, encoding in sorted(PRECOMPRESS_FORMATS.items()):
+        outFile.write('RewriteCond "%%{HTTP:Accept-Encoding}" "\\b%s\\b"\n'
+                      % encoding)
+        outFile.write('RewriteCond "%%{REQUEST_FILENAME}.%s" -f\n'
+                      % compressFormat)
+        outFile.write('RewriteRule "^(.+\\.(%s))$" "$1.%s" [L]\n'
+                      % (extensions,
+                         compressFormat,
+                         ),
+                      )
+    for extension, mimeType in sorted(PRECOMPRESS_TYPES.items()):
+        outFile.write('<FilesMatch "\\%s\\.(%s)$">\n'
+                      % (extension,
+                         '|'.join(sorted(PRECOMPRESS_FORMATS)),
+                         ),
+                      )
+        outFile.write('ForceType %s\n' % mimeType)
+        outFile.write('</FilesMatch>\n')
+    for compressFormat, encoding in sorted(PRECOMPRESS_FORMATS.items()):
+        outFile.write('<FilesMatch "\\.(%s)\\.%s$">\n'
+                      % (extensions,
+                         compressFormat,
+                         ),
+                      )
+        outFile.write('Header set Content-Encoding %s\n' % encoding)
+        outFile.write('</FilesMatch>\n')
+    outFile.write('Header append Vary Accept-Encoding\n')
+    outFile.write('</IfModule>\n')
+    outFile.write('</IfModule>\n')
@@ -1,20 +1,33 @@
 # encoding=utf-8
 import re
-from os.path import (join,
+from os.path import (dirname,
+                     join,
+                     realpath,
                      splitext,
                      )
-from os import (unlink,
-                )
-from wdeploy import (task,
+from wdeploy import (batch,
+                     compilecache,
+                     digest,
+                     task,
                      utils,
                      )
 from wdeploy.user import (as_user,
                           original_user,
                           original_group,
                           writeDestinationFile,
-                          crawlDestination,
                           )
+from wdeploy.depcache import DependencyCache
+from wdeploy.driver import (driverScript,
+                            getDriver,
+                            )
 from wdeploy.dependencies import extensionCheck
+from wdeploy.fingerprint import fingerprintOutputs
+from wdeploy.manifest import Manifest
+from wdeploy.precompress import (manifestName,
+                                 precompressFormats,
+                                 precompressMissing,
+                                 writePrecompressed,
+                                 )
 
 if __name__ == '__main__':
     raise Exception('This program cannot be run in DOS mode.')
@@ -22,8 +35,8 @@ if __name__ == '__main__':
 LESS_IMPORT_RE = re.compile(r'@import(?: +)\"(?P<import>.+)\";')
 
 
-def _lessProcess(sourceFile, includeDirs):
-    """Return a lessc process taking sourceFile as stdin"""
+def _lessTool(includeDirs):
+    """Return the name and arguments of the less compiler"""
     args = []
     if includeDirs:
         for includeDir in includeDirs:
@@ -32,39 +45,127 @@ def _lessProcess(sourceFile, includeDirs):
              '-ru',
              '-x',
              '-']
-    return utils.pipeRun('lessc', sourceFile, args)
+    return 'lessc', args
 
 
-def _cssProcess(sourceFile):
-    """Return a css minifier process taking sourceFile as stdin"""
+def _cssTool():
+    """Return the name and arguments of the css minifier to use"""
     if utils.isToolPresent('yui-compressor'):
         args = ['--type',
                 'css',
                 '--charset',
                 'utf-8',
                 ]
-        return utils.pipeRun('yui-compressor', sourceFile, args)
+        return 'yui-compressor', args
     if utils.isToolPresent('cleancss'):
         args = ['-e',
                 '--s1',
                 '-s',
                 ]
-        return utils.pipeRun('cleancss', sourceFile, args)
+        return 'cleancss', args
     if utils.isToolPresent('cssmin'):
-        return utils.pipeRun('cssmin', sourceFile, [])
+        return 'cssmin', []
     raise RuntimeError('No CSS minification facilities present!'
                        + '(tried yui-compressor, cleancss, cssmin)')
 
 
+def _lessProcess(sourceFile, includeDirs):
+    """Return a lessc process taking sourceFile as stdin"""
+    toolName, args = _lessTool(includeDirs)
+    return utils.pipeRun(toolName, sourceFile, args)
+
+
+def _cssProcess(sourceFile):
+    """Return a css minifier process taking sourceFile as stdin"""
+    toolName, args = _cssTool()
+    return utils.pipeRun(toolName, sourceFile, args)
+
+
+def _lessServerArgs():
+    """Return the command line of the less compile server"""
+    lessModule = dirname(dirname(realpath(utils.which('lessc'))))
+    return [utils.which('node'),
+            driverScript('less_server.js'),
+            lessModule,
+            ]
+
+
+def _lessServerOptions(includeDirs):
+    """Return the less options matching the arguments from _lessTool()"""
+    return {'filename': '-',
+            'paths': ['.'] + list(includeDirs or []),
+            'strictMath': True,
+            'relativeUrls': True,
+            'compress': True,
+            }
+
+
+def _lessCompile(source, includeDirs):
+    """Compile a less file using the compile server.
+
+    Returns
+    -------
+    bytes
+        The compiled file content, or None if the compile server is not
+        available.
+    """
+    server = getDriver('less', _lessServerArgs)
+    if server is None:
+        return None
+    with utils.open_utf8(source, 'r') as inFile:
+        response = server.request(source=inFile.read(),
+                                  options=_lessServerOptions(includeDirs),
+                                  )
+    if response is None:
+        return None
+    if 'error' in response:
+        error = response['error']
+        raise RuntimeError('Error while processing less file: %s, line %s, '
+                           'column %s: %s'
+                           % (source,
+                              error.get('line'),
+                              error.get('column'),
+                              error.get('message'),
+                              ),
+                           )
+    return response['css'].encode('utf-8')
+
+
 @as_user(original_user, original_group)
-def _lessProcessFromSource(source, includeDirs):
+def _lessProcessFromSource(source, includeDirs, cssTool):
     """Read and process a source less file
 
+    Parameters
+    ----------
+    cssTool : tuple(string, list)
+        The css minifier, as returned by batch.batchTool(), or None if it
+        can't be batched
+
+
     Returns
     -------
-    string
-        The processed file content
+    tuple(string, bool)
+        The processed file content, and True if it was minified by the minify
+        server (see wdeploy.batch)
+
+
+    Notes
+    -----
+    The file is compiled by a compile server started once per process, and
+    minified by the minify server if cssTool is provided. If they can't be
+    started, one lessc or minifier process is started per file.
     """
+    compiled = _lessCompile(source, includeDirs)
+    if compiled is not None:
+        if cssTool is not None:
+            result = batch.minifyContent(cssTool, compiled)
+            if result is not None:
+                return result, True
+        toolName, args = _cssTool()
+        return utils.processData(toolName,
+                                 compiled,
+                                 args,
+                                 ), False
     with utils.open_utf8(source, 'r') as inFile:
         lessProc = _lessProcess(inFile, includeDirs)
         cssProc = _cssProcess(lessProc.stdout)
@@ -73,7 +174,7 @@ def _lessProcessFromSource(source, includeDirs):
         lessProc.wait()
         if cssProc.returncode != 0 or lessProc.returncode != 0:
             raise RuntimeError('Error while processing less file: %s' % source)
-        return result
+        return result, False
 
 
 @as_user(original_user, original_group)
@@ -94,27 +195,67 @@ def _cssProcessFromSource(source):
         return result
 
 
-def lessProcess(source, dest, includeDirs):
-    """Process a less file into a css file"""
-    writeDestinationFile(dest,
-                         _lessProcessFromSource(source, includeDirs),
-                         )
+def lessProcess(source, dest, includeDirs, dependencies=None):
+    """Process a less file into a css file
+
+    Parameters
+    ----------
+    dependencies : list(string)
+        (optional) Full path of all files imported by the source file. The
+        result is then taken from the compile cache when possible.
+
+
+    Notes
+    -----
+    Results of the minify server are cached under their own key (see
+    batch.cacheTool()). A result of the command line minifier, used when the
+    minify server failed, is not cached under that key.
+    """
+    cssTool = batch.batchTool(_cssTool)
+    if dependencies is None:
+        content, _ = _lessProcessFromSource(source, includeDirs, cssTool)
+    else:
+        key, content = compilecache.lookup(
+            [_lessTool(includeDirs),
+             _cssTool() if cssTool is None else batch.cacheTool(cssTool),
+             ],
+            [source] + dependencies,
+        )
+        if content is None:
+            content, batched = _lessProcessFromSource(source,
+                                                      includeDirs,
+                                                      cssTool,
+                                                      )
+            if batched == (cssTool is not None):
+                compilecache.store(key, content)
+    writeDestinationFile(dest, content)
 
 
 def cssProcess(source, dest):
     """Process a css file into a minified css file"""
     writeDestinationFile(dest,
-                         _cssProcessFromSource(source),
+                         compilecache.cachedResult(
+                             [_cssTool()],
+                             [source],
+                             lambda: _cssProcessFromSource(source),
+                         ),
                          )
 
 
-@task(sourcePathArguments=['sourceDir', 'includeDirs'],
-      destinationPathArguments=['destinationDir'],
+@task(sourcePathArguments=['sourceDir', 'includeDirs', 'changedPaths'],
+      destinationPathArguments=['destinationDir', 'fingerprint'],
+      concurrent=True,
       )
 def css(sourceDir,
         destinationDir,
         includeDirs=None,
-        removeStale=True):
+        removeStale=True,
+        incremental=False,
+        changeDetection='mtime',
+        jobs=None,
+        changedPaths=None,
+        precompress=False,
+        fingerprint=None):
     """Process all css/less files from sourceDir.
 
     This task will look for changes in the source directory, and process/copy
@@ -127,6 +268,45 @@ def css(sourceDir,
 
     includeDirs is a list of directories included when parsing import
     directives in lessc files.
+
+    If incremental is True, the state of the outputs is kept in a manifest
+    between runs, and outputs whose sources did not change are skipped without
+    checking the destination directory. Imports found in less files, and
+    where they were found, are also kept; only changed files are parsed again.
+    Changes made in the destination directory without changing the mtime of
+    its directories (a file overwritten in place) are then not detected; run
+    once with incremental set to False to check the whole destination.
+    Default to False.
+
+    changeDetection can be 'mtime' (default) to rebuild outputs older than their
+    sources, or 'hash' to rebuild outputs whose sources content changed since
+    they were produced. 'hash' requires incremental.
+
+    jobs is the number of files processed at the same time (default to the
+    number of CPU).
+
+    changedPaths is an optional list of files changed since the last run (for
+    example from a file watcher or a CI diff). If incremental is True and the
+    previous run knows all of them, only the outputs depending on them are
+    rebuilt, without crawling the source directory.
+
+    Processed files are kept in the compile cache (see wdeploy.compilecache),
+    and reused when the same content is processed again.
+
+    With cleancss, CSS files are minified in chunks by a single process, and
+    compiled less files by the same process (see wdeploy.batch).
+
+    If precompress is True, a gzip (.gz) and a brotli (.br) file are written
+    next to each updated output, at maximum compression. It can also be a list
+    of formats ('gz', 'br'). See wdeploy.precompress.
+
+    fingerprint is an optional static root directory containing
+    destinationDir. If provided, a copy of each output named after its content
+    (app.3f9a1c2b4d5e.css) is written next to it, and the staticfiles.json
+    manifest of the static root maps outputs to their copy, as Django's
+    ManifestStaticFilesStorage does. url() references to fingerprinted files
+    are rewritten in the copies; tasks producing referenced files must run
+    before. See wdeploy.fingerprint.
     """
     def dependencyCheck(absolutePath):
         with utils.open_utf8(absolutePath, 'r') as src:
@@ -145,16 +325,50 @@ def css(sourceDir,
         name, _ = splitext(relativePath)
         return join(destinationDir, '%s.css' % name)
 
-    def updateCB(absoluteSource, absoluteDest):
+    def updateCB(absoluteSource, absoluteDest, dependencies):
         _, ext = splitext(absoluteSource)
         if ext == '.less':
             lessProcess(absoluteSource,
                         absoluteDest,
                         includeDirs,
+                        dependencies,
                         )
         else:
             cssProcess(absoluteSource, absoluteDest)
+        writePrecompressed([absoluteDest], formats)
+
+    tool = batch.batchTool(_cssTool)
+
+    def batchCB(toUpdate):
+        lessFiles = [updateArgs
+                     for updateArgs in toUpdate
+                     if splitext(updateArgs[0])[1] == '.less'
+                     ]
+        cssFiles = [updateArgs
+                    for updateArgs in toUpdate
+                    if splitext(updateArgs[0])[1] != '.less'
+                    ]
+        notProcessed = batch.batchProcess(tool, cssFiles)
+        writePrecompressed([updateArgs[1]
+                            for updateArgs in cssFiles
+                            if updateArgs not in notProcessed
+                            ],
+                           formats,
+                           )
+        return lessFiles + notProcessed
 
+    formats = precompressFormats(precompress)
+    digest.checkChangeDetection(changeDetection, incremental)
+    if incremental:
+        manifest = Manifest(manifestName('css:%s' % destinationDir,
+                                         formats,
+                                         ),
+                            destinationDir,
+                            )
+        dependencyCache = DependencyCache('css:%s' % destinationDir)
+    else:
+        manifest = None
+        dependencyCache = None
     outputFiles = utils.checkDependencies(baseDir=sourceDir,
                                           includeDirs=includeDirs,
                                           localInclude=True,
@@ -165,12 +379,29 @@ def css(sourceDir,
                                           dependencyCheck=dependencyCheck,
                                           outputCB=outputCB,
                                           updateCB=updateCB,
+                                          manifest=manifest,
+                                          changeDetection=changeDetection,
+                                          jobs=jobs,
+                                          withDependencies=True,
+                                          dependencyCache=dependencyCache,
+                                          changedPaths=changedPaths,
+                                          batchCB=batchCB if tool else None,
                                           )
+    keptFiles = outputFiles
+    if fingerprint:
+        keptFiles = outputFiles + fingerprintOutputs('css:%s' % destinationDir,
+                                                     fingerprint,
+                                                     outputFiles,
+                                                     formats,
+                                                     manifest,
+                                                     )
     if removeStale:
-        for candidateRelativePath, name in crawlDestination(destinationDir):
-            candidateFullPath = join(destinationDir,
-                                     candidateRelativePath,
-                                     name,
-                                     )
-            if candidateFullPath not in outputFiles:
-                unlink(candidateFullPath)
+        utils.removeStaleFiles(destinationDir,
+                               keptFiles,
+                               manifest,
+                               formats,
+                               )
+    precompressMissing(outputFiles, formats, manifest)
+    if manifest is not None:
+        manifest.save()
+        dependencyCache.save()
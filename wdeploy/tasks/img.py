@@ -2,56 +2,74 @@
 from os.path import (join,
                      splitext,
                      )
-from os import (unlink,
-                )
-from wdeploy import (task,
+from wdeploy import (compilecache,
+                     digest,
+                     task,
                      utils,
                      )
 from wdeploy.user import (as_user,
                           original_user,
                           original_group,
                           writeDestinationFile,
-                          crawlDestination,
                           )
 from wdeploy.dependencies import extensionCheck
+from wdeploy.fingerprint import fingerprintOutputs
+from wdeploy.manifest import Manifest
+from wdeploy.precompress import (manifestName,
+                                 precompressFormats,
+                                 precompressMissing,
+                                 writePrecompressed,
+                                 )
 
 if __name__ == '__main__':
     raise Exception('This program cannot be run in DOS mode.')
 
 
-def _jpgProcess(sourceFile):
-    """Return a process that minify an input jpeg file"""
+def _jpgTool():
+    """Return the name and arguments of the jpeg minifier"""
     if utils.isToolPresent('jpegtran'):
         args = ['-optimize',
                 '-progressive',
                 '-copy', 'none',
                 ]
-        return utils.pipeRun('jpegtran', sourceFile, args)
+        return 'jpegtran', args
     raise RuntimeError('No JPG minification facilities present!'
                        + '(tried jpegtran)')
 
 
-def _pngProcess(sourceFile):
-    """Return a process that minify an input PNG file"""
+def _pngTool():
+    """Return the name and arguments of the PNG minifier"""
     if utils.isToolPresent('pngcrush_wrapper'):
-        args = []
-        return utils.pipeRun('pngcrush_wrapper', sourceFile, args)
+        return 'pngcrush_wrapper', []
     raise RuntimeError('No PNG minification facilities present!'
                        + '(tried pngcrush_wrapper)')
 
 
-def _svgProcess(sourceFile):
-    """Return a process that minify an input SVG file"""
+def _svgTool():
+    """Return the name and arguments of the SVG minifier"""
     if utils.isToolPresent('svgo'):
         args = ['-i', '-',
                 '-o', '-',
                 '--multipass',
                 ]
-        return utils.pipeRun('svgo', sourceFile, args)
+        return 'svgo', args
     raise RuntimeError('No SVG minification facilities present!'
                        + '(tried svgo)')
 
 
+def _imgTool(source):
+    """Return the name and arguments of the minifier for an image file"""
+    _, ext = splitext(source)
+    ext = ext.lower()
+    if ext == '.png':
+        return _pngTool()
+    elif ext == '.jpg':
+        return _jpgTool()
+    elif ext == '.svg':
+        return _svgTool()
+    raise RuntimeError('Unknown image extension: %s' % ext)
+
+
 @as_user(original_user, original_group)
 def _imgProcessFromSource(source):
     """Read and process a source image file
@@ -61,18 +79,9 @@ def _imgProcessFromSource(source):
     string
         The processed file content
     """
-    _, ext = splitext(source)
-    ext = ext.lower()
-    if ext == '.png':
-        method = _pngProcess
-    elif ext == '.jpg':
-        method = _jpgProcess
-    elif ext == '.svg':
-        method = _svgProcess
-    else:
-        raise RuntimeError('Unknown image extension: %s' % ext)
+    toolName, args = _imgTool(source)
     with open(source, 'rb') as inFile:
-        proc = method(inFile)
+        proc = utils.pipeRun(toolName, inFile, args)
         result = proc.stdout.read()
         proc.wait()
         if proc.returncode != 0:
@@ -83,22 +92,47 @@ def _imgProcessFromSource(source):
 def imgProcess(source, dest):
     """Process an image file into a minified image file"""
     writeDestinationFile(dest,
-                         _imgProcessFromSource(source),
+                         compilecache.cachedResult(
+                             [_imgTool(source)],
+                             [source],
+                             lambda: _imgProcessFromSource(source),
+                         ),
                          )
 
 
-@task(sourcePathArguments=['sourceDir', 'includeDirs'],
-      destinationPathArguments=['destinationDir'],
+@task(sourcePathArguments=['sourceDir'],
+      destinationPathArguments=['destinationDir', 'fingerprint'],
+      concurrent=True,
       )
 def img(sourceDir,
         destinationDir,
-        removeStale=True):
+        removeStale=True,
+        incremental=False,
+        changeDetection='mtime',
+        jobs=None,
+        precompress=False,
+        fingerprint=None):
     """Process all image files from sourceDir.
 
     This task will look for changes in the source directory, and process/copy
     files in the destination directory.
 
     It will handle jpg, png and svg files.
+
+    If incremental is True, the state of the outputs is kept in a manifest
+    between runs (see css()). Default to False.
+
+    changeDetection can be 'mtime' or 'hash' (see css()).
+
+    jobs is the number of files processed at the same time (default to the
+    number of CPU).
+
+    Minified files are kept in the compile cache (see css()).
+
+    precompress writes compressed copies of updated SVG outputs (see css()).
+
+    fingerprint writes copies of outputs named after their content, listed
+    in the static manifest of the given static root (see css()).
     """
     def outputCB(relativePath):
         return join(destinationDir, relativePath)
@@ -107,7 +141,18 @@ def img(sourceDir,
         imgProcess(absoluteSource,
                    absoluteDest,
                    )
-
+        writePrecompressed([absoluteDest], formats)
+
+    formats = precompressFormats(precompress)
+    digest.checkChangeDetection(changeDetection, incremental)
+    if incremental:
+        manifest = Manifest(manifestName('img:%s' % destinationDir,
+                                         formats,
+                                         ),
+                            destinationDir,
+                            )
+    else:
+        manifest = None
     outputFiles = utils.checkDependencies(baseDir=sourceDir,
                                           includeDirs=None,
                                           localInclude=True,
@@ -118,11 +163,24 @@ def img(sourceDir,
                                           dependencyCheck=None,
                                           outputCB=outputCB,
                                           updateCB=updateCB,
+                                          manifest=manifest,
+                                          changeDetection=changeDetection,
+                                          jobs=jobs,
                                           )
+    keptFiles = outputFiles
+    if fingerprint:
+        keptFiles = outputFiles + fingerprintOutputs('img:%s' % destinationDir,
+                                                     fingerprint,
+                                                     outputFiles,
+                                                     formats,
+                                                     manifest,
+                                                     )
     if removeStale:
-        for candidateRelativePath, name in crawlDestination(destinationDir):
-            candidateFullPath = join(destinationDir,
-                                     candidateRelativePath,
-                                     name)
-            if candidateFullPath not in outputFiles:
-                unlink(candidateFullPath)
+        utils.removeStaleFiles(destinationDir,
+                               keptFiles,
+                               manifest,
+                               formats,
+                               )
+    precompressMissing(outputFiles, formats, manifest)
+    if manifest is not None:
+        manifest.save()
@@ -1,45 +1,57 @@
 # encoding=utf-8
 from os.path import (join,
                      )
-from os import (unlink,
-                )
-from wdeploy import (task,
+from wdeploy import (batch,
+                     compilecache,
+                     digest,
+                     task,
                      utils,
                      )
 from wdeploy.user import (as_user,
                           original_user,
                           original_group,
                           writeDestinationFile,
-                          crawlDestination,
                           )
 from wdeploy.dependencies import extensionCheck
+from wdeploy.fingerprint import fingerprintOutputs
+from wdeploy.manifest import Manifest
+from wdeploy.precompress import (manifestName,
+                                 precompressFormats,
+                                 precompressMissing,
+                                 writePrecompressed,
+                                 )
 
 if __name__ == '__main__':
     raise Exception('This program cannot be run in DOS mode.')
 
 
-def _jsProcess(sourceFile):
-    """Return a JS minifier process returning the minified output as stdout"""
+def _jsTool():
+    """Return the name and arguments of the JS minifier to use"""
     if utils.isToolPresent('closure-compiler.sh'):
-        args = []
-        return utils.pipeRun('closure-compiler.sh', sourceFile, args)
+        return 'closure-compiler.sh', []
     if utils.isToolPresent('uglifyjs'):
         args = ['-c',
                 '-m',
                 ]
-        return utils.pipeRun('uglifyjs', sourceFile, args)
+        return 'uglifyjs', args
     if utils.isToolPresent('yui-compressor'):
         args = ['--type',
                 'js',
                 '--charset',
                 'utf-8',
                 ]
-        return utils.pipeRun('yui-compressor', sourceFile, args)
+        return 'yui-compressor', args
     raise RuntimeError('No JS minification facilities present!'
                        + '(tried closure-compiler.sh, uglifyjs, '
                        + 'yui-compressor)')
 
 
+def _jsProcess(sourceFile):
+    """Return a JS minifier process returning the minified output as stdout"""
+    toolName, args = _jsTool()
+    return utils.pipeRun(toolName, sourceFile, args)
+
+
 @as_user(original_user, original_group)
 def _jsProcessFromSource(source):
     """Read and process a source css file
@@ -61,22 +73,50 @@ def _jsProcessFromSource(source):
 def jsProcess(source, dest):
     """Process a css file into a minified css file"""
     writeDestinationFile(dest,
-                         _jsProcessFromSource(source),
+                         compilecache.cachedResult(
+                             [_jsTool()],
+                             [source],
+                             lambda: _jsProcessFromSource(source),
+                         ),
                          )
 
 
-@task(sourcePathArguments=['sourceDir', 'includeDirs'],
-      destinationPathArguments=['destinationDir'],
+@task(sourcePathArguments=['sourceDir'],
+      destinationPathArguments=['destinationDir', 'fingerprint'],
+      concurrent=True,
       )
 def js(sourceDir,
        destinationDir,
-       removeStale=True):
+       removeStale=True,
+       incremental=False,
+       changeDetection='mtime',
+       jobs=None,
+       precompress=False,
+       fingerprint=None):
     """Process all Javascript files drom sourceDir.
 
     This task will look for changes in the source directory, and process/copy
     files in the destination directory.
 
     Javscript files will be minified.
+
+    If incremental is True, the state of the outputs is kept in a manifest
+    between runs (see css()). Default to False.
+
+    changeDetection can be 'mtime' or 'hash' (see css()).
+
+    jobs is the number of files processed at the same time (default to the
+    number of CPU).
+
+    Minified files are kept in the compile cache (see css()).
+
+    With uglifyjs, files are minified in chunks by a single process (see
+    wdeploy.batch).
+
+    precompress writes compressed copies of updated outputs (see css()).
+
+    fingerprint writes copies of outputs named after their content, listed
+    in the static manifest of the given static root (see css()).
     """
     def outputCB(relativePath):
         return join(destinationDir, relativePath)
@@ -85,7 +125,30 @@ def js(sourceDir,
         jsProcess(absoluteSource,
                   absoluteDest,
                   )
+        writePrecompressed([absoluteDest], formats)
+
+    tool = batch.batchTool(_jsTool)
+
+    def batchCB(toUpdate):
+        notProcessed = batch.batchProcess(tool, toUpdate)
+        writePrecompressed([updateArgs[1]
+                            for updateArgs in toUpdate
+                            if updateArgs not in notProcessed
+                            ],
+                           formats,
+                           )
+        return notProcessed
 
+    formats = precompressFormats(precompress)
+    digest.checkChangeDetection(changeDetection, incremental)
+    if incremental:
+        manifest = Manifest(manifestName('js:%s' % destinationDir,
+                                         formats,
+                                         ),
+                            destinationDir,
+                            )
+    else:
+        manifest = None
     outputFiles = utils.checkDependencies(baseDir=sourceDir,
                                           includeDirs=None,
                                           localInclude=True,
@@ -93,11 +156,25 @@ def js(sourceDir,
                                           dependencyCheck=None,
                                           outputCB=outputCB,
                                           updateCB=updateCB,
+                                          manifest=manifest,
+                                          changeDetection=changeDetection,
+                                          jobs=jobs,
+                                          batchCB=batchCB if tool else None,
                                           )
+    keptFiles = outputFiles
+    if fingerprint:
+        keptFiles = outputFiles + fingerprintOutputs('js:%s' % destinationDir,
+                                                     fingerprint,
+                                                     outputFiles,
+                                                     formats,
+                                                     manifest,
+                                                     )
     if removeStale:
-        for candidateRelativePath, name in crawlDestination(destinationDir):
-            candidateFullPath = join(destinationDir,
-                                     candidateRelativePath,
-                                     name)
-            if candidateFullPath not in outputFiles:
-                unlink(candidateFullPath)
+        utils.removeStaleFiles(destinationDir,
+                               keptFiles,
+                               manifest,
+                               formats,
+                               )
+    precompressMissing(outputFiles, formats, manifest)
+    if manifest is not None:
+        manifest.save()
@@ -4,6 +4,9 @@ from os.path import (join,
                      )
 from wdeploy import (task,
                      )
+from wdeploy.precompress import (precompressFormats,
+                                 precompressMissing,
+                                 )
 from wdeploy.user import (getSourceMTime,
                           getDestinationMTime,
                           readSourceFile,
@@ -18,12 +21,14 @@ logg = getLogger(__name__)
 
 @task(sourcePathArguments=['sourceDir'],
       destinationPathArguments=['targetDir'],
+      concurrent=True,
       )
 def makepages(sourceDir,
               targetDir,
               headerNames,
               footerNames,
-              pagesList):
+              pagesList,
+              precompress=False):
     """Create files by merging headers, body and footers.
 
     Parameters
@@ -42,6 +47,10 @@ def makepages(sourceDir,
         List of pages to generate. The tuples contain the title of the page, and
         the name of the file to use as the body. Same rules applies as for
         headerNames.
+    precompress : bool | list(string)
+        Write compressed copies of the generated pages (see
+        wdeploy.precompress). Pages are only compressed again when they
+        changed.
 
 
     Notes
@@ -49,6 +58,7 @@ def makepages(sourceDir,
     The title will be used anywhere the '%TITLE%' string is used (header, body,
     footer).
     """
+    formats = precompressFormats(precompress)
     header = u''
     decoratorTime = 0
     if headerNames:
@@ -72,10 +82,12 @@ def makepages(sourceDir,
             decoratorTime = max(decoratorTime, thisFooterTime)
 
     logg.info('Generating merged files')
+    targetPaths = []
     for title, bodyFile in pagesList:
         logg.debug('Merging file %s' % bodyFile)
         sourcePath = join(sourceDir, '%s.html' % bodyFile)
         targetPath = join(targetDir, '%s.html' % bodyFile)
+        targetPaths.append(targetPath)
 
         content = readSourceFile(sourcePath).decode()
         bodyTime = getSourceMTime(sourcePath)
@@ -90,3 +102,4 @@ def makepages(sourceDir,
                                    )
         fullContent = fullContent.replace(u'%TITLE%', title)
         writeDestinationFile(targetPath, fullContent.encode())
+    precompressMissing(targetPaths, formats)
@@ -39,7 +39,39 @@ def _runAsOriginal(virtualEnv, projectLocation, args):
     _runManage(virtualEnv, projectLocation, args)
 
 
-@task(pathArguments=['virtualEnv', 'projectLocation'])
+# Files of a Django project used by manage.py commands, relative to the
+# project location: settings, migrations, static files and translations.
+# Other files of the project are not checked, to keep unchanged runs cheap.
+MANAGE_INPUTS = ('manage.py',
+                 '*/settings*.py',
+                 '*/settings/*.py',
+                 '*/migrations/*.py',
+                 '*/static/**',
+                 '*/locale/*/LC_MESSAGES/*.po',
+                 )
+
+
+def _manageInputs(args):
+    """Inputs of manage(): some project files and the installed packages"""
+    files = [join(args['projectLocation'],
+                  pattern,
+                  )
+             for pattern in MANAGE_INPUTS
+             ]
+    files.append(join(args['virtualEnv'],
+                      'lib',
+                      'python*',
+                      'site-packages',
+                      ),
+                 )
+    return {'files': files,
+            }
+
+
+@task(pathArguments=['virtualEnv', 'projectLocation'],
+      inputs=_manageInputs,
+      skipByDefault=False,
+      )
 def manage(virtualEnv,
            projectLocation,
            args,
@@ -57,6 +89,20 @@ def manage(virtualEnv,
         Arguments for manage.py
     runAs : string
         Account to run the command as. Can be either 'original' or 'prefix'.
+
+
+    Notes
+    -----
+    The command runs on every deploy by default: commands like migrate,
+    clearsessions or collectstatic depend on state that is not known here.
+    Skipping is opt-in:
+    - with a 'skip' property set to True in the task definition, the command
+      is skipped when the settings, migrations, static files and translations
+      of the project (see MANAGE_INPUTS) and the installed packages did not
+      change since its last run
+    - with an 'inputs' property in the task definition (see
+      wdeploy.task.runTask()), these inputs are also checked, for example the
+      STATIC_ROOT of collectstatic in "outputs"
     """
     runAs = runAs.lower()
     if runAs == 'original':
@@ -14,7 +14,9 @@ if __name__ == '__main__':
 logg = getLogger(__name__)
 
 
-@task(destinationPathArguments=['dirName'])
+@task(destinationPathArguments=['dirName'],
+      concurrent=True,
+      )
 @as_user(prefix_user, prefix_group)
 def mkdir(dirName):
     """Create a directory in PREFIX with appropriate access rights."""
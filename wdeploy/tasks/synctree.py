@@ -5,14 +5,23 @@ from os import (remove,
                 rmdir,
                 walk,
                 )
-from os.path import join
-from wdeploy import task
-from wdeploy.user import (readSourceFile,
-                          writeDestinationFile,
-                          getSourceMTime,
-                          getDestinationMTime,
+from os.path import (isfile,
+                     join,
+                     )
+from wdeploy import (digest,
+                     task,
+                     )
+from wdeploy.manifest import Manifest
+from wdeploy.precompress import (compressedPaths,
+                                 manifestName,
+                                 precompressFormats,
+                                 precompressMissing,
+                                 writePrecompressed,
+                                 )
+from wdeploy.user import (copySourceToDestination,
                           crawlSource,
                           crawlDestination,
+                          getDestinationStats,
                           )
 from logging import getLogger
 
@@ -23,11 +32,15 @@ logg = getLogger(__name__)
 
 @task(sourcePathArguments=['sourceDir'],
       destinationPathArguments=['destDir'],
+      concurrent=True,
       )
 def synctree(sourceDir,
              destDir,
              deleteStalledFiles=True,
              excludePatterns=None,
+             incremental=False,
+             changeDetection='mtime',
+             precompress=False,
              ):
     """Synchronize the destination directory with the source directory.
 
@@ -41,6 +54,16 @@ def synctree(sourceDir,
         Delete files in destination that didn't come from a file in source
     excludePatterns : list(string)
         List of patterns to exclude from the mirror.
+    incremental : bool
+        Keep the state of the mirrored files in a manifest between runs, and
+        skip files whose source did not change without checking the
+        destination (see css()). Default to False.
+    changeDetection : string
+        'mtime' to copy files newer than their copy, or 'hash' to copy files
+        whose content changed since the last copy. 'hash' requires incremental.
+    precompress : bool | list(string)
+        Write compressed copies of the copied text files (see
+        wdeploy.precompress)
 
 
     Notes
@@ -53,11 +76,26 @@ def synctree(sourceDir,
                  destDir,
                  ),
               )
+    formats = precompressFormats(precompress)
+    digest.checkChangeDetection(changeDetection, incremental)
+    if incremental:
+        manifest = Manifest(manifestName('synctree:%s' % destDir,
+                                         formats,
+                                         ),
+                            destDir,
+                            )
+    else:
+        manifest = None
     rsync(sourceDir,
           destDir,
           deleteStalledFiles,
           excludePatterns,
+          manifest,
+          changeDetection,
+          formats,
           )
+    if manifest is not None:
+        manifest.save()
 
 
 def copyfile(sourcePath,
@@ -83,15 +121,18 @@ def copyfile(sourcePath,
                   destPath,
                   ),
                )
-    writeDestinationFile(destPath,
-                         readSourceFile(sourcePath),
-                         )
+    copySourceToDestination(sourcePath,
+                            destPath,
+                            )
 
 
 def rsync(sourceDir,
           destinationDir,
           deleteStalledFiles,
           excludeList=None,
+          manifest=None,
+          changeDetection='mtime',
+          compressedFormats=(),
           ):
     """Synchronize files from source to destination (mirror mode).
 
@@ -106,6 +147,19 @@ def rsync(sourceDir,
     excludeList : list(string)
         List of patterns for file that should not be copied
         Files fitting this pattern will however be deleted from destination.
+    manifest : Manifest
+        (optional) The manifest of the files mirrored in the previous run.
+        Files it knows whose source did not change are skipped, and if no
+        destination directory changed since then, the destination is not
+        crawled. It is updated, but not saved.
+    changeDetection : string
+        Either 'mtime' to copy files newer than their destination, or 'hash'
+        to copy files whose content digest differs from the one recorded in
+        the manifest, which is then required.
+    compressedFormats : list(string)
+        (optional) Formats of the compressed copies written next to copied
+        files (see wdeploy.precompress). Files that already have a compressed
+        copy in the source directory are not compressed.
 
 
     Notes
@@ -116,49 +170,182 @@ def rsync(sourceDir,
     will also be removed.
     """
 
-    # List used to delete stall files
-    sourceFiles = []
+    if changeDetection == 'hash' and manifest is None:
+        raise RuntimeError('Hash change detection requires a manifest')
 
-    for relativePath, fileName in crawlSource(sourceDir):
+    # Stamp (size, modification time, inode) of source files, by relative path
+    sourceFiles = {}
+
+    for entry in crawlSource(sourceDir):
         excluded = False
         if excludeList:
             for exclude in excludeList:
-                if fnmatch(fileName, exclude):
+                if fnmatch(entry.name, exclude):
                     excluded = True
                     break
             if excluded:
                 continue
 
-        sourceFiles.append(join(relativePath,
-                                fileName))
+        sourceFiles[join(entry.relativePath,
+                         entry.name)] = (entry.size,
+                                         entry.mtimeNS,
+                                         entry.inode,
+                                         )
 
-        destinationFilePath = join(destinationDir,
-                                   relativePath,
-                                   fileName)
+    if manifest is not None and manifest.isClean():
+        # The files recorded in the manifest are the only destination files
+        destinationFiles = None
+    else:
+        # Stamp of destination files, by relative path
+        destinationFiles = {join(entry.relativePath,
+                                 entry.name): (entry.size,
+                                               entry.mtimeNS,
+                                               entry.inode,
+                                               )
+                            for entry in crawlDestination(destinationDir)
+                            }
+
+    if changeDetection == 'hash':
+        sourceDigests = digest.sourceDigests({join(sourceDir,
+                                                   relativeFilePath): stamp
+                                              for relativeFilePath, stamp
+                                              in sourceFiles.items()
+                                              })
 
+    copiedFiles = []
+    for relativeFilePath, sourceStamp in sourceFiles.items():
         sourceFilePath = join(sourceDir,
-                              relativePath,
-                              fileName)
-        destinationTime = getDestinationMTime(destinationFilePath)
-        sourceTime = getSourceMTime(sourceFilePath)
-        if (sourceTime <= destinationTime):
-            continue
+                              relativeFilePath)
+        destinationFilePath = join(destinationDir,
+                                   relativeFilePath)
+        if changeDetection == 'hash':
+            sourceDigest = sourceDigests[sourceFilePath]
+            if manifest.matchesDigest(destinationFilePath,
+                                      sourceFilePath,
+                                      sourceDigest,
+                                      ):
+                if manifest.isTrusted(destinationFilePath):
+                    continue
+                destinationStamp = destinationFiles.get(relativeFilePath)
+                if destinationStamp == manifest.outputStamp(
+                        destinationFilePath):
+                    manifest.record(destinationFilePath,
+                                    sourceFilePath,
+                                    sourceStamp,
+                                    {},
+                                    destinationStamp,
+                                    sourceDigest,
+                                    )
+                    continue
+        else:
+            sourceDigest = None
+            if (manifest is not None
+                    and manifest.isUpToDate(destinationFilePath,
+                                            sourceFilePath,
+                                            sourceStamp,
+                                            {},
+                                            )):
+                continue
+            if destinationFiles is not None:
+                destinationStamp = destinationFiles.get(relativeFilePath,
+                                                        (0, 0, 0),
+                                                        )
+                if (sourceStamp[1] <= destinationStamp[1]):
+                    if manifest is not None:
+                        manifest.record(destinationFilePath,
+                                        sourceFilePath,
+                                        sourceStamp,
+                                        {},
+                                        destinationStamp,
+                                        )
+                    continue
 
         copyfile(sourceFilePath,
                  destinationFilePath)
+        copiedFiles.append((relativeFilePath,
+                            sourceDigest,
+                            ),
+                           )
 
-    if deleteStalledFiles:
-        for relativePath, fileName in crawlDestination(destinationDir):
-            relativeFilePath = join(relativePath,
-                                    fileName)
-            if relativeFilePath in sourceFiles:
-                continue
+    # Files to compress, unless the source directory already has a
+    # compressed copy
+    toCompress = {relativeFilePath
+                  for relativeFilePath in sourceFiles
+                  if compressedFormats
+                  and not any('%s.%s' % (relativeFilePath,
+                                         compressFormat,
+                                         ) in sourceFiles
+                              for compressFormat in compressedFormats
+                              )
+                  }
+    writePrecompressed([join(destinationDir, relativeFilePath)
+                        for relativeFilePath, _ in copiedFiles
+                        if relativeFilePath in toCompress
+                        ],
+                       compressedFormats,
+                       )
+    precompressMissing([join(destinationDir, relativeFilePath)
+                        for relativeFilePath in toCompress
+                        ],
+                       compressedFormats,
+                       manifest,
+                       )
 
-            destinationFilePath = join(destinationDir,
-                                       relativeFilePath)
+    if manifest is not None:
+        copiedPaths = [join(destinationDir, relativeFilePath)
+                       for relativeFilePath, _ in copiedFiles
+                       ]
+        copiedStamps = getDestinationStats(copiedPaths)
+        for (relativeFilePath, sourceDigest), destinationStamp in zip(
+                copiedFiles,
+                copiedStamps,
+        ):
+            manifest.record(join(destinationDir, relativeFilePath),
+                            join(sourceDir, relativeFilePath),
+                            sourceFiles[relativeFilePath],
+                            {},
+                            destinationStamp,
+                            sourceDigest,
+                            )
+        manifest.retain(join(destinationDir, relativeFilePath)
+                        for relativeFilePath in sourceFiles
+                        )
+
+    if deleteStalledFiles:
+        if destinationFiles is None:
+            staleFiles = [destinationFilePath
+                          for destinationFilePath in manifest.previousOutputs
+                          if destinationFilePath not in manifest.records
+                          ]
+            staleFiles += [compressedPath
+                           for destinationFilePath in staleFiles
+                           for compressedPath in compressedPaths(
+                               destinationFilePath,
+                               compressedFormats,
+                           )
+                           if isfile(compressedPath)
+                           ]
+        else:
+            compressedFiles = {compressedPath
+                               for relativeFilePath in toCompress
+                               for compressedPath in compressedPaths(
+                                   relativeFilePath,
+                                   compressedFormats,
+                               )
+                               }
+            staleFiles = [join(destinationDir,
+                               relativeFilePath)
+                          for relativeFilePath in destinationFiles
+                          if relativeFilePath not in sourceFiles
+                          and relativeFilePath not in compressedFiles
+                          ]
+        for destinationFilePath in staleFiles:
             logg.debug('Removing stale file %s' % destinationFilePath)
             remove(destinationFilePath)
 
+        if destinationFiles is None and not staleFiles:
+            # No file removed, and no one else changed the destination
+            return
         for directory, dirs, files in walk(destinationDir,
                                            topdown=False):
             if not dirs and not files:
@@ -1,22 +1,52 @@
 # encoding=utf-8
 """Deploy third-party files"""
+from concurrent.futures import ThreadPoolExecutor
+from fcntl import (flock,
+                   LOCK_EX,
+                   )
+import hashlib
+from hashlib import sha1
 import json
-from os import listdir
-from os.path import (join,
+from os import (getpid,
+                listdir,
+                makedirs,
+                rename,
+                replace,
+                unlink,
+                )
+from os.path import (dirname,
+                     join,
                      isdir,
+                     isfile,
+                     normpath,
+                     relpath,
                      splitext,
                      )
-from shutil import rmtree
-from subprocess import Popen
-from wdeploy import (task,
+from shutil import (copyfileobj,
+                    rmtree,
+                    )
+from subprocess import (DEVNULL,
+                        PIPE,
+                        Popen,
+                        )
+import tarfile
+from threading import (Lock,
+                       get_ident,
+                       )
+from time import time
+from urllib.request import urlopen
+import zipfile
+from wdeploy import (config,
+                     digest,
+                     task,
                      utils,
                      )
 from wdeploy.dependencies import extensionCheck
+from wdeploy.manifest import Manifest
 from wdeploy.user import (as_user,
                           original_user,
                           original_group,
-                          writeDestinationFile,
-                          readSourceFile,
+                          copySourceToDestination,
                           )
 from .css import cssProcess
 from .js import jsProcess
@@ -27,11 +57,56 @@ if __name__ == '__main__':
 logg = getLogger(__name__)
 
 
+# Number of third-party packages prepared at the same time
+PREPARE_JOBS = 4
+
+# Directory containing the mirrors of git repositories, in the data directory
+MIRRORS_DIR = 'mirrors'
+
+# Directory containing downloaded archives, in the data directory
+DOWNLOADS_DIR = 'downloads'
+
+# Checksum algorithms accepted for archives
+CHECKSUM_ALGORITHMS = ('sha256',
+                       'sha384',
+                       'sha512',
+                       )
+
+# Size of the chunks read when downloading or extracting
+COPY_CHUNK_SIZE = 64 * 1024
+
+# How JS and CSS files are deployed: always minified, copied as is, or copied
+# when already minified
+MINIFY_POLICIES = ('minify',
+                   'copy',
+                   'auto',
+                   )
+
+# Names of already minified files, for the 'auto' policy
+MINIFIED_SUFFIXES = ('.min.js',
+                     '-min.js',
+                     '.min.css',
+                     '-min.css',
+                     )
+
+# Files with less whitespace than this ratio in their first
+# MINIFIED_SAMPLE_SIZE bytes are considered minified, for the 'auto' policy
+MINIFIED_WHITESPACE_RATIO = 0.08
+MINIFIED_SAMPLE_SIZE = 16 * 1024
+
+
 @task(sourcePathArguments=['listDir'],
-      destinationPathArguments=['jsDir', 'cssDir'])
+      destinationPathArguments=['jsDir', 'cssDir'],
+      concurrent=True,
+      )
 def third(listDir,
           jsDir,
           cssDir,
+          incremental=False,
+          changeDetection='mtime',
+          jobs=None,
+          prepareJobs=None,
+          minify='minify',
           ):
     """Read third-party dependencies descriptions and deploy them
 
@@ -44,6 +119,24 @@ def third(listDir,
         The output directory for Javascript files. Relative to PREFIX.
     cssDir : string
         The output directory for CSS files. Relative to PREFIX.
+    incremental : bool
+        Keep the state of the outputs in a manifest between runs, and skip
+        outputs whose sources did not change without checking the destination
+        (see css()). Default to False.
+    changeDetection : string
+        'mtime' to update outputs older than their source, or 'hash' to update
+        outputs whose source content changed. 'hash' requires incremental.
+    jobs : int
+        The number of files processed at the same time. Default to the number
+        of CPU.
+    prepareJobs : int
+        The number of packages prepared (cloned...) at the same time. Default
+        to PREPARE_JOBS.
+    minify : string
+        The minification policy of packages that don't set one: 'minify' to
+        always minify JS and CSS files, 'copy' to copy them as is, or 'auto' to
+        copy files that are already minified (see isMinified()). Changing the
+        policy rebuilds the outputs in incremental mode.
 
 
     Notes
@@ -54,10 +147,28 @@ def third(listDir,
       named "type".
     - prefix: the prefix for output directories
     - files: list of files to process
+    - minify: the minification policy for the package, or a dictionary whose
+      keys are source files and values are the policy for this file. Default
+      to the minify argument.
 
     For "git" source type, the source object can have:
     - url: the repository URL
     - tag: the tag to checkout
+    Repositories are mirrored in the data directory, and only fetched from
+    when a tag is missing. Only the listed files are extracted.
+
+    For "tarball" (tar, possibly compressed) and "zip" source types, the
+    source object can have:
+    - url: the archive URL
+    - checksum: mandatory, "<algorithm>:<hex digest>" with algorithm one of
+      sha256, sha384 or sha512
+    - root: (optional) the directory of the archive containing the files, for
+      archives with a top-level directory
+    Archives are downloaded once in the data directory. Only the listed files
+    are extracted.
+
+    For "directory" source type, the source object must have:
+    - path: the directory containing the files. Relative to ROOT.
 
     File list can have the following properties:
     - "js": a dictionary whose key are source files and values are destination
@@ -65,25 +176,49 @@ def third(listDir,
 
     In all cases, destination names will be prefixed with "prefix" and put in
     appropriate directories (<js path>/<prefix>/file.js)
+
+    The files of all packages are prepared at the same time, then all packages
+    are deployed.
     """
-    for fileName in listdir(listDir):
+    digest.checkChangeDetection(changeDetection, incremental)
+    _checkMinifyPolicy(minify)
+    packages = []
+    for fileName in sorted(listdir(listDir)):
         filePath = join(listDir,
                         fileName)
         name = splitext(fileName)[0]
         with open(filePath, 'r') as inFile:
-            cfg = json.load(inFile)
-            thirdPath = prepareFiles(name,
-                                     cfg['source'])
-            try:
-                prefix = cfg['prefix']
-            except KeyError:
-                prefix = name
-            deployThird(thirdPath,
-                        prefix,
-                        cfg['files'],
-                        jsDir,
-                        cssDir,
-                        )
+            packages.append((name,
+                             json.load(inFile),
+                             ),
+                            )
+    thirdPaths = prepareAll([(name,
+                              cfg['source'],
+                              _packagePaths(cfg['files']),
+                              )
+                             for name, cfg in packages
+                             ],
+                            prepareJobs,
+                            )
+    for name, cfg in packages:
+        try:
+            prefix = cfg['prefix']
+        except KeyError:
+            prefix = name
+        policies = cfg.get('minify', minify)
+        if isinstance(policies, dict):
+            policies = dict(policies)
+            policies.setdefault(None, minify)
+        deployThird(thirdPaths[name],
+                    prefix,
+                    cfg['files'],
+                    jsDir,
+                    cssDir,
+                    incremental,
+                    changeDetection,
+                    jobs,
+                    policies,
+                    )
 
 
 def _outputPathHandlerFactory(outputDir,
@@ -118,7 +253,12 @@ def deployThird(sourceDir,
                 prefix,
                 files,
                 jsDir,
-                cssDir):
+                cssDir,
+                incremental=False,
+                changeDetection='mtime',
+                jobs=None,
+                minify='minify',
+                ):
     """Copy files from third party source to deployment directory.
 
     Parameters
@@ -136,8 +276,25 @@ def deployThird(sourceDir,
     cssDir : string
         The base CSS directory. CSS files will be copied there under the prefix
         directory.
+    incremental : bool
+        Use a manifest to skip outputs whose sources did not change.
+    changeDetection : string
+        The change detection mode, 'mtime' or 'hash'.
+    jobs : int
+        The number of files processed at the same time.
+    minify : string | dict
+        The minification policy of JS and CSS files (see MINIFY_POLICIES), or
+        a dictionary of policies by source file. The None key of the dictionary
+        gives the policy of files not in it, default to 'minify'.
     """
+    if isinstance(minify, dict):
+        for policy in minify.values():
+            _checkMinifyPolicy(policy)
+    else:
+        _checkMinifyPolicy(minify)
     if 'js' in files:
+        outputDir = join(jsDir, prefix)
+        manifest = _manifest('third:js', outputDir, incremental, minify)
         utils.checkDependencies(baseDir=sourceDir,
                                 includeDirs=None,
                                 localInclude=False,
@@ -146,10 +303,20 @@ def deployThird(sourceDir,
                                 outputCB=_outputPathHandlerFactory(jsDir,
                                                                    prefix,
                                                                    files['js']),
-                                updateCB=updateJSFile,
+                                updateCB=_updateFactory(sourceDir,
+                                                        minify,
+                                                        updateJSFile,
+                                                        ),
                                 filesList=files['js'],
+                                manifest=manifest,
+                                changeDetection=changeDetection,
+                                jobs=jobs,
                                 )
+        if manifest is not None:
+            manifest.save()
     if 'css' in files:
+        outputDir = join(cssDir, prefix)
+        manifest = _manifest('third:css', outputDir, incremental, minify)
         utils.checkDependencies(baseDir=sourceDir,
                                 includeDirs=None,
                                 localInclude=False,
@@ -159,11 +326,21 @@ def deployThird(sourceDir,
                                                                    prefix,
                                                                    files['css'],
                                                                    ),
-                                updateCB=updateCSSFile,
+                                updateCB=_updateFactory(sourceDir,
+                                                        minify,
+                                                        updateCSSFile,
+                                                        ),
                                 filesList=files['css'],
+                                manifest=manifest,
+                                changeDetection=changeDetection,
+                                jobs=jobs,
                                 )
+        if manifest is not None:
+            manifest.save()
     if 'cssother' in files:
         lsof = files['cssother']
+        outputDir = join(cssDir, prefix)
+        manifest = _manifest('third:cssother', outputDir, incremental)
         utils.checkDependencies(baseDir=sourceDir,
                                 includeDirs=None,
                                 localInclude=False,
@@ -173,13 +350,49 @@ def deployThird(sourceDir,
                                                                    prefix,
                                                                    lsof),
                                 updateCB=copyFile,
-                                filesList=lsof)
+                                filesList=lsof,
+                                manifest=manifest,
+                                changeDetection=changeDetection,
+                                jobs=jobs)
+        if manifest is not None:
+            manifest.save()
+
+
+def _manifest(kind, outputDir, incremental, minify=None):
+    """Return the manifest for a kind of output, or None if not incremental.
+
+    Notes
+    -----
+    The minification policy is the variant of the manifest: changing it
+    rebuilds all outputs.
+    """
+    if not incremental:
+        return None
+    return Manifest('%s:%s' % (kind,
+                               outputDir,
+                               ),
+                    outputDir,
+                    None if minify is None else _policyName(minify),
+                    )
+
+
+def _policyName(minify):
+    """Return a minification policy as used in manifest names"""
+    if not isinstance(minify, dict):
+        return minify
+    return ','.join('%s=%s' % (sourcePath,
+                               policy,
+                               )
+                    for sourcePath, policy in sorted(
+                        (sourcePath or '', policy)
+                        for sourcePath, policy in minify.items()
+                    ))
 
 
 def copyFile(sourcepath,
              destinationpath):
-    writeDestinationFile(destinationpath,
-                         readSourceFile(sourcepath))
+    copySourceToDestination(sourcepath,
+                            destinationpath)
 
 
 def updateJSFile(sourcePath,
@@ -196,26 +409,385 @@ def updateCSSFile(sourcePath,
     cssProcess(sourcePath, destPath)
 
 
+def _checkMinifyPolicy(policy):
+    if policy not in MINIFY_POLICIES:
+        raise RuntimeError('Unknown minification policy: "%s"' % policy)
+
+
+@as_user(original_user, original_group)
+def _whitespaceRatio(sourcePath):
+    """Return the ratio of whitespace in the beginning of a source file"""
+    with open(sourcePath, 'rb') as inFile:
+        sample = inFile.read(MINIFIED_SAMPLE_SIZE)
+    if not sample:
+        return 1
+    return sum(sample.count(character)
+               for character in b' \t\r\n'
+               ) / len(sample)
+
+
+def isMinified(sourcePath):
+    """Tell if a JS or CSS file looks already minified.
+
+    Notes
+    -----
+    Files named like "*.min.js" are minified. Otherwise, a sample of the file
+    is read; minifiers remove almost all whitespace (see
+    MINIFIED_WHITESPACE_RATIO).
+    """
+    if sourcePath.lower().endswith(MINIFIED_SUFFIXES):
+        return True
+    return _whitespaceRatio(sourcePath) < MINIFIED_WHITESPACE_RATIO
+
+
+def _updateFactory(sourceDir, minify, processCB):
+    """Create an updateCB handler applying a minification policy.
+
+    Parameters
+    ----------
+    sourceDir : string
+        The directory containing the package files
+    minify : string | dict
+        The minification policy (see deployThird())
+    processCB : runnable
+        Called with the source and destination path of files to minify
+
+    Returns
+    -------
+    runnable
+        A runnable suitable to be used as the updateCB argument of
+        checkDependencies().
+    """
+    def runnable(sourcePath, destPath):
+        if isinstance(minify, dict):
+            policy = minify.get(relpath(sourcePath, sourceDir),
+                                minify.get(None, 'minify'),
+                                )
+        else:
+            policy = minify
+        if policy == 'auto':
+            policy = 'copy' if isMinified(sourcePath) else 'minify'
+        if policy == 'copy':
+            logg.debug('Copying %s without minifying it' % sourcePath)
+            copySourceToDestination(sourcePath, destPath)
+        else:
+            processCB(sourcePath, destPath)
+    return runnable
+
+
+def _packagePaths(files):
+    """Return the path of all the files used from a package"""
+    return sorted(set(path
+                      for kindFiles in files.values()
+                      for path in kindFiles
+                      ))
+
+
+class _PrepareProgress(object):
+    """Combined progress of packages prepared at the same time"""
+
+    def __init__(self, names):
+        self.total = len(names)
+        self.running = []
+        self.done = 0
+        self.failed = 0
+        self._lock = Lock()
+
+    def started(self, name):
+        with self._lock:
+            self.running.append(name)
+            self._report()
+
+    def finished(self, name, failed=False):
+        with self._lock:
+            self.running.remove(name)
+            self.done += 1
+            if failed:
+                self.failed += 1
+            self._report()
+
+    def _report(self):
+        if self.failed:
+            failedStatus = ', %s failed' % self.failed
+        else:
+            failedStatus = ''
+        if self.running:
+            runningStatus = ', preparing %s' % ', '.join(self.running)
+        else:
+            runningStatus = ''
+        logg.info('Third-party packages: %s/%s done%s%s'
+                  % (self.done,
+                     self.total,
+                     failedStatus,
+                     runningStatus,
+                     ),
+                  )
+
+
+def prepareAll(packages, jobs=None):
+    """Prepare the files of multiple packages at the same time.
+
+    Parameters
+    ----------
+    packages : list(tuple(string, dict, list(string)))
+        The name, source settings and used files of all packages (see
+        prepareFiles())
+    jobs : int
+        The maximum number of packages prepared at the same time. Default to
+        PREPARE_JOBS.
+
+
+    Returns
+    -------
+    dict
+        The path containing the prepared files, by package name
+
+
+    Notes
+    -----
+    A failure doesn't stop the preparation of other packages. An exception
+    listing all failed packages is raised once all are done.
+    """
+    progress = _PrepareProgress([name for name, _, _ in packages])
+
+    def prepare(name, source, paths):
+        progress.started(name)
+        try:
+            result = prepareFiles(name, source, paths)
+        except Exception:
+            progress.finished(name, True)
+            raise
+        progress.finished(name)
+        return result
+
+    with ThreadPoolExecutor(jobs or PREPARE_JOBS) as executor:
+        futures = [(name,
+                    executor.submit(prepare, name, source, paths),
+                    )
+                   for name, source, paths in packages
+                   ]
+    result = {}
+    failures = []
+    for name, future in futures:
+        try:
+            result[name] = future.result()
+        except Exception as e:
+            logg.error('Error while preparing %s: %s'
+                       % (name,
+                          e,
+                          ),
+                       )
+            failures.append(name)
+    if failures:
+        raise RuntimeError('Failed to prepare %s third-party package(s): %s'
+                           % (len(failures),
+                              ', '.join(failures),
+                              ),
+                           )
+    return result
+
+
+def _runGIT(args, cwd):
+    """Run git without showing its output.
+
+    Returns
+    -------
+    tuple(int, string)
+        The return code of git, and its first error message
+    """
+    process = Popen([utils.which(utils.GIT)] + args,
+                    cwd=cwd,
+                    stdin=DEVNULL,
+                    stdout=DEVNULL,
+                    stderr=PIPE,
+                    )
+    _, errors = process.communicate()
+    errors = errors.decode('utf-8', 'replace').strip().splitlines()
+    fatalErrors = [line
+                   for line in errors
+                   if line.startswith(('fatal:', 'error:'))
+                   ]
+    errors = fatalErrors or errors
+    return process.returncode, errors[0] if errors else ''
+
+
 @as_user(original_user, original_group)
 def prepareFiles(name,
                  source,
+                 paths=None,
                  ):
     """Prepare files according to the settings in source.
 
     source if taken from a config file.
+    paths is the list of files used from the package, relative to its root.
+    If None, all files are prepared.
     This function return a path containing the prepared files. If it fails, an
     exception is raised.
     """
     if source['type'] == 'git':
         return prepareGIT(name,
-                          source)
+                          source,
+                          paths)
+    if source['type'] in ('tarball', 'zip'):
+        return prepareArchive(name,
+                              source,
+                              paths)
+    if source['type'] == 'directory':
+        return prepareDirectory(name,
+                                source,
+                                paths)
     raise NotImplementedError('Unsupported source type: %s' % source['type'])
 
 
-def prepareGIT(name,
-               source,
-               ):
-    """Prepare files from a GIT repository."""
+def _mirrorPath(url):
+    """Return the path of the bare mirror of a repository"""
+    return join(utils.dataPath(),
+                MIRRORS_DIR,
+                '%s.git' % sha1(url.encode()).hexdigest(),
+                )
+
+
+def _hasRef(mirrorPath, ref):
+    """Tell if a mirror contains a reference"""
+    result, _ = _runGIT(['rev-parse',
+                         '--verify',
+                         '--quiet',
+                         '%s^{commit}' % ref,
+                         ],
+                        mirrorPath,
+                        )
+    return result == 0
+
+
+def updateMirror(url, ref):
+    """Make sure the mirror of a repository contains a reference.
+
+    Parameters
+    ----------
+    url : string
+        The repository URL. Local repositories (file://) can be used.
+    ref : string
+        The full name of a reference (refs/tags/v1.0, refs/heads/master)
+
+
+    Returns
+    -------
+    string
+        The path of the bare mirror
+
+
+    Notes
+    -----
+    The mirror is created on first use. Afterward, it is only fetched from
+    (getting new objects only) when the reference is a branch or is missing.
+    A lock file prevents multiple processes from updating a mirror at the same
+    time.
+    """
+    mirrorPath = _mirrorPath(url)
+    makedirs(dirname(mirrorPath), exist_ok=True)
+    with open('%s.lock' % mirrorPath, 'w') as lockFile:
+        flock(lockFile, LOCK_EX)
+        if not isdir(mirrorPath):
+            logg.debug('Creating mirror of %s' % url)
+            result, error = _runGIT(['clone',
+                                     '--mirror',
+                                     url,
+                                     mirrorPath,
+                                     ],
+                                    dirname(mirrorPath),
+                                    )
+            if result != 0:
+                if isdir(mirrorPath):
+                    rmtree(mirrorPath)
+                raise RuntimeError('Error when mirroring repository %s: %s'
+                                   % (url,
+                                      error,
+                                      ),
+                                   )
+        elif (not ref.startswith('refs/tags/')
+              or not _hasRef(mirrorPath, ref)):
+            logg.debug('Fetching %s' % url)
+            result, error = _runGIT(['fetch',
+                                     '--prune',
+                                     'origin',
+                                     ],
+                                    mirrorPath,
+                                    )
+            if result != 0:
+                raise RuntimeError('Error when fetching repository %s: %s'
+                                   % (url,
+                                      error,
+                                      ),
+                                   )
+    return mirrorPath
+
+
+def _extractArchive(mirrorPath, ref, paths, destinationPath):
+    """Extract some files of a mirror at a given reference.
+
+    Notes
+    -----
+    The files are produced by git archive and extracted while they are
+    produced; no working tree or checkout is needed.
+    """
+    args = [utils.which(utils.GIT),
+            'archive',
+            '--format=tar',
+            ref,
+            ]
+    if paths:
+        args += ['--'] + paths
+    process = Popen(args,
+                    cwd=mirrorPath,
+                    stdin=DEVNULL,
+                    stdout=PIPE,
+                    stderr=PIPE,
+                    )
+    # Extracted files must look newer than outputs produced from a previous
+    # version, whatever the date of the commit
+    now = time()
+    try:
+        with tarfile.open(fileobj=process.stdout, mode='r|') as archive:
+            for member in archive:
+                member.mtime = now
+                if hasattr(tarfile, 'data_filter'):
+                    archive.extract(member, destinationPath, filter='data')
+                else:
+                    archive.extract(member, destinationPath)
+    except tarfile.TarError:
+        # Reported below from git error
+        pass
+    finally:
+        process.stdout.close()
+    errors = process.stderr.read().decode('utf-8', 'replace').strip()
+    process.stderr.close()
+    if process.wait() != 0:
+        raise RuntimeError('Error when extracting %s: %s'
+                           % (ref,
+                              errors.splitlines()[0] if errors else '',
+                              ),
+                           )
+
+
+def _preparedPath(name, installString, extractCB):
+    """Return the directory containing the prepared files of a package.
+
+    Parameters
+    ----------
+    name : string
+        The package name
+    installString : string
+        Describes the files to prepare. Files are prepared again when it
+        differs from the previous run.
+    extractCB : runnable
+        Called with an empty directory, to put the files in it
+
+
+    Notes
+    -----
+    Files are put in a temporary directory, which replaces the previous files
+    once complete.
+    """
     infoFile = join(utils.dataPath(),
                     '%s.third' % name)
     try:
@@ -223,50 +795,300 @@ def prepareGIT(name,
             installedString = inFile.read()
     except OSError:
         installedString = ''
-
-    if 'tag' not in source:
-        tagName = ''
-    else:
-        tagName = source['tag']
-    expectedInstallString = '%s:%s' % (source['url'], tagName)
     thirdPathName = '%s.files' % name
     thirdPath = join(utils.dataPath(),
                      thirdPathName)
-    if expectedInstallString == installedString:
+    if installString == installedString and isdir(thirdPath):
         return thirdPath
 
+    temporaryPath = '%s.tmp' % thirdPath
+    if isdir(temporaryPath):
+        rmtree(temporaryPath)
+    makedirs(temporaryPath)
+    try:
+        extractCB(temporaryPath)
+    except Exception:
+        rmtree(temporaryPath)
+        raise
     if isdir(thirdPath):
         rmtree(thirdPath)
-
-    gitPath = utils.which(utils.GIT)
-    cloneProcessArgs = [gitPath,
-                        'clone',
-                        source['url'],
-                        thirdPathName,
-                        ]
-    cloneProcess = Popen(cloneProcessArgs,
-                         cwd=utils.dataPath())
-    cloneResult = cloneProcess.wait()
-    if cloneResult != 0:
-        raise Exception('Error when cloning repository for %s' % name)
-
-    if tagName:
-        checkoutProcessArgs = [gitPath,
-                               'checkout',
-                               'tags/%s' % source['tag']]
-    else:
-        checkoutProcessArgs = [gitPath,
-                               'checkout',
-                               'master']
-    checkoutProcess = Popen(checkoutProcessArgs,
-                            cwd=thirdPath)
-    checkoutResult = checkoutProcess.wait()
-    if checkoutResult != 0:
-        raise Exception('Error when checking out tag %s for %s' %
-                        (tagName,
-                         name))
+    rename(temporaryPath, thirdPath)
 
     with open(infoFile, 'w') as outFile:
-        outFile.write(expectedInstallString)
+        outFile.write(installString)
 
     return thirdPath
+
+
+def prepareGIT(name,
+               source,
+               paths=None,
+               ):
+    """Prepare files from a GIT repository.
+
+    Notes
+    -----
+    The repository is kept as a bare mirror in the data directory, shared by
+    all packages using the same URL. Only the files used from the package are
+    extracted from it.
+    """
+    if 'tag' not in source:
+        tagName = ''
+        ref = 'refs/heads/master'
+    else:
+        tagName = source['tag']
+        ref = 'refs/tags/%s' % tagName
+
+    def extract(destinationPath):
+        mirrorPath = updateMirror(source['url'], ref)
+        try:
+            _extractArchive(mirrorPath, ref, paths, destinationPath)
+        except Exception as e:
+            raise RuntimeError('Error when preparing tag %s for %s: %s'
+                               % (tagName,
+                                  name,
+                                  e,
+                                  ),
+                               )
+
+    return _preparedPath(name,
+                         '%s:%s:%s' % (source['url'],
+                                       tagName,
+                                       ','.join(paths or []),
+                                       ),
+                         extract,
+                         )
+
+
+def _parseChecksum(checksum):
+    """Return the algorithm and the hex digest of an archive checksum"""
+    try:
+        algorithm, hexDigest = checksum.split(':', 1)
+    except (AttributeError, ValueError):
+        algorithm, hexDigest = None, None
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise RuntimeError('Invalid checksum "%s" (expected "<algorithm>:'
+                           '<hex digest>" with algorithm in %s)'
+                           % (checksum,
+                              ', '.join(CHECKSUM_ALGORITHMS),
+                              ),
+                           )
+    return algorithm, hexDigest.lower()
+
+
+def downloadArchive(url, checksum):
+    """Return the path of a downloaded archive, downloading it if needed.
+
+    Parameters
+    ----------
+    url : string
+        The archive URL. Local files (file://) can be used.
+    checksum : string
+        The expected checksum, as "<algorithm>:<hex digest>"
+
+
+    Returns
+    -------
+    string
+        The path of the archive in the download cache
+
+
+    Notes
+    -----
+    Archives are stored in the data directory under their digest, and only
+    downloaded when missing. The digest is computed while downloading; an
+    archive that doesn't match is not stored.
+    """
+    algorithm, hexDigest = _parseChecksum(checksum)
+    downloadDir = join(utils.dataPath(),
+                       DOWNLOADS_DIR,
+                       )
+    archivePath = join(downloadDir,
+                       '%s-%s' % (algorithm,
+                                  hexDigest,
+                                  ),
+                       )
+    if isfile(archivePath):
+        return archivePath
+    makedirs(downloadDir, exist_ok=True)
+    temporaryPath = '%s.%s.%s.tmp' % (archivePath,
+                                      getpid(),
+                                      get_ident(),
+                                      )
+    logg.debug('Downloading %s' % url)
+    archiveDigest = hashlib.new(algorithm)
+    try:
+        with urlopen(url) as response, open(temporaryPath, 'wb') as outFile:
+            while True:
+                chunk = response.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                archiveDigest.update(chunk)
+                outFile.write(chunk)
+        if archiveDigest.hexdigest() != hexDigest:
+            raise RuntimeError('Checksum mismatch for %s: got %s:%s'
+                               % (url,
+                                  algorithm,
+                                  archiveDigest.hexdigest(),
+                                  ),
+                               )
+        replace(temporaryPath, archivePath)
+    except Exception:
+        try:
+            unlink(temporaryPath)
+        except OSError:
+            pass
+        raise
+    return archivePath
+
+
+def _memberPath(memberName, root):
+    """Return the path of an archive member relative to the package root.
+
+    Returns
+    -------
+    string
+        The path, or None if the member is outside of the root
+    """
+    memberName = normpath(memberName)
+    if not root:
+        return memberName
+    root = normpath(root)
+    if not memberName.startswith(root + '/'):
+        return None
+    return memberName[len(root) + 1:]
+
+
+def _extractTarball(archivePath, root, paths, destinationPath):
+    """Extract some files of a tar archive, in a single pass.
+
+    Returns
+    -------
+    set(string)
+        The extracted paths
+    """
+    now = time()
+    extracted = set()
+    with tarfile.open(archivePath, mode='r|*') as archive:
+        for member in archive:
+            path = _memberPath(member.name, root)
+            if (path is None
+                    or not member.isfile()
+                    or (paths is not None and path not in paths)):
+                continue
+            member.name = path
+            member.mtime = now
+            if hasattr(tarfile, 'data_filter'):
+                archive.extract(member, destinationPath, filter='data')
+            else:
+                archive.extract(member, destinationPath)
+            extracted.add(path)
+    return extracted
+
+
+def _extractZip(archivePath, root, paths, destinationPath):
+    """Extract some files of a zip archive.
+
+    Returns
+    -------
+    set(string)
+        The extracted paths
+    """
+    extracted = set()
+    with zipfile.ZipFile(archivePath) as archive:
+        for member in archive.infolist():
+            path = _memberPath(member.filename, root)
+            if (path is None
+                    or member.is_dir()
+                    or (paths is not None and path not in paths)):
+                continue
+            if path.startswith('../') or path.startswith('/'):
+                raise RuntimeError('Invalid member in archive: %s'
+                                   % member.filename)
+            outputPath = join(destinationPath, path)
+            makedirs(dirname(outputPath), exist_ok=True)
+            with archive.open(member) as inFile, \
+                    open(outputPath, 'wb') as outFile:
+                copyfileobj(inFile, outFile, COPY_CHUNK_SIZE)
+            extracted.add(path)
+    return extracted
+
+
+def prepareArchive(name,
+                   source,
+                   paths=None,
+                   ):
+    """Prepare files from a tar or zip archive.
+
+    Notes
+    -----
+    The archive is verified and kept in the data directory (see
+    downloadArchive()). Only the files used from the package are extracted
+    from it.
+    """
+    if 'checksum' not in source:
+        raise RuntimeError('No checksum for archive %s of %s'
+                           % (source['url'],
+                              name,
+                              ),
+                           )
+    root = source.get('root', '')
+    if source['type'] == 'zip':
+        extractArchive = _extractZip
+    else:
+        extractArchive = _extractTarball
+
+    def extract(destinationPath):
+        archivePath = downloadArchive(source['url'], source['checksum'])
+        try:
+            extracted = extractArchive(archivePath,
+                                       root,
+                                       set(paths) if paths else None,
+                                       destinationPath,
+                                       )
+        except (OSError, tarfile.TarError, zipfile.BadZipFile) as e:
+            raise RuntimeError('Error when extracting %s for %s: %s'
+                               % (source['url'],
+                                  name,
+                                  e,
+                                  ),
+                               )
+        missing = sorted(set(paths or []) - extracted)
+        if missing:
+            raise RuntimeError('Files missing from %s for %s: %s'
+                               % (source['url'],
+                                  name,
+                                  ', '.join(missing),
+                                  ),
+                               )
+
+    return _preparedPath(name,
+                         '%s:%s:%s:%s' % (source['url'],
+                                          source['checksum'],
+                                          root,
+                                          ','.join(paths or []),
+                                          ),
+                         extract,
+                         )
+
+
+def prepareDirectory(name,
+                     source,
+                     paths=None,
+                     ):
+    """Use files from a local directory.
+
+    Notes
+    -----
+    Files are used in place; nothing is copied.
+    """
+    sourcePath = join(config().ROOT,
+                      source['path'],
+                      )
+    if not isdir(sourcePath):
+        raise RuntimeError('Missing directory %s for %s'
+                           % (sourcePath,
+                              name,
+                              ),
+                           )
+    return sourcePath
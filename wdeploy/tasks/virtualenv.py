@@ -73,8 +73,26 @@ def _installRequirements(outputDir):
     check_call(args)
 
 
+def _virtualenvInputs(args):
+    """Inputs of virtualenv(): the packages installed in both environments"""
+    return {'files': [join(args[argName],
+                           'lib',
+                           'python*',
+                           'site-packages',
+                           )
+                      for argName in ('sourceDir', 'outputDir')
+                      ] + [join(args['outputDir'],
+                                'requirements.txt',
+                                ),
+                           ],
+            'tools': ['virtualenv'],
+            }
+
+
 @task(sourcePathArguments=['sourceDir'],
       destinationPathArguments=['outputDir'],
+      concurrent=True,
+      inputs=_virtualenvInputs,
       )
 def virtualenv(sourceDir,
                outputDir,
@@ -97,6 +115,8 @@ def virtualenv(sourceDir,
     -----
     The copied environment is not a 1:1 copy of the source; it merely reproduces
     the list of installed packages.
+    The task is skipped when no package was installed or removed in either
+    environment since its last run.
     """
     _createVirtualEnvironment(outputDir, pythonBin)
     requirements = _getRequirements(sourceDir)
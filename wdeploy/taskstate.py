@@ -0,0 +1,185 @@
+# encoding=utf-8
+"""Skip tasks whose inputs did not change since their last successful run.
+
+Tasks declaring their inputs (see the inputs argument of wdeploy.task.task())
+get a fingerprint made of:
+- their arguments
+- the configuration file
+- the size, modification time and inode of their input files
+- the identity of the programs they use (see utils.toolIdentity())
+- the existence of their outputs
+The fingerprint is stored in the project data directory after each successful
+run, and the task is skipped when it matches on the next run.
+
+Setting the WDEPLOY_FORCE environment variable (--force option of
+webdeploy.py) runs all tasks.
+"""
+from glob import glob
+from hashlib import sha1
+import json
+from os import (environ,
+                remove,
+                replace,
+                stat,
+                )
+from os.path import (exists,
+                     join,
+                     )
+from wdeploy import (config,
+                     digest,
+                     utils,
+                     )
+from logging import getLogger
+
+if __name__ == '__main__':
+    raise Exception('This program cannot be run in DOS mode.')
+logg = getLogger(__name__)
+
+
+TASK_STATE_VERSION = 1
+
+# Environment variable set to run all tasks
+FORCE_KEY = 'WDEPLOY_FORCE'
+
+
+def isForced():
+    """Tell if tasks must run even if their inputs did not change"""
+    return bool(environ.get(FORCE_KEY))
+
+
+def _inputFiles(patterns):
+    """Return the stamps of the files matching some glob patterns.
+
+    Notes
+    -----
+    Directories can be matched; their modification time changes when entries
+    are added or removed.
+    """
+    result = []
+    for pattern in patterns:
+        for path in sorted(glob(pattern, recursive=True)):
+            try:
+                pathStat = stat(path)
+            except FileNotFoundError:
+                continue
+            result.append('%s:%s:%s:%s' % (path,
+                                           pathStat.st_size,
+                                           pathStat.st_mtime_ns,
+                                           pathStat.st_ino,
+                                           ),
+                          )
+        result.append('')
+    return result
+
+
+class TaskState(object):
+    """The fingerprint of a task, compared to its last successful run.
+
+    Parameters
+    ----------
+    taskName : string
+        The name of the task
+    args : dict
+        The task arguments, as in the configuration
+    inputsCB : runnable
+        Called without argument, returns the task inputs as a dictionary with
+        the optional keys "files" (list of glob patterns), "tools" (list of
+        programs) and "outputs" (list of paths written by the task; only their
+        existence is checked, since the task changes them).
+    """
+
+    def __init__(self, taskName, args, inputsCB):
+        self.taskName = taskName
+        self.inputsCB = inputsCB
+        self.args = json.dumps(args,
+                               sort_keys=True,
+                               default=repr,
+                               )
+        self.statePath = join(utils.dataPath(),
+                              '%s.task' % sha1(('%s:%s'
+                                                % (taskName,
+                                                   self.args,
+                                                   )
+                                                ).encode()).hexdigest(),
+                              )
+
+    def fingerprint(self):
+        """Return the current fingerprint of the task.
+
+        Returns
+        -------
+        string
+            The fingerprint, or None if it can't be computed (missing program)
+        """
+        inputs = self.inputsCB()
+        parts = ['%s' % TASK_STATE_VERSION,
+                 self.taskName,
+                 self.args,
+                 digest.fileDigest(config().__file__),
+                 ]
+        parts += _inputFiles(inputs.get('files', []))
+        parts += ['%s:%s' % (path,
+                             exists(path),
+                             )
+                  for path in inputs.get('outputs', [])
+                  ]
+        try:
+            parts += [utils.toolIdentity(toolName)
+                      for toolName in inputs.get('tools', [])
+                      ]
+        except RuntimeError as e:
+            logg.debug('No fingerprint for task %s: %s'
+                       % (self.taskName,
+                          e,
+                          ),
+                       )
+            return None
+        return digest.combineDigests(parts)
+
+    def isUpToDate(self, fingerprint):
+        """Tell if the task inputs did not change since its last run.
+
+        Parameters
+        ----------
+        fingerprint : string
+            The fingerprint of the task, as returned by fingerprint()
+        """
+        if isForced() or fingerprint is None:
+            return False
+        try:
+            with open(self.statePath, 'r') as inFile:
+                previous = inFile.read()
+        except OSError:
+            return False
+        return previous == fingerprint
+
+    def reset(self):
+        """Forget the last successful run, before running the task"""
+        try:
+            remove(self.statePath)
+        except FileNotFoundError:
+            pass
+
+    def save(self, fingerprint):
+        """Record the fingerprint of a successful run.
+
+        Parameters
+        ----------
+        fingerprint : string
+            The fingerprint computed before running the task. Inputs changed
+            while the task was running (including by the task itself) make the
+            next run check them again.
+        """
+        if fingerprint is None:
+            return
+        temporaryPath = '%s.tmp' % self.statePath
+        try:
+            with open(temporaryPath, 'w') as outFile:
+                outFile.write(fingerprint)
+            replace(temporaryPath, self.statePath)
+        except OSError:
+            logg.warning('Can\'t save the state of task %s' % self.taskName)
+            try:
+                remove(temporaryPath)
+            except OSError:
+                pass
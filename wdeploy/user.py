@@ -1,13 +1,45 @@
 # encoding=utf-8
 """Manage user switching"""
+from array import array
+from atexit import register as atexit_register
 from functools import wraps
+from importlib import import_module
+from errno import (EINVAL,
+                   ENOSYS,
+                   EOPNOTSUPP,
+                   EXDEV,
+                   )
 from os import (seteuid,
                 setegid,
                 environ,
                 getuid,
                 getgid,
+                getcwd,
+                getpid,
+                chdir,
+                close,
+                fork,
+                _exit,
+                waitpid,
+                open as os_open,
+                register_at_fork,
+                replace,
+                sendfile,
+                stat,
+                unlink,
+                O_CREAT,
+                O_RDONLY,
+                O_TRUNC,
+                O_WRONLY,
                 )
-from os.path import (getmtime,
+try:
+    from os import copy_file_range
+except ImportError:
+    copy_file_range = None
+from os.path import (basename,
+                     dirname,
+                     getmtime,
+                     join,
                      )
 from pwd import (getpwnam,
                  getpwuid,
@@ -15,10 +47,13 @@ from pwd import (getpwnam,
 from grp import (getgrnam,
                  getgrgid,
                  )
-from multiprocessing import (Process,
-                             SimpleQueue,
-                             )
+from multiprocessing import get_context
+from multiprocessing.reduction import (recv_handle,
+                                       send_handle,
+                                       )
+from threading import Lock
 from wdeploy import (config,
+                     profiling,
                      utils,
                      )
 from logging import getLogger
@@ -31,6 +66,372 @@ logg = getLogger(__name__)
 ORIGINAL_UID_KEY = 'WDEPLOY_ORIGINAL_UID'
 ORIGINAL_GID_KEY = 'WDEPLOY_ORIGINAL_GID'
 
+# Workers are forked so they inherit the registry of decorated functions and
+# the already loaded configuration.
+_FORK = get_context('fork')
+# Delay to wait for a worker to exit after asking it to stop
+WORKER_STOP_TIMEOUT = 5
+
+# Functions decorated with as_user(), indexed by _functionKey()
+_FUNCTIONS = {}
+# Worker pools, indexed by identity (user name, group name)
+_POOLS = {}
+_POOLS_LOCK = Lock()
+# Identity of the current process if it is a worker, None otherwise
+_CURRENT_IDENTITY = None
+# Size of the chunks copied at once by _copyDescriptor()
+COPY_CHUNK_SIZE = 1 << 30
+
+
+class FileDescriptor(object):
+    """An open file descriptor passed between the caller and a worker.
+
+    Notes
+    -----
+    When used as an argument or a return value of a function decorated with
+    as_user(), the descriptor itself is transferred to the other process
+    (using SCM_RIGHTS) instead of being pickled as a number.
+    The receiving side owns the descriptor it gets and must close it; for
+    arguments, this is done by the worker once the function returns.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def close(self):
+        close(self.fd)
+
+
+def _passedDescriptors(args, kwargs):
+    """Return the FileDescriptor objects found in call arguments"""
+    return [arg
+            for arg in list(args) + list(kwargs.values())
+            if isinstance(arg, FileDescriptor)
+            ]
+
+
+def _functionKey(function):
+    """Return the name used to designate a function in worker messages"""
+    return '%s:%s' % (function.__module__,
+                      function.__qualname__,
+                      )
+
+
+def _resolveFunction(key):
+    """Return a function registered by as_user() from its key.
+
+    Notes
+    -----
+    If the module defining the function was imported after the worker was
+    started, it is imported on demand; this registers its functions.
+    """
+    if key not in _FUNCTIONS:
+        import_module(key.split(':')[0])
+    return _FUNCTIONS[key]
+
+
+def _resolveName(name):
+    """Return a user/group name, calling it if it is a runnable"""
+    if name is None or isinstance(name, str):
+        return name
+    return name()
+
+
+def _switchIdentity(identity):
+    """Change the effective user and group of the current process"""
+    realUserName, realGroupName = identity
+    if realGroupName:
+        logg.debug('Group: %s' % realGroupName)
+        setegid(getgrnam(realGroupName).gr_gid)
+    if realUserName:
+        logg.debug('User: %s' % realUserName)
+        userDef = getpwnam(realUserName)
+        seteuid(userDef.pw_uid)
+        environ['HOME'] = userDef.pw_dir
+
+
+def _callNested(identity, key, args, kwargs):
+    """Run a function with another identity from a worker.
+
+    Returns
+    -------
+    tuple(bool, object)
+        Success, and the returned value or the raised exception
+
+
+    Notes
+    -----
+    Workers are daemon processes and can't start workers of their own. The
+    function runs in a process forked for this call only, which gets back the
+    privileges of the worker before switching identity.
+    """
+    global _CURRENT_IDENTITY
+    logg.debug('Running %s as %s/%s in a forked process'
+               % ((key,) + identity))
+    connection, childConnection = _FORK.Pipe()
+    pid = fork()
+    if pid == 0:
+        status = 0
+        try:
+            connection.close()
+            profiling.takeCounters()
+            try:
+                seteuid(getuid())
+                setegid(getgid())
+                _switchIdentity(identity)
+                _CURRENT_IDENTITY = identity
+                reply = (True, _resolveFunction(key)(*args, **kwargs))
+            except Exception as e:
+                reply = (False, e)
+            childConnection.send(reply + (profiling.takeCounters(),))
+            if isinstance(reply[1], FileDescriptor):
+                send_handle(childConnection, reply[1].fd, None)
+        except BaseException:
+            status = 1
+        finally:
+            _exit(status)
+    childConnection.close()
+    try:
+        success, value, collected = connection.recv()
+        profiling.merge(collected)
+        if isinstance(value, FileDescriptor):
+            value.fd = recv_handle(connection)
+    except EOFError:
+        success, value = False, RuntimeError('Process running %s failed'
+                                             % key)
+    finally:
+        connection.close()
+        waitpid(pid, 0)
+    return success, value
+
+
+def _workerMain(identity, connection, parentConnection):
+    """Main loop of a worker process.
+
+    Parameters
+    ----------
+    identity : tuple(string, string)
+        The user and group names to run as
+    connection : multiprocessing.connection.Connection
+        The connection to the parent process
+    parentConnection : multiprocessing.connection.Connection
+        The other end of the connection, inherited from the parent process.
+        It is closed so that the worker gets EOFError when the parent exits.
+
+
+    Notes
+    -----
+    Messages received are either None (stop the worker) or a tuple made of a
+    function key, the positional arguments and the keyword arguments.
+    Replies are tuples made of a boolean indicating success, either the
+    returned value or the raised exception, and the profiling counters
+    collected during the call (see wdeploy.profiling.takeCounters()).
+    The first reply is sent once the identity is switched.
+    """
+    global _CURRENT_IDENTITY
+    parentConnection.close()
+    # Counters inherited from the parent process are already accounted for
+    profiling.takeCounters()
+    # Connections to the other workers belong to the parent process
+    for pool in _POOLS.values():
+        pool.forget()
+    _POOLS.clear()
+    try:
+        _switchIdentity(identity)
+    except Exception as e:
+        connection.send((False, e))
+        return
+    _CURRENT_IDENTITY = identity
+    workDir = getcwd()
+    connection.send((True, None))
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        key, args, kwargs = message
+        descriptors = _passedDescriptors(args, kwargs)
+        for descriptor in descriptors:
+            descriptor.fd = recv_handle(connection)
+        try:
+            reply = (True, _resolveFunction(key)(*args, **kwargs))
+        except Exception as e:
+            reply = (False, e)
+        reply += (profiling.takeCounters(),)
+        for descriptor in descriptors:
+            descriptor.close()
+        if getcwd() != workDir:
+            try:
+                chdir(workDir)
+            except OSError:
+                logg.debug('Can\'t restore working directory %s' % workDir)
+        try:
+            connection.send(reply)
+        except Exception as e:
+            connection.send((False,
+                             RuntimeError('Can\'t send result of %s: %s'
+                                          % (key,
+                                             e,
+                                             ),
+                                          ),
+                             reply[2],
+                             ))
+            continue
+        if isinstance(reply[1], FileDescriptor):
+            send_handle(connection, reply[1].fd, None)
+            reply[1].close()
+    connection.close()
+
+
+class _Worker(object):
+    """A process running with a given identity, waiting for function calls.
+
+    Notes
+    -----
+    Workers are daemon processes: they can't start workers of their own (see
+    _callNested()).
+    """
+
+    def __init__(self, identity):
+        self.connection, childConnection = _FORK.Pipe()
+        self.process = _FORK.Process(target=_workerMain,
+                                     args=(identity,
+                                           childConnection,
+                                           self.connection,
+                                           ),
+                                     daemon=True,
+                                     )
+        self.process.start()
+        childConnection.close()
+        try:
+            success, value = self.connection.recv()
+        except EOFError:
+            success, value = False, RuntimeError('Worker failed to start')
+        if not success:
+            self.stop()
+            raise value
+
+    def call(self, key, args, kwargs):
+        """Run a function in the worker and return the reply"""
+        self.connection.send((key,
+                              args,
+                              kwargs,
+                              ),
+                             )
+        for descriptor in _passedDescriptors(args, kwargs):
+            send_handle(self.connection, descriptor.fd, self.process.pid)
+        success, value, collected = self.connection.recv()
+        profiling.merge(collected)
+        if isinstance(value, FileDescriptor):
+            value.fd = recv_handle(self.connection)
+        return success, value
+
+    def stop(self):
+        """Ask the worker to exit and wait for it"""
+        try:
+            self.connection.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(WORKER_STOP_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.connection.close()
+
+
+class _WorkerPool(object):
+    """Set of workers sharing the same identity.
+
+    Notes
+    -----
+    A worker is only used by one call at a time; new workers are started when
+    all existing ones are busy, so concurrent callers never wait on each other.
+    """
+
+    def __init__(self, identity):
+        self.identity = identity
+        self.lock = Lock()
+        self.idle = []
+        self.workers = []
+
+    def call(self, key, args, kwargs):
+        with self.lock:
+            worker = self.idle.pop() if self.idle else None
+        if worker is None:
+            logg.debug('Starting worker for %s/%s' % self.identity)
+            with profiling.timed('worker:%s/%s' % self.identity):
+                worker = _Worker(self.identity)
+            with self.lock:
+                self.workers.append(worker)
+        try:
+            with profiling.timed('as_user:%s' % key):
+                success, value = worker.call(key, args, kwargs)
+        except BaseException:
+            # The worker state is unknown; don't reuse it
+            with self.lock:
+                self.workers.remove(worker)
+            worker.process.terminate()
+            worker.stop()
+            raise
+        with self.lock:
+            self.idle.append(worker)
+        if not success:
+            raise value
+        return value
+
+    def stop(self):
+        with self.lock:
+            workers = self.workers
+            self.workers = []
+            self.idle = []
+        for worker in workers:
+            worker.stop()
+
+    def forget(self):
+        """Close connections inherited from the parent process"""
+        for worker in self.workers:
+            worker.connection.close()
+        self.workers = []
+        self.idle = []
+
+
+def _getPool(identity):
+    """Return the worker pool for an identity, creating it if needed"""
+    with _POOLS_LOCK:
+        try:
+            return _POOLS[identity]
+        except KeyError:
+            pool = _WorkerPool(identity)
+            _POOLS[identity] = pool
+            return pool
+
+
+def stop_workers():
+    """Stop all worker processes.
+
+    Notes
+    -----
+    This is called automatically at exit. Workers are started again on demand
+    if a function decorated with as_user() is called afterward.
+    """
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+        _POOLS.clear()
+    for pool in pools:
+        pool.stop()
+
+
+def _resetLock():
+    """Make sure a forked process doesn't inherit a held lock"""
+    global _POOLS_LOCK
+    _POOLS_LOCK = Lock()
+
+
+register_at_fork(after_in_child=_resetLock)
+atexit_register(stop_workers)
+
 
 def as_user(userName=None,
             groupName=None,
@@ -50,58 +451,39 @@ def as_user(userName=None,
 
     Notes
     -----
-    The function will be run in a separate process through the multiprocessing
-    facilities. Existing open files are still available in this context.
-    Return values can be handled, but they have to go through a
-    multiprocessing.SimpleQueue object, making it impossible to pass advanced
-    objects.
+    The function will be run in a separate worker process. One worker is
+    started the first time an identity is needed, then reused for all
+    subsequent calls with the same identity. Files opened after the worker was
+    started are not available in this context, and the current directory is
+    restored after each call.
+    The function must be defined at module level, and its arguments and return
+    value go through a multiprocessing connection, making it impossible to
+    pass advanced objects.
     Exception raised in the function will be re-raised to the caller
     transparently.
+    A function running in a worker calls functions decorated for the same
+    identity directly. Functions decorated for another identity run in a
+    process forked for each call, as workers can't start workers of their own.
     """
     def decorator(function):
         """The real decorator, built using as_user()"""
+        key = _functionKey(function)
+        _FUNCTIONS[key] = function
+
         @wraps(function)
         def decorated(*args, **kwargs):
-            """Wrapped function, change uid and retrieve result."""
-            resultQueue = SimpleQueue()
-
-            def user_switched_process(*args, **kwargs):
-                """Function called in subprocess."""
-                logg.debug('Running function as another user')
-                if groupName:
-                    if isinstance(groupName, str):
-                        realGroupName = groupName
-                    else:
-                        realGroupName = groupName()
-                    logg.debug('Group: %s' % realGroupName)
-                    setegid(getgrnam(realGroupName).gr_gid)
-                if userName:
-                    if isinstance(userName, str):
-                        realUserName = userName
-                    else:
-                        realUserName = userName()
-                    logg.debug('User: %s' % realUserName)
-                    userDef = getpwnam(realUserName)
-                    seteuid(userDef.pw_uid)
-                    environ['HOME'] = userDef.pw_dir
-                try:
-                    result = function(*args, **kwargs)
-                    resultQueue.put(result)
-                    resultQueue.put(None)
-                except Exception as e:
-                    resultQueue.put(None)
-                    resultQueue.put(e)
-
-            subprocess = Process(target=user_switched_process,
-                                 args=args,
-                                 kwargs=kwargs,
-                                 )
-            subprocess.start()
-            result = resultQueue.get()
-            exception = resultQueue.get()
-            if exception:
-                raise exception
-            return result
+            """Wrapped function, run it in the worker for the identity."""
+            identity = (_resolveName(userName),
+                        _resolveName(groupName),
+                        )
+            if identity == _CURRENT_IDENTITY:
+                return function(*args, **kwargs)
+            if _CURRENT_IDENTITY is not None:
+                success, value = _callNested(identity, key, args, kwargs)
+                if not success:
+                    raise value
+                return value
+            return _getPool(identity).call(key, args, kwargs)
         return decorated
     return decorator
 
@@ -149,15 +531,129 @@ def original_group():
 def readSourceFile(sourcePath):
     """Return the content of a source file using original user"""
     with open(sourcePath, 'rb') as inFile:
-        return inFile.read()
+        content = inFile.read()
+    profiling.count('bytes.read', len(content))
+    return content
+
+
+def _writeAtomically(destinationPath, writeCB):
+    """Write a file through a temporary file renamed once complete.
+
+    Parameters
+    ----------
+    destinationPath : string
+        The file to write
+    writeCB : runnable
+        A runnable receiving the descriptor of the temporary file, and writing
+        the content into it.
+
+
+    Notes
+    -----
+    If writing fails, the temporary file is removed and the destination file is
+    left untouched.
+    """
+    utils.makeParentPath(destinationPath)
+    temporaryPath = join(dirname(destinationPath),
+                         '.%s.%s.tmp' % (basename(destinationPath),
+                                         getpid(),
+                                         ),
+                         )
+    outFD = os_open(temporaryPath, O_WRONLY | O_CREAT | O_TRUNC, 0o666)
+    try:
+        try:
+            writeCB(outFD)
+        finally:
+            close(outFD)
+        replace(temporaryPath, destinationPath)
+    except BaseException:
+        try:
+            unlink(temporaryPath)
+        except OSError:
+            pass
+        raise
 
 
 @as_user(prefix_user, prefix_group)
 def writeDestinationFile(destinationPath, content):
     """Write a destination file using prefix user"""
-    utils.makeParentPath(destinationPath)
-    with open(destinationPath, 'wb') as outFile:
-        outFile.write(content)
+    def writeCB(outFD):
+        with open(outFD, 'wb', closefd=False) as outFile:
+            outFile.write(content)
+    _writeAtomically(destinationPath, writeCB)
+    profiling.count('bytes.written', len(content))
+
+
+def _copyDescriptor(inFD, outFD):
+    """Copy the whole content of a file into another one.
+
+    Notes
+    -----
+    The copy is done by the kernel (copy_file_range() or sendfile()); the
+    content is never read into memory.
+    """
+    offset = 0
+    useCopyRange = copy_file_range is not None
+    while True:
+        if useCopyRange:
+            try:
+                copied = copy_file_range(inFD,
+                                         outFD,
+                                         COPY_CHUNK_SIZE,
+                                         offset,
+                                         )
+            except OSError as e:
+                if e.errno not in (EINVAL, ENOSYS, EOPNOTSUPP, EXDEV):
+                    raise
+                useCopyRange = False
+                continue
+        else:
+            copied = sendfile(outFD,
+                              inFD,
+                              offset,
+                              COPY_CHUNK_SIZE,
+                              )
+        if copied == 0:
+            break
+        offset += copied
+    profiling.count('bytes.read', offset)
+    profiling.count('bytes.written', offset)
+
+
+@as_user(original_user, original_group)
+def openSourceFile(sourcePath):
+    """Open a source file for reading using original user.
+
+    Returns
+    -------
+    FileDescriptor
+        The open file, to be closed by the caller
+    """
+    return FileDescriptor(os_open(sourcePath, O_RDONLY))
+
+
+@as_user(prefix_user, prefix_group)
+def writeDestinationFileFrom(destinationPath, sourceDescriptor):
+    """Write a destination file using prefix user, copying an open file"""
+    def writeCB(outFD):
+        _copyDescriptor(sourceDescriptor.fd, outFD)
+    _writeAtomically(destinationPath, writeCB)
+
+
+def copySourceToDestination(sourcePath, destinationPath):
+    """Copy a source file into a destination file.
+
+    Notes
+    -----
+    The source file is opened by the original user and its descriptor handed
+    to the prefix user, which writes the destination; the file content never
+    goes through the workers connections.
+    """
+    sourceDescriptor = openSourceFile(sourcePath)
+    try:
+        writeDestinationFileFrom(destinationPath, sourceDescriptor)
+    finally:
+        sourceDescriptor.close()
 
 
 def _getMTime(path):
@@ -180,11 +676,80 @@ def getDestinationMTime(destinationPath):
     return _getMTime(destinationPath)
 
 
+def _getMTimes(paths):
+    """Return the mtimes of a list of resources, in nanoseconds.
+
+    Notes
+    -----
+    Resources that doesn't exist have a mtime of 0.
+    """
+    result = array('q')
+    for path in paths:
+        try:
+            result.append(stat(path).st_mtime_ns)
+        except OSError:
+            result.append(0)
+    return result
+
+
+@as_user(original_user, original_group)
+def getSourceMTimes(sourcePaths):
+    """Return the mtimes of a list of source files (see _getMTimes())"""
+    return _getMTimes(sourcePaths)
+
+
+@as_user(prefix_user, prefix_group)
+def getDestinationMTimes(destinationPaths):
+    """Return the mtimes of a list of destination files (see _getMTimes())"""
+    return _getMTimes(destinationPaths)
+
+
+def _getStats(paths):
+    """Return the stamp of a list of resources.
+
+    Returns
+    -------
+    list(tuple(int, int, int))
+        The size, mtime (in nanoseconds) and inode of each resource.
+
+
+    Notes
+    -----
+    Resources that doesn't exist have a size, mtime and inode of 0.
+    """
+    result = []
+    for path in paths:
+        try:
+            pathStat = stat(path)
+            result.append((pathStat.st_size,
+                           pathStat.st_mtime_ns,
+                           pathStat.st_ino,
+                           ),
+                          )
+        except OSError:
+            result.append((0, 0, 0))
+    return result
+
+
+@as_user(original_user, original_group)
+def getSourceStats(sourcePaths):
+    """Return the stamp of a list of source files (see _getStats())"""
+    return _getStats(sourcePaths)
+
+
+@as_user(prefix_user, prefix_group)
+def getDestinationStats(destinationPaths):
+    """Return the stamp of a list of destination files (see _getStats())"""
+    return _getStats(destinationPaths)
+
+
 @as_user(original_user, original_group)
 def crawlSource(path):
-    return list(utils.walkfiles(path))
+    """List all files in a source directory (see utils.scanfiles())"""
+    return utils.scanfiles(path)
 
 
 @as_user(prefix_user, prefix_group)
 def crawlDestination(path):
-    return list(utils.walkfiles(path))
+    """List all files in a destination directory (see utils.scanfiles())"""
+    return utils.scanfiles(path)
@@ -1,32 +1,48 @@
 # encoding=utf-8
 """Utility functions for the WebDeploy project."""
+from array import array
 from codecs import open as codecs_open
+from collections import namedtuple
+from concurrent.futures import (FIRST_COMPLETED,
+                                ThreadPoolExecutor,
+                                wait,
+                                )
 import grp
 from os import (access,
                 chmod,
                 chown,
+                cpu_count,
                 environ,
                 makedirs,
-                walk,
+                scandir,
+                unlink,
                 X_OK,
                 )
 import subprocess
-from os.path import (isdir,
+from os.path import (basename,
+                     isdir,
                      isfile,
                      join,
                      pathsep,
                      relpath,
                      dirname,
                      isabs,
+                     normpath,
+                     realpath,
                      )
 import pwd
+from time import perf_counter
 from wdeploy import (config,
                      dependencies,
                      )
 from wdeploy.user import (crawlSource,
-                          getSourceMTime,
-                          getDestinationMTime,
+                          crawlDestination,
+                          getSourceStats,
+                          getDestinationStats,
                           )
+from wdeploy import (digest,
+                     profiling,
+                     )
 from logging import getLogger
 
 if __name__ == '__main__':
@@ -40,6 +56,23 @@ GIT = 'git'
 
 DATA_DIR = '.deploy'
 
+# Number of threads used to crawl directories
+SCAN_JOBS = 8
+
+# Maximum number of files processed by a single batch invocation
+BATCH_SIZE = 50
+
+# A file found by scanfiles(), with the stat data obtained while listing it
+FileEntry = namedtuple('FileEntry',
+                       ['relativePath',
+                        'name',
+                        'size',
+                        'mtimeNS',
+                        'inode',
+                        'mode',
+                        ],
+                       )
+
 
 def chowner(path,
             user,
@@ -140,7 +173,8 @@ def real_mkdir(fullDirPath):
     """
     if not isdir(fullDirPath):
         logg.info('Creating directory "%s"' % fullDirPath)
-        makedirs(fullDirPath)
+        # Another worker might create it at the same time
+        makedirs(fullDirPath, exist_ok=True)
         cfg_chown(fullDirPath)
         cfg_chmod(fullDirPath)
 
@@ -244,6 +278,41 @@ def which(toolName):
     return path
 
 
+def toolIdentity(toolName):
+    """Return a string identifying the installed version of a program.
+
+    Parameters
+    ----------
+    toolName : string
+        The name of the program, as passed to which()
+
+
+    Returns
+    -------
+    string
+        The program name and the digest of its executable file.
+
+
+    Notes
+    -----
+    The executable is read once (symlinks are followed), and the result is
+    cached. Upgrading a program replaces its executable, changing its
+    identity. Programs launched through a wrapper script that doesn't change
+    with their version are not detected.
+    """
+    myself = toolIdentity
+    try:
+        myself.cache
+    except AttributeError:
+        myself.cache = {}
+    if toolName not in myself.cache:
+        myself.cache[toolName] = '%s:%s' % (
+            toolName,
+            digest.fileDigest(realpath(which(toolName))),
+        )
+    return myself.cache[toolName]
+
+
 def isexecutable(path):
     """Determine if a path point to an executable file."""
     return isfile(path) and access(path, X_OK)
@@ -268,7 +337,7 @@ def dataPath():
                   )
     if not isdir(result):
         logg.info('Creating cache directory "%s"' % result)
-        makedirs(result)
+        makedirs(result, exist_ok=True)
     return result
 
 
@@ -280,12 +349,111 @@ def walkfiles(path):
     This generator returns all files in the form of tuples. First tuple element
     is the file path relative to the path argument, second tuple element is the
     file name.
+
+
+    Notes
+    -----
+    The directory is crawled with scanfiles().
     """
-    for dirPath, _, files in walk(path):
-        localPath = relpath(dirPath,
-                            path)
-        for fileName in files:
-            yield localPath, fileName
+    for entry in scanfiles(path):
+        yield entry.relativePath, entry.name
+
+
+def _scanDirectory(path, relativePath):
+    """List the content of a single directory for scanfiles().
+
+    Returns
+    -------
+    tuple(list(FileEntry), list(string))
+        The files of the directory, and the relative path of its
+        subdirectories.
+    """
+    files = []
+    directories = []
+    try:
+        with scandir(join(path, relativePath)) as entries:
+            for entry in entries:
+                if relativePath == '.':
+                    entryRelativePath = entry.name
+                else:
+                    entryRelativePath = join(relativePath, entry.name)
+                try:
+                    isDirectory = entry.is_dir()
+                except OSError:
+                    isDirectory = False
+                if isDirectory:
+                    # Like walk(), don't follow symbolic links to directories
+                    if not entry.is_symlink():
+                        directories.append(entryRelativePath)
+                    continue
+                try:
+                    entryStat = entry.stat()
+                except OSError:
+                    files.append(FileEntry(relativePath,
+                                           entry.name,
+                                           0,
+                                           0,
+                                           0,
+                                           0,
+                                           ),
+                                 )
+                    continue
+                files.append(FileEntry(relativePath,
+                                       entry.name,
+                                       entryStat.st_size,
+                                       entryStat.st_mtime_ns,
+                                       entryStat.st_ino,
+                                       entryStat.st_mode,
+                                       ),
+                             )
+    except OSError:
+        logg.debug('Can\'t list directory %s' % join(path, relativePath))
+    return files, directories
+
+
+def scanfiles(path, jobs=SCAN_JOBS):
+    """List all files from a given directory, with their stat data.
+
+    Parameters
+    ----------
+    path : string
+        The directory to crawl
+    jobs : int
+        The number of directories listed at the same time
+
+
+    Returns
+    -------
+    list(FileEntry)
+        All the files found, sorted by relative path. The relative path of
+        files at the root of path is '.', as with walkfiles().
+
+
+    Notes
+    -----
+    Every directory is listed as a separate job in a thread pool, so
+    independent subtrees are crawled in parallel.
+    Files that can't be stat'ed (broken symbolic links) have all their stat
+    data set to 0.
+    """
+    result = []
+    with ThreadPoolExecutor(jobs) as executor:
+        pending = {executor.submit(_scanDirectory, path, '.')}
+        while pending:
+            done, pending = wait(pending,
+                                 return_when=FIRST_COMPLETED,
+                                 )
+            for future in done:
+                files, directories = future.result()
+                result.extend(files)
+                pending.update(executor.submit(_scanDirectory,
+                                               path,
+                                               directory,
+                                               )
+                               for directory in directories
+                               )
+    result.sort()
+    return result
 
 
 def checkDependencies(baseDir,
@@ -297,8 +465,15 @@ def checkDependencies(baseDir,
                       updateCB,
                       filesList=None,
                       walkerCB=crawlSource,
-                      sourceMTimeCB=getSourceMTime,
-                      destinationMTimeCB=getDestinationMTime,
+                      sourceStatsCB=getSourceStats,
+                      destinationStatsCB=getDestinationStats,
+                      manifest=None,
+                      changeDetection='mtime',
+                      jobs=None,
+                      withDependencies=False,
+                      dependencyCache=None,
+                      changedPaths=None,
+                      batchCB=None,
                       ):
     """Crawl a directory to find updated files.
 
@@ -339,15 +514,47 @@ def checkDependencies(baseDir,
         provided, walkerCB is used
     walkerCB : runnable
         A runnable that takes a path as its single argument and returns a list
-        of tuples. Each tuple represent a file in the path, recursively, with
-        the first element of the tuple behing the relative path and the second
-        element behing the file name.
-    sourceMTimeCB : runnable
-        A runnable that take a path as its single argument and return the file
-        modification time. Used for source files.
-    destinationMTimeCB : runnable
-        A runnable that take a path as its single argument and return the file
-        modification time. Used for destination files. Default to
+        of FileEntry, representing the files in the path, recursively (see
+        scanfiles()). The modification time of these entries is used directly.
+    sourceStatsCB : runnable
+        A runnable that take a list of paths as its single argument and return
+        the list of the files size and modification times, as tuples. Used for
+        source files.
+    destinationStatsCB : runnable
+        A runnable that take a list of paths as its single argument and return
+        the list of the files size and modification times, as tuples. Used for
+        destination files.
+    manifest : Manifest
+        (optional) The manifest of the outputs from the previous run. Outputs
+        it knows whose sources did not change are skipped without checking
+        the destination. It is updated with the new state of the outputs, but
+        not saved.
+    changeDetection : string
+        How to detect that a file needs updating. With 'mtime', its output must
+        be older than the file or one of its dependencies. With 'hash', the
+        content digest of the file and its dependencies must differ from the
+        one recorded in the manifest, which is then required.
+    jobs : int
+        The maximum number of calls to updateCB running at the same time.
+        Default to the number of CPU. updateCB must be thread-safe.
+    withDependencies : bool
+        If True, updateCB receives a third argument: the list of the absolute
+        path of all files the source file depends on, directly or not.
+    dependencyCache : DependencyCache
+        (optional) Used to avoid calling dependencyCheck on unchanged files,
+        and to remember where dependencies were found. It is updated but not
+        saved.
+    changedPaths : list(string)
+        (optional) Full path of the files changed since the last run. If
+        dependencyCache can tell which outputs depend on them, only these
+        outputs are checked; the source directory is not crawled. Otherwise,
+        all files are checked.
+    batchCB : runnable
+        (optional) A runnable receiving a list of the arguments updateCB would
+        receive, for a chunk of files to update (up to BATCH_SIZE), and
+        processing them at once. It must return the list of the arguments it
+        did not process successfully; updateCB is then called for each of
+        them, so that errors are reported against the right file.
 
 
     Returns
@@ -355,49 +562,412 @@ def checkDependencies(baseDir,
     list(string)
         Return the list of all files that were checked by this call. This list
         is made of absolute path.
+
+
+    Notes
+    -----
+    If some updates fail, the others still complete and an exception listing
+    all failed outputs is raised at the end. Failed outputs are not recorded
+    in the manifest.
     """
-    if filesList is None:
-        sourceFilesPath = walkerCB(baseDir)
-        filesList = [join(x[0], x[1])
-                     for x in sourceFilesPath
+    if changeDetection == 'hash' and manifest is None:
+        raise RuntimeError('Hash change detection requires a manifest')
+    checkStart = perf_counter()
+    # Stamp (size, modification time, inode) obtained while crawling source
+    # files
+    knownStats = {}
+    targetedOutputs = None
+    if changedPaths is not None and dependencyCache is not None:
+        targetedOutputs = dependencyCache.affectedOutputs(changedPaths)
+    if targetedOutputs is not None:
+        logg.debug('Checking %s outputs affected by %s changed files'
+                   % (len(targetedOutputs),
+                      len(changedPaths),
+                      ),
+                   )
+        dependencyCache.keep()
+        filesList = [relpath(sourcePath, baseDir)
+                     for sourcePath in targetedOutputs.values()
                      ]
+    elif filesList is None:
+        filesList = []
+        for entry in walkerCB(baseDir):
+            relativePath = normpath(join(entry.relativePath, entry.name))
+            filesList.append(relativePath)
+            knownStats[join(baseDir, relativePath)] = (entry.size,
+                                                       entry.mtimeNS,
+                                                       entry.inode,
+                                                       )
     if validityCheck is None:
         def validityCheck(a):
             return True
-    allFiles = {x: {'modifiedDate': None,
-                    'relativePath': x,
-                    'fullPath': join(baseDir, x),
-                    'deps': [],
-                    }
-                for x in filesList
-                if validityCheck(join(baseDir, x))
-                }
-    dependencyFiles = {}
-
-    for fileObjKey in allFiles:
-        fileObj = allFiles[fileObjKey]
-        dependencies._fillDeps(fileObj,
-                               allFiles,
-                               dependencyFiles,
-                               includeDirs,
-                               localInclude,
-                               dependencyCheck,
-                               )
+    if dependencyCache is None:
+        graph = dependencies.DependencyGraph()
+    else:
+        graph = dependencies.DependencyGraph(dependencyCache.resolve)
+        if dependencyCheck:
+            dependencyCheck = dependencyCache.wrap(dependencyCheck)
+    sources = [graph.addSource(baseDir, x)
+               for x in dict.fromkeys(filesList)
+               if validityCheck(join(baseDir, x))
+               ]
+    graph.build(includeDirs,
+                localInclude,
+                dependencyCheck,
+                )
 
-    output = []
-    for fileObjKey in allFiles:
-        fileObj = allFiles[fileObjKey]
-        outputPath = outputCB(fileObj['relativePath'])
-        output.append(outputPath)
-        dependencies._updateMTime(fileObj, sourceMTimeCB)
-        outputMDate = destinationMTimeCB(outputPath)
-        if outputMDate <= fileObj['modifiedDate']:
-            updateCB(fileObj['fullPath'],
-                     outputPath,
-                     )
+    nodePaths = [graph.fullPath(node)
+                 for node in range(len(graph))
+                 ]
+    usedPaths = set(nodePaths)
+    sourcePaths = [path
+                   for path in usedPaths
+                   if path not in knownStats
+                   ]
+    sourceStats = dict(zip(sourcePaths,
+                           sourceStatsCB(sourcePaths),
+                           ),
+                       )
+    sourceStats.update((path, knownStats[path])
+                       for path in usedPaths
+                       if path in knownStats
+                       )
+    newestMTimes = graph.newestMTimes(array('q',
+                                            (sourceStats[path][1]
+                                             for path in nodePaths
+                                             ),
+                                            ),
+                                      )
+    output = [outputCB(graph.relativePaths[node])
+              for node in sources
+              ]
+
+    if changeDetection == 'hash':
+        sourceDigests = digest.sourceDigests(sourceStats)
+
+    # Outputs to check, with their source file, the stamp of their
+    # dependencies, their input digest, and how to check them:
+    # - 'mtime': compare the output mtime with the sources
+    # - 'verify': sources are unchanged, only check that the output is the one
+    #   recorded
+    # - 'update': sources changed
+    toCheck = []
+    for node, outputPath in zip(sources,
+                                output,
+                                ):
+        fullPath = nodePaths[node]
+        if manifest is None and dependencyCache is None:
+            toCheck.append((node, outputPath, {}, None, 'mtime'))
+            continue
+        fileDeps = [nodePaths[dep]
+                    for dep in graph.allDependencies(node)
+                    ]
+        if dependencyCache is not None:
+            dependencyCache.recordRoot(fullPath, outputPath, fileDeps)
+        if manifest is None:
+            toCheck.append((node, outputPath, {}, None, 'mtime'))
+            continue
+        depStamps = {dep: sourceStats[dep]
+                     for dep in fileDeps
+                     }
+        if changeDetection == 'hash':
+            inputDigest = digest.combineDigests(
+                [sourceDigests[fullPath]]
+                + sorted('%s:%s' % (dep,
+                                    sourceDigests[dep],
+                                    )
+                         for dep in fileDeps
+                         ),
+            )
+            if not manifest.matchesDigest(outputPath,
+                                          fullPath,
+                                          inputDigest,
+                                          ):
+                checkMode = 'update'
+            elif manifest.isTrusted(outputPath):
+                continue
+            else:
+                checkMode = 'verify'
+        else:
+            inputDigest = None
+            if manifest.isUpToDate(outputPath,
+                                   fullPath,
+                                   sourceStats[fullPath],
+                                   depStamps,
+                                   ):
+                continue
+            if manifest.rebuildUnknown(outputPath):
+                checkMode = 'update'
+            else:
+                checkMode = 'mtime'
+        toCheck.append((node,
+                        outputPath,
+                        depStamps,
+                        inputDigest,
+                        checkMode,
+                        ),
+                       )
+
+    outputStats = destinationStatsCB([item[1]
+                                      for item in toCheck
+                                      ])
+    toUpdate = []
+    for (node, outputPath, _, _, checkMode), outputStat in zip(
+            toCheck,
+            outputStats,
+    ):
+        if checkMode == 'mtime':
+            upToDate = outputStat[1] > newestMTimes[node]
+        elif checkMode == 'verify':
+            upToDate = manifest.outputStamp(outputPath) == tuple(outputStat)
+        else:
+            upToDate = False
+        if not upToDate:
+            if withDependencies:
+                updateArgs = (nodePaths[node],
+                              outputPath,
+                              [nodePaths[dep]
+                               for dep in graph.allDependencies(node)
+                               ],
+                              )
+            else:
+                updateArgs = (nodePaths[node],
+                              outputPath,
+                              )
+            toUpdate.append(updateArgs)
+    profiling.addTime('checkDependencies:check', perf_counter() - checkStart)
+    with profiling.timed('checkDependencies:update'):
+        updatedOutputs, failures = _runUpdates(updateCB,
+                                               toUpdate,
+                                               jobs,
+                                               batchCB,
+                                               )
+    profiling.count('files.checked', len(sources))
+    profiling.count('files.skipped', len(sources) - len(toUpdate))
+    profiling.count('files.rebuilt', len(updatedOutputs))
+    profiling.count('files.failed', len(failures))
+    if targetedOutputs is not None:
+        # Outputs not affected by the changes are still valid
+        output = dependencyCache.outputs()
+    if manifest is not None:
+        outputStats = dict(zip((item[1]
+                                for item in toCheck
+                                ),
+                               outputStats,
+                               ),
+                           )
+        outputStats.update(zip(updatedOutputs,
+                               destinationStatsCB(updatedOutputs),
+                               ),
+                           )
+        for node, outputPath, depStamps, inputDigest, _ in toCheck:
+            manifest.record(outputPath,
+                            nodePaths[node],
+                            sourceStats[nodePaths[node]],
+                            depStamps,
+                            outputStats[outputPath],
+                            inputDigest,
+                            )
+        manifest.retain(outputPath
+                        for outputPath in output
+                        if outputPath not in failures
+                        )
+    if failures:
+        raise RuntimeError('Failed to update %s file(s): %s'
+                           % (len(failures),
+                              ', '.join(failures),
+                              ),
+                           )
     return output
 
 
+def _updateChunk(updateCB, batchCB, chunk):
+    """Update a chunk of files with batchCB, then one by one if it failed.
+
+    Returns
+    -------
+    list(tuple(string, Exception))
+        The output path of each file in chunk, with the exception raised while
+        updating it (or None).
+    """
+    try:
+        notProcessed = batchCB(chunk)
+    except Exception as e:
+        logg.warning('Batch update of %s files failed, updating them one by '
+                     'one: %s'
+                     % (len(chunk),
+                        e,
+                        ),
+                     )
+        notProcessed = chunk
+    retryOutputs = set(updateArgs[1]
+                       for updateArgs in notProcessed
+                       )
+    result = []
+    for updateArgs in chunk:
+        error = None
+        if updateArgs[1] in retryOutputs:
+            try:
+                updateCB(*updateArgs)
+            except Exception as e:
+                error = e
+        result.append((updateArgs[1], error))
+    return result
+
+
+def _runUpdates(updateCB, toUpdate, jobs, batchCB=None):
+    """Call updateCB for all files to update, in parallel.
+
+    Parameters
+    ----------
+    updateCB : runnable
+        See checkDependencies()
+    toUpdate : list(tuple)
+        The arguments of updateCB for all files to update. The second one is
+        the output path.
+    jobs : int
+        The maximum number of calls to updateCB running at the same time. If
+        None, the number of CPU is used.
+    batchCB : runnable
+        (optional) See checkDependencies(). Files are split in chunks so that
+        all jobs get some work, with at most BATCH_SIZE files per chunk.
+
+
+    Returns
+    -------
+    tuple(list(string), dict)
+        The list of updated outputs, and the exception raised for each output
+        that failed.
+
+
+    Notes
+    -----
+    A failure doesn't stop other updates. Results are logged in the same order
+    as toUpdate, no matter in which order updates complete.
+    """
+    if jobs is None:
+        jobs = cpu_count() or 1
+    updatedOutputs = []
+    failures = {}
+
+    def handleResult(outputPath, error):
+        if error is not None:
+            logg.error('Error while updating %s: %s'
+                       % (outputPath,
+                          error,
+                          ),
+                       )
+            failures[outputPath] = error
+        else:
+            logg.debug('Updated %s' % outputPath)
+            updatedOutputs.append(outputPath)
+
+    def updateOne(*updateArgs):
+        try:
+            updateCB(*updateArgs)
+        except Exception as e:
+            return [(updateArgs[1], e)]
+        return [(updateArgs[1], None)]
+
+    if batchCB is not None:
+        chunkSize = max(1, min(BATCH_SIZE, -(-len(toUpdate) // jobs)))
+        tasks = [(_updateChunk,
+                  (updateCB,
+                   batchCB,
+                   toUpdate[index:index + chunkSize],
+                   ),
+                  )
+                 for index in range(0, len(toUpdate), chunkSize)
+                 ]
+    else:
+        tasks = [(updateOne, updateArgs)
+                 for updateArgs in toUpdate
+                 ]
+    if jobs <= 1 or len(tasks) <= 1:
+        for function, args in tasks:
+            for outputPath, error in function(*args):
+                handleResult(outputPath, error)
+        return updatedOutputs, failures
+    with ThreadPoolExecutor(jobs) as executor:
+        futures = [executor.submit(function, *args)
+                   for function, args in tasks
+                   ]
+        for future in futures:
+            for outputPath, error in future.result():
+                handleResult(outputPath, error)
+    return updatedOutputs, failures
+
+
+def removeStaleFiles(destinationDir,
+                     outputFiles,
+                     manifest=None,
+                     compressedFormats=(),
+                     ):
+    """Remove files from a destination directory that are not outputs.
+
+    Parameters
+    ----------
+    destinationDir : string
+        The directory to clean
+    outputFiles : list(string)
+        The full path of all the files to keep, as returned by
+        checkDependencies()
+    manifest : Manifest
+        (optional) The manifest used with checkDependencies(). If the
+        destination directory is unchanged since the previous run, the outputs
+        recorded then are the only candidates and the directory isn't crawled.
+    compressedFormats : list(string)
+        (optional) Suffixes of the compressed files written next to outputs
+        (see wdeploy.precompress). They are kept along with their output, and
+        removed along with it.
+    """
+    outputFiles = set(outputFiles)
+    keptFiles = outputFiles.union('%s.%s' % (outputPath, compressFormat)
+                                  for outputPath in outputFiles
+                                  for compressFormat in compressedFormats
+                                  )
+    if manifest is not None and manifest.isClean():
+        candidates = manifest.previousOutputs
+    else:
+        candidates = [join(destinationDir,
+                           entry.relativePath,
+                           entry.name,
+                           )
+                      for entry in crawlDestination(destinationDir)
+                      ]
+    for candidateFullPath in candidates:
+        # Files at the root of the crawl have a "./" component
+        candidateFullPath = normpath(candidateFullPath)
+        if candidateFullPath not in keptFiles:
+            logg.debug('Removing stale file %s' % candidateFullPath)
+            for stalePath in [candidateFullPath] + [
+                    '%s.%s' % (candidateFullPath, compressFormat)
+                    for compressFormat in compressedFormats
+            ]:
+                try:
+                    unlink(stalePath)
+                except FileNotFoundError:
+                    pass
+
+
+class _ProfiledPopen(subprocess.Popen):
+    """A process recording its run time once waited for (see profiling)"""
+
+    def __init__(self, args, **kwargs):
+        self._profileName = 'program:%s' % basename(args[0])
+        self._profileStart = perf_counter()
+        super().__init__(args, **kwargs)
+
+    def wait(self, timeout=None):
+        result = super().wait(timeout)
+        if self._profileStart is not None:
+            profiling.addTime(self._profileName,
+                              perf_counter() - self._profileStart,
+                              )
+            self._profileStart = None
+        return result
+
+
 def pipeRun(binaryName,
             inputStream,
             args):
@@ -430,11 +1000,15 @@ def pipeRun(binaryName,
         args = [binaryName] + args
     else:
         args = [which(binaryName)] + args
-    result = subprocess.Popen(args,
-                              stdin=inputStream or subprocess.DEVNULL,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.DEVNULL,
-                              )
+    if profiling.isEnabled():
+        popen = _ProfiledPopen
+    else:
+        popen = subprocess.Popen
+    result = popen(args,
+                   stdin=inputStream or subprocess.DEVNULL,
+                   stdout=subprocess.PIPE,
+                   stderr=subprocess.DEVNULL,
+                   )
     return result
 
 
@@ -474,3 +1048,47 @@ def readProcessOutput(binaryName,
                               ),
                            )
     return result
+
+
+def processData(binaryName,
+                data,
+                args):
+    """Run a program with the given data as input and return it's output.
+
+    Parameters
+    ----------
+    binaryName : string
+        The name of the program to run. Can be a simple name, in which case
+        'which' will be used, or an absolute path.
+    data : bytes
+        The content to send as the process input.
+    args : list
+        List of arguments to pass to the program
+
+
+    Returns
+    -------
+    The full output of the process.
+
+
+    Notes
+    -----
+    If the process return a value different than 0, an exception is raised.
+    """
+    if isabs(binaryName):
+        args = [binaryName] + args
+    else:
+        args = [which(binaryName)] + args
+    with profiling.timed('program:%s' % basename(args[0])):
+        process = subprocess.run(args,
+                                 input=data,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL,
+                                 )
+    if process.returncode != 0:
+        raise RuntimeError('Error while running program %s (%s)'
+                           % (binaryName,
+                              process.returncode,
+                              ),
+                           )
+    return process.stdout
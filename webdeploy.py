@@ -4,13 +4,17 @@
 from sys import (argv,
                  executable,
                  )
-from os import (getuid,
+from os import (execv,
+                getuid,
                 getgid,
                 environ,
                 )
-from subprocess import call
-from wdeploy import (config,
-                     runTask,
+from wdeploy import (compilecache,
+                     config,
+                     digest,
+                     profiling,
+                     scheduler,
+                     taskstate,
                      utils,
                      user,
                      )
@@ -21,17 +25,24 @@ logg = getLogger(__name__)
 
 def run():
     """Run all tasks from the configuration."""
-    for taskId, task in enumerate(config().TASKS):
-        logg.info('Running task %s: %s'
-                  % (taskId + 1,
-                     task['name'],
-                     ),
-                  )
-        runTask(task)
+    try:
+        scheduler.runTasks(config().TASKS,
+                           getattr(config(), 'TASK_JOBS', 1),
+                           )
+        compilecache.logStatistics()
+    finally:
+        digest.saveDigests()
+        profiling.writeReport()
 
 
 def sudoMe():
-    """Rerun self using sudo."""
+    """Rerun self using sudo.
+
+    Notes
+    -----
+    The current process is replaced, so the exit status of the run is the one
+    of sudo.
+    """
     try:
         logg.info('Calling sudo to rerun self')
         sudo = utils.which(utils.SUDO)
@@ -39,15 +50,19 @@ def sudoMe():
                    '-E',
                    executable,
                    argv[0],
-                   ]
+                   ] + argv[1:]
         environ[user.ORIGINAL_UID_KEY] = str(getuid())
         environ[user.ORIGINAL_GID_KEY] = str(getgid())
-        call(callArg)
+        execv(sudo, callArg)
     except Exception:
         logg.error('sudo not found; re-run this script as root.')
 
 
 def main():
+    if '--force' in argv[1:]:
+        environ[taskstate.FORCE_KEY] = '1'
+    if '--profile' in argv[1:]:
+        environ[profiling.PROFILE_KEY] = '1'
     if getuid() != 0:
         logg.warn('This script needs to be root to operate correctly')
         sudoMe()